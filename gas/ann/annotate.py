@@ -12,6 +12,10 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import vcf
+import bgzf
+from sweep_join import SweepJoin
+from transcripts import TranscriptModels
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -107,1023 +111,1387 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
-
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+"""Per-record lookups of the stages as parameterized statements
+   {table} and the other names are filled in by Stage.query(), values are
+   bound by the driver, so nothing needs to be stripped from them
+"""
+QUERIES = {
+    'dbSNP': 'select * from dbSNP where CHR = %s AND POS = %s AND ' +
+        '(REF = %s OR REF = %s) AND INFO = %s',
+    'chrom_pos_equal_base': 'select * from chrom_pos_equal_base where ' +
+        'CHR = %s AND start = %s AND ((haplotypeReference = %s AND ' +
+        'haplotypeAlternate = %s) OR (haplotypeReference = %s AND ' +
+        'haplotypeAlternate = %s))',
+    'chrom_pos_equal_nobase': 'select * from chrom_pos_equal_nobase ' +
+        'where CHR = %s AND start = %s',
+    'chrom_pos_unequal': 'select * from chrom_pos_unequal where ' +
+        'CHR = %s AND start <= %s AND %s <= end',
+    'transcripts': 'select * from {table} where chrom = %s AND ' +
+        '(txStart - %s) <= %s AND %s <= (txEnd + %s) ' +
+        'order by txStart, txEnd',
+    'cpgIslandExt': 'select chrom, chromStart, chromEnd, name from ' +
+        'cpgIslandExt where chrom = %s AND (chromStart <= %s AND ' +
+        '%s <= chromEnd) order by chromStart, chromEnd',
+    'overlap': 'select * from {table} where {chrom} = %s AND ' +
+        '({start} <= %s AND %s <= {end}) order by {start}, {end}',
+    'tfbsConsSites': 'select chrom, chromStart, chromEnd, name from ' +
+        '{table} where chromStart <= %s AND %s <= chromEnd ' +
+        'order by chromStart, chromEnd',
+    'gwasCatalog': 'select * from {table} where chrom = %s AND ' +
+        'chromEnd = %s order by chromStart, chromEnd',
+}
+
+# 'params' binds the values of QUERIES; 'inline' pastes them into the SQL
+# text the way the stages used to, to compare the two (compare_queries.py)
+QUERY_STYLES = ['params', 'inline']
+
+# how windows of variants are joined with a local interval index: 'sweep'
+# merges sorted variants with the sorted intervals in one pass per
+# chromosome (sweep_join.py), 'probe' searches the index per window
+OVERLAP_JOINS = ['sweep', 'probe']
+
+
+"""sql with the values pasted in: strings double-quoted and stripped of
+   quotes, numbers as they are
+"""
+def inlineQuery(sql, params):
+    values = []
+    for value in params:
+        if isinstance(value, str):
+            values.append('"' + clean_mysql_chars(value) + '"')
+        else:
+            values.append(str(value))
+    return sql % tuple(values)
 
-            linenum = linenum + 1
 
+"""Statement and values of batchSelect(); order=None leaves out the ORDER
+   BY (for tieredSelect(), which sorts the union)
+"""
+def batchQuery(table, columns, keys, on, where=None, wherevalues=(),
+    select='t.*', order=()):
+    selects = []
+    values = []
+    for i, key in enumerate(keys):
+        if (i == 0):
+            selects.append('select ' + ', '.join(['%s as ' + c for c in
+                ('i',) + tuple(columns)]))
         else:
-            fh_out.write(line + '\n')
+            selects.append('select ' + ', '.join(['%s'] *
+                (len(columns) + 1)))
+        values.append(i)
+        values.extend(key)
+
+    sql = 'select p.i, ' + select + ' from ' + table + ' t join (' + \
+        ' union all '.join(selects) + ') p on ' + on
+    if where is not None:
+        sql = sql + ' where ' + where
+        values.extend(wherevalues)
+    if order is not None:
+        sql = sql + ' order by ' + ', '.join(['p.i'] +
+            ['t.' + c for c in order])
+    return sql, values
+
+
+"""Runs one query for a batch of variants instead of one per variant
+   Each key is bound to a row of the derived table p (with the given
+   column names); 'on' joins p to the reference table t.
+   Returns the result rows of each key sorted by the columns of t in
+   order, i.e. in the order of the range scan of the per-record lookup,
+   whatever plan the server picks for the join.
+"""
+def batchSelect(cursor, table, columns, keys, on, where=None,
+    wherevalues=(), select='t.*', order=()):
+    sql, values = batchQuery(table, columns, keys, on, where=where,
+        wherevalues=wherevalues, select=select, order=order)
+    cursor.execute(sql, values)
+    rows = [[] for key in keys]
+    for row in cursor.fetchall():
+        rows[row[0]].append(row[1:])
+    return rows
+
+
+"""Rows of the first tier among rows of (tier, column, ...), without the
+   tier, in the order they came
+"""
+def firstTier(rows):
+    if (len(rows) == 0):
+        return []
+    tier = min([row[0] for row in rows])
+    return [row[1:] for row in rows if (row[0] == tier)]
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
+"""batchSelect() over several tables in order of precedence, as one
+   statement: tables is a list of (table, on), and each key gets the rows
+   of the first table that has any for it, sorted by the columns in order
+   (which all of the tables have)
+"""
+def tieredSelect(cursor, tables, columns, keys, where=None, wherevalues=(),
+    order=()):
+    sqls = []
+    values = []
+    for n, (table, on) in enumerate(tables):
+        sql, tablevalues = batchQuery(table, columns, keys, on, where=where,
+            wherevalues=wherevalues, select=str(n) + ' as tier, t.*',
+            order=None)
+        sqls.append(sql)
+        values.extend(tablevalues)
+
+    cursor.execute(' union all '.join(sqls) + ' order by ' +
+        ', '.join(['i', 'tier'] + list(order)), values)
+    rows = [[] for key in keys]
+    for row in cursor.fetchall():
+        rows[row[0]].append(row[1:])
+    return [firstTier(tiered) for tiered in rows]
+
+
+"""Base class for an annotation stage
+   A stage annotates one VCF record at a time, so the same code can run
+   over a whole file (runStage) or be chained in memory with the other
+   stages (see pipeline.py).
+   annotate() receives the tab-split record and returns the fields to
+   write, or None when the record goes out unchanged.
+   Reference rows are looked up by lookupKey(); prefetch() resolves the
+   keys of a whole window of records with queryBatch(), anything not
+   prefetched falls back to one queryRows() per record.
+"""
+class Stage(object):
+    logmode = 'a'
+    queryStyle = 'params'
+    overlapJoin = 'sweep'
+    # attributes written to the .count.log, see counts()
+    counters = ['var_count', 'line_count', 'cache_hits', 'cache_misses']
+    # bumped when a change to the stage changes its output
+    version = 1
+    # only appends to the INFO column, so its tokens can be recomputed on
+    # their own (see stage_versions.py)
+    spliceable = True
+
+    def __init__(self, format='vcf', table=None, sep='\t'):
+        self.format = format
+        self.table = table
+        self.sep = sep
+        self.inds = getFormatSpecificIndices(format=format)
+        self.cursor = None
+        # optional lookup_cache.LookupCache shared with other stages/jobs,
+        # and the versions of the reference tables its keys are valid for
+        # (see stage_versions.stageVersion)
+        self.cache = None
+        self.cacheVersion = None
+        self.prefetched = {}
+        self.var_count = 0
+        self.line_count = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def begin(self, cursor):
+        self.cursor = cursor
+        self.prefetched = {}
+        self.var_count = 0
+        self.line_count = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    """Lines passed through untouched: meta lines and the column header
+    """
+    def isHeader(self, line):
+        return line.startswith('##') or line.startswith('#CHROM') or \
+            line.startswith('CHROM')
+
+    """Query parameters of a record, or None if it is not looked up
+    """
+    def lookupKey(self, fields):
+        return None
+
+    def queryRows(self, key):
+        raise NotImplementedError
+
+    """Runs QUERIES[name] with params and returns all rows
+    """
+    def query(self, name, params, **names):
+        names.setdefault('table', self.table)
+        return self.execute(QUERIES[name].format(**names), params)
+
+    """Runs sql with params in the queryStyle of the stage, returns all rows
+    """
+    def execute(self, sql, params):
+        if (self.queryStyle == 'inline'):
+            self.cursor.execute(inlineQuery(sql, params))
+        else:
+            self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
+
+    """Returns {key: rows}; by default one query per key
+    """
+    def queryBatch(self, keys):
+        return dict([(key, self.queryRows(key)) for key in keys])
+
+    """Key of a lookup in the shared cache; stages whose query depends on
+       more than the table and the lookup key add that here
+    """
+    def cacheKey(self, key):
+        return (self.__class__.__name__, self.table, key)
+
+    """Rows cached under ckey, or None; counts hits and misses for the log
+       Entries are kept per cacheVersion, so a process that outlives a
+       reference table refresh does not serve the old rows
+    """
+    def cacheGet(self, ckey):
+        if self.cache is None:
+            return None
+        rows = self.cache.get((self.cacheVersion, ckey))
+        if rows is None:
+            self.cache_misses = self.cache_misses + 1
+        else:
+            self.cache_hits = self.cache_hits + 1
+        return rows
+
+    def cachePut(self, ckey, rows):
+        if self.cache is not None:
+            self.cache.put((self.cacheVersion, ckey), rows)
+
+    """Interval index attributes of the stage, with the table each reads
+    """
+    def indexTables(self):
+        return {}
+
+    """Position filter attributes of the stage, with the table each is
+       built from (see position_filter.py)
+    """
+    def filterTables(self):
+        return {}
+
+    """Reference tables the output of the stage depends on
+    """
+    def referenceTables(self):
+        tables = set(self.indexTables().values())
+        if self.table is not None:
+            tables.add(self.table)
+        return sorted(tables)
+
+    """True if every table of the stage is read from a local index or
+       snapshot, so it needs no database connection
+    """
+    def isLocal(self):
+        tables = self.indexTables()
+        return (len(tables) > 0) and all([getattr(self, attr) is not None
+            for attr in tables])
+
+    """What windows are joined with: index itself, or a sweep over it for
+       this run of the stage
+    """
+    def indexJoin(self, index):
+        if (index is None) or (self.overlapJoin != 'sweep'):
+            return index
+        return SweepJoin(index)
+
+    """Runs queryBatch(chrom, keys) once per chromosome, key[0] is the chrom
+    """
+    def batchByChrom(self, keys, queryBatch):
+        groups = {}
+        for key in keys:
+            groups.setdefault(key[0], []).append(key)
+
+        found = {}
+        for chrom, chrom_keys in groups.items():
+            found.update(zip(chrom_keys, queryBatch(chrom, chrom_keys)))
+        return found
+
+    """Distinct lookup keys of a window of records
+    """
+    def recordKeys(self, records):
+        keys = dict.fromkeys([self.lookupKey(fields) for fields in records])
+        keys.pop(None, None)
+        return list(keys)
+
+    """Fetches the rows of a window of records; keys found in the cache
+       are not queried again
+    """
+    def prefetch(self, records):
+        self.prefetched = {}
+        missing = []
+        for key in self.recordKeys(records):
+            rows = self.cacheGet(self.cacheKey(key))
+            if rows is None:
+                missing.append(key)
+            else:
+                self.prefetched[key] = rows
+
+        if (len(missing) > 0):
+            found = self.queryBatch(missing)
+            for key in missing:
+                self.cachePut(self.cacheKey(key), found[key])
+            self.prefetched.update(found)
+
+    def lookup(self, key):
+        rows = self.prefetched.get(key)
+        if rows is None:
+            ckey = self.cacheKey(key)
+            rows = self.cacheGet(ckey)
+            if rows is None:
+                rows = self.queryRows(key)
+                self.cachePut(ckey, rows)
+        return rows
+
+    def annotate(self, fields):
+        raise NotImplementedError
+
+    """Current values of the log counters
+    """
+    def counts(self):
+        return dict([(c, getattr(self, c)) for c in self.counters])
+
+    """Adds counters of another run of the stage, e.g. over one shard of
+       the file, so writeLog() reports the totals
+    """
+    def addCounts(self, counts):
+        for c, value in counts.items():
+            setattr(self, c, getattr(self, c) + value)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+    def writeCacheLog(self, fh_log):
+        fh_log.write(f"Lookup cache {self.__class__.__name__} " + \
+            f"({str(self.table)}): {str(self.cache_hits)} hits, " + \
+            f"{str(self.cache_misses)} misses\n")
+
+
+"""Runs a single stage over basefile + tmpextin, writing basefile + tmpextout
+   With batchsize > 0 the reference rows of each window of batchsize lines
+   are fetched together; 0 runs one query per record.
+"""
+def runStage(stage, basefile, tmpextin, tmpextout, batchsize=0):
+    writer = vcf.VcfWriter(open(basefile + tmpextout, "w"))
+    fh = bgzf.openText(basefile + tmpextin)
+    conn = None if stage.isLocal() else u.db_pool().acquire()
+    stage.begin(None if conn is None else conn.cursor())
+
+    for records in vcf.readWindows(fh, batchsize):
+        data = [record for record in records
+            if not stage.isHeader(record.line)]
+        if (batchsize > 0):
+            stage.prefetch([record.split(stage.sep) for record in data])
+
+        for record in data:
+            fields = stage.annotate(record.split(stage.sep))
+            if fields is not None:
+                record.update(fields)
+        for record in records:
+            writer.write(record)
+
+    writeStageLog(stage, basefile)
+
+    if conn is not None:
+        u.db_pool().release(conn)
     fh.close()
-    fh_out.close()
+    writer.close()
 
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+"""Writes the stage counters to <basefile>.count.log
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
+def writeStageLog(stage, basefile):
+    fh_log = open(basefile + '.count.log', stage.logmode)
+    stage.writeLog(fh_log)
+    if stage.cache is not None:
+        stage.writeCacheLog(fh_log)
+    fh_log.close()
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Appends tokens to the INFO column, skipping the ';' if already there
+"""
+def appendInfo(fields, text):
+    vcf.info(fields).add(text)
 
 
-"""Get information about location in gene structures
+"""Chromosome name as stored in most reference tables, e.g. chr1
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+def withChr(chr):
+    chr = chr.strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
 
-                    else:
-                        region = ''
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
+"""Chromosome name without the chr prefix, e.g. 1
+"""
+def withoutChr(chr):
+    chr = chr.strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
 
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+class DbSnpStage(Stage):
+    logmode = 'w'
+    # sets the ID column and may replace the INFO column
+    spliceable = False
+    counters = Stage.counters + ['linenum', 'filter_skips', 'filter_hits',
+        'filter_false']
+
+    """index: optional snapshot.Snapshot of the table
+       positions: optional position_filter.PositionFilter of the table;
+       without a snapshot, only variants at its positions are queried
+    """
+    def __init__(self, format='vcf', table='dbSNP', varclass='SNV',
+        sep='\t', index=None, positions=None):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.varclass = varclass
+        self.index = index
+        self.positions = positions
+        self.linenum = 1
+        self.resetFilterCounts()
+
+    def indexTables(self):
+        return {'index': self.table}
+
+    def filterTables(self):
+        return {'positions': self.table}
+
+    def begin(self, cursor):
+        Stage.begin(self, cursor)
+        self.linenum = 1
+        self.resetFilterCounts()
+
+    """Lookups the position filter skipped, let through, and let through
+       without a match
+    """
+    def resetFilterCounts(self):
+        self.filter_skips = 0
+        self.filter_hits = 0
+        self.filter_false = 0
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def lookupKey(self, fields):
+        inds = self.inds
+        ref = fields[inds[2]].strip()
+        return (withoutChr(fields[inds[0]]), fields[inds[1]].strip(), ref,
+            getComplementary(ref))
+
+    def cacheKey(self, key):
+        return (self.__class__.__name__, self.table, self.varclass, key)
+
+    def queryRows(self, key):
+        chr, pos, ref, compRef = key
+        if self.index is not None:
+            return self.localRows(chr, [key])[0]
+        if (len(self.filterKeys(chr, [key])) == 0):
+            return ()
+        rows = self.query('dbSNP', (chr, int(pos), ref, compRef,
+            self.varclass))
+        self.countFalse([rows])
+        return rows
+
+    """Keys on chr whose position is in the position filter; the others
+       cannot match
+    """
+    def filterKeys(self, chr, keys):
+        if self.positions is None:
+            return keys
+        hits = self.positions.containsMany(chr, [int(pos) for c, pos, ref,
+            compRef in keys])
+        found = [key for key, hit in zip(keys, hits.tolist()) if hit]
+        self.filter_skips = self.filter_skips + len(keys) - len(found)
+        self.filter_hits = self.filter_hits + len(found)
+        return found
+
+    def countFalse(self, found):
+        if self.positions is not None:
+            self.filter_false = self.filter_false + \
+                len([rows for rows in found if len(rows) == 0])
+
+    """Rows of keys on chr from the snapshot, as the query gives them
+    """
+    def localRows(self, chr, keys):
+        return self.index.matchMany(chr, [int(pos) for c, pos, ref, compRef
+            in keys], ('REF', 'INFO'), [set([(ref, self.varclass),
+            (compRef, self.varclass)]) for c, pos, ref, compRef in keys])
+
+    def queryBatch(self, keys):
+        if self.index is not None:
+            return self.batchByChrom(keys, self.localRows)
+        return self.batchByChrom(keys, self.selectRows)
+
+    """Rows of keys on chr from the database, one query for the keys that
+       pass the position filter
+    """
+    def selectRows(self, chr, keys):
+        hits = self.filterKeys(chr, keys)
+        if (len(hits) == 0):
+            return [[] for key in keys]
+        rows = batchSelect(
+            self.cursor, 'dbSNP', ('pos', 'ref', 'cref'),
+            [(int(pos), ref, compRef) for c, pos, ref, compRef in hits],
+            on='t.POS = p.pos AND (t.REF = p.ref OR t.REF = p.cref)',
+            where='t.CHR = %s AND t.INFO = %s',
+            wherevalues=(chr, self.varclass))
+        self.countFalse(rows)
+        found = dict(zip(hits, rows))
+        return [found.get(key, []) for key in keys]
+
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            info = vcf.info(fields)
+            if (info == '.'):
+                info.set('DB' + maf_str)
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                info.append('DB;VC=' + self.varclass + maf_str)
+
+            fields[2] = str(';'.join(rsids))
+
+        self.linenum = self.linenum + 1
+        return fields
+
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+        if (self.filter_skips + self.filter_hits > 0):
+            self.writeFilterLog(fh_log)
+
+    """False positive rate of the position filter (the share of lookups
+       without a match that it let through) and the memory it maps
+    """
+    def writeFilterLog(self, fh_log):
+        misses = self.filter_skips + self.filter_false
+        rate = (self.filter_false / float(misses)) * 100 if (misses > 0) \
+            else 0.0
+        lookups = self.filter_skips + self.filter_hits
+        fh_log.write(f"Position filter: {str(self.filter_skips)} of " + \
+            f"{str(lookups)} lookups skipped, {str(self.filter_false)} " + \
+            f"false positives ({rate:.2f}%)")
+        if self.positions is not None:
+            mb = self.positions.nbytes() / (1024 * 1024)
+            fh_log.write(f", {mb:.1f} MB mapped")
+        fh_log.write("\n")
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+    runStage(DbSnpStage(format=format, varclass=varclass, sep=sep),
+        vcf, '', tmpextout)
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+class BigRefGeneStage(Stage):
+    # tables in order of precedence: (table, snapshot attribute, how the
+    # table t joins a batch of keys p)
+    tiers = [
+        ('chrom_pos_equal_base', 'equalBase', 't.start = p.pos AND ' +
+            '((t.haplotypeReference = p.ref AND ' +
+            't.haplotypeAlternate = p.alt) OR ' +
+            '(t.haplotypeReference = p.cref AND ' +
+            't.haplotypeAlternate = p.calt))'),
+        ('chrom_pos_equal_nobase', 'equalNobase', 't.start = p.pos'),
+        ('chrom_pos_unequal', 'unequal',
+            't.start <= p.pos AND p.pos <= t.end'),
+    ]
+    # collapsed reference rows kept before the memo starts over
+    maxCollapsed = 100000
+    # drops the '.' the INFO column starts with
+    spliceable = False
+
+    """equalBase, equalNobase, unequal: optional snapshot.Snapshot of each
+       table; a table without one is queried
+    """
+    def __init__(self, format='vcf', table=None, sep='\t', equalBase=None,
+        equalNobase=None, unequal=None):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.equalBase = equalBase
+        self.equalNobase = equalNobase
+        self.unequal = unequal
+        # collapseRefSeq() of each reference row seen
+        self.collapsed = {}
+
+    def indexTables(self):
+        return dict([(attr, table) for table, attr, on in self.tiers])
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def lookupKey(self, fields):
+        inds = self.inds
+        ref = fields[inds[2]].strip()
+        alt = fields[inds[3]].strip()
+        return (withoutChr(fields[inds[0]]), fields[inds[1]].strip(), ref,
+            alt, getComplementary(ref), getComplementary(alt))
+
+    """Consecutive tiers answered the same way, as (snapshot, tiers);
+       the snapshot is None for tiers that are queried together
+    """
+    def tierGroups(self):
+        groups = []
+        for tier in self.tiers:
+            index = getattr(self, tier[1])
+            if (index is None) and (len(groups) > 0) and \
+                (groups[-1][0] is None):
+                groups[-1][1].append(tier)
+            else:
+                groups.append((index, [tier]))
+        return groups
+
+    """Rows of each of keys on chr from the first table that has any for
+       it. Tables with a snapshot are read from it, the others are queried
+       in one statement that ranks their rows by table: a batch query, or
+       the per-record one if batch is False.
+    """
+    def resolve(self, chr, keys, batch=True):
+        found = [[] for key in keys]
+        pending = list(range(len(keys)))
+        for index, tiers in self.tierGroups():
+            subset = [keys[i] for i in pending]
+            if index is not None:
+                rows = self.localRows(tiers[0][0], index, chr, subset)
+            elif batch:
+                rows = tieredSelect(self.cursor,
+                    [(table, on) for table, attr, on in tiers],
+                    ('pos', 'ref', 'alt', 'cref', 'calt'),
+                    [(int(k[1]),) + k[2:] for k in subset],
+                    where='t.CHR = %s', wherevalues=(chr,), order=('start',))
+            else:
+                rows = [self.tieredQuery([table for table, attr, on in tiers],
+                    subset[0])]
+
+            for i, r in zip(pending, rows):
+                found[i] = r
+            pending = [i for i, r in zip(pending, rows) if (len(r) == 0)]
+            if (len(pending) == 0):
+                break
+        return found
+
+    """Rows of the first of tables that has any for key, with one query
+    """
+    def tieredQuery(self, tables, key):
+        chr, pos, ref, alt, compRef, compAlt = key
+        pos = int(pos)
+        params = {
+            'chrom_pos_equal_base': (chr, pos, ref, alt, compRef, compAlt),
+            'chrom_pos_equal_nobase': (chr, pos),
+            'chrom_pos_unequal': (chr, pos, pos),
+        }
+        sql = ' union all '.join([QUERIES[table].replace('select * from ' +
+            table, 'select ' + str(n) + ' as tier, t.* from ' + table + ' t',
+            1) for n, table in enumerate(tables)]) + ' order by tier, start'
+        return firstTier(self.execute(sql, sum([params[table]
+            for table in tables], ())))
+
+    def queryRows(self, key):
+        return self.resolve(key[0], [key], batch=False)[0]
+
+    """Rows of keys on chr from the snapshot index of table
+    """
+    def localRows(self, table, index, chr, keys):
+        positions = [int(k[1]) for k in keys]
+        if (table == 'chrom_pos_equal_base'):
+            return index.matchMany(chr, positions,
+                ('haplotypeReference', 'haplotypeAlternate'),
+                [set([(k[2], k[3]), (k[4], k[5])]) for k in keys])
+        if (table == 'chrom_pos_equal_nobase'):
+            return index.matchMany(chr, positions)
+        return index.queryMany(chr, positions)
+
+    def queryBatch(self, keys):
+        return self.batchByChrom(keys, self.resolve)
+
+    """collapseRefSeq() of a reference row, worked out once per row
+    """
+    def collapse(self, row):
+        row = tuple(row)
+        text = self.collapsed.get(row)
+        if text is None:
+            if (len(self.collapsed) >= self.maxCollapsed):
+                self.collapsed = {}
+            text = collapseRefSeq('\t'.join([str(x) for x in
+                row[1:len(row)]]))
+            self.collapsed[row] = text
+        return text
+
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
+
+        # dict keeps the isoforms in query order, unlike a set
+        m = dict.fromkeys([self.collapse(row) for row in rows])
+
+        info = vcf.info(fields)
+        info.append(';'.join(m))
+        info.dropPrefix('.;')
+        return fields
+
+    def writeLog(self, fh_log):
+        pass
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    runStage(BigRefGeneStage(format=format, sep=sep), vcf, tmpextin,
+        tmpextout)
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+"""Variants located: counters shared by the refGene location stages
+"""
+class GeneLocationStage(Stage):
+    counters = Stage.counters + ['interGenic_count', 'cds_count',
+        'utr3_count', 'utr5_count', 'intronic_count',
+        'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count']
+
+    """index, cpgIndex: optional interval_index.IntervalIndex of the
+       transcript table and of cpgIslandExt
+       transcripts: transcripts.TranscriptModels shared with other stages
+       of the job, or preloaded from disk
+    """
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500,
+        sep='\t', index=None, cpgIndex=None, transcripts=None):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.promoter_offset = promoter_offset
+        self.index = index
+        self.cpgIndex = cpgIndex
+        self.join = None
+        self.cpgJoin = None
+        if transcripts is None:
+            transcripts = TranscriptModels()
+        self.transcripts = transcripts
+        self.cpgIslands = {}
+        self.resetCounts()
+
+    def indexTables(self):
+        return {'index': self.table, 'cpgIndex': 'cpgIslandExt'}
+
+    def begin(self, cursor):
+        Stage.begin(self, cursor)
+        self.cpgIslands = {}
+        self.join = self.indexJoin(self.index)
+        self.cpgJoin = self.indexJoin(self.cpgIndex)
+        self.resetCounts()
+
+    def resetCounts(self):
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def lookupKey(self, fields):
+        return (withChr(fields[self.inds[0]]), fields[self.inds[1]].strip())
+
+    def cacheKey(self, key):
+        return ('transcripts', self.table, int(self.promoter_offset), key)
+
+    def prefetch(self, records):
+        self.cpgIslands = {}
+        Stage.prefetch(self, records)
+
+    def queryRows(self, key):
+        chr, pos = key
+        if self.index is not None:
+            return self.index.query(chr, int(pos),
+                pad=int(self.promoter_offset))
+        offset = int(self.promoter_offset)
+        return self.query('transcripts', (chr, offset, int(pos), int(pos),
+            offset))
+
+    """Transcripts of the whole window, then the CpG islands of every
+       variant that fell near a transcript
+    """
+    def queryBatch(self, keys):
+        offset = str(int(self.promoter_offset))
+        if self.index is not None:
+            found = self.batchByChrom(keys, lambda chr, keys:
+                (self.join or self.index).queryMany(chr,
+                    [int(pos) for c, pos in keys],
+                    pad=int(self.promoter_offset)))
+        else:
+            found = self.batchByChrom(keys, lambda chr, keys: batchSelect(
+                self.cursor, self.table, ('pos',),
+                [(int(pos),) for c, pos in keys],
+                on='(t.txStart - ' + offset + ') <= p.pos AND ' +
+                    'p.pos <= (t.txEnd + ' + offset + ')',
+                where='t.chrom = %s', wherevalues=(chr,),
+                order=('txStart', 'txEnd')))
+
+        near = [key for key in keys if len(found[key]) > 0]
+        if self.cpgIndex is not None:
+            self.cpgIslands = self.batchByChrom(near, lambda chr, keys:
+                (self.cpgJoin or self.cpgIndex).queryMany(chr,
+                    [int(pos) for c, pos in keys]))
+        else:
+            self.cpgIslands = self.batchByChrom(near, lambda chr, keys:
+                batchSelect(
+                    self.cursor, 'cpgIslandExt', ('pos',),
+                    [(int(pos),) for c, pos in keys],
+                    on='t.chromStart <= p.pos AND p.pos <= t.chromEnd',
+                    where='t.chrom = %s', wherevalues=(chr,),
+                    select='t.chrom, t.chromStart, t.chromEnd, t.name',
+                    order=('chromStart', 'chromEnd')))
+        for key in near:
+            self.cachePut(('cpgIslandExt', key), self.cpgIslands[key])
+        return found
+
+    """Name of the CpG island a promoter-region variant falls in, or None
+    """
+    def getCpgIsland(self, key):
+        rows = self.cpgIslands.get(key)
+        if rows is None:
+            rows = self.cacheGet(('cpgIslandExt', key))
+        if (rows is None) and (self.cpgIndex is not None):
+            rows = self.cpgIndex.query(key[0], int(key[1]))
+            self.cachePut(('cpgIslandExt', key), rows)
+        if rows is None:
+            chr, pos = key
+            rows = self.query('cpgIslandExt', (chr, int(pos), int(pos)))
+            self.cachePut(('cpgIslandExt', key), rows)
+        rows = rows[0] if (len(rows) > 0) else None
+
+        if (rows is None):
+            return None
+        return "".join(str(rows[3]).split())
+
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
+
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
+
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
+
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
+
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
+
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
+
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
+
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
+
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+"""Get information about location in gene structures
+"""
+class GeneStage(GeneLocationStage):
+
+    def annotate(self, fields):
+        key = self.lookupKey(fields)
+        rows = self.lookup(key)
+        info = []
+
+        if (len(rows) > 0):
+            #count location, once per isoform
+            positionType = vcf.info(fields).get('positionType')
+
+            pos = int(key[1])
+            cnt = 1
+            for row in rows:
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = \
+                        self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = \
+                        self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(self.promoter_offset)
+                promoter_minus = txtEnd + int(self.promoter_offset)
+                region = ""
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in self.transcripts.exons(row, pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for e in self.transcripts.exons(row, pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum = exonCount - e
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif ((u.isBetween(pos, promoter_plus, txtStart) and 
+                    (strand == "+")) or 
+                    (u.isBetween(pos, txtEnd, promoter_minus) and 
+                    (strand == "-"))):
+                    island = self.getCpgIsland(key)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + island
+                        self.promoter_count = self.promoter_count + 1
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            vcf.info(fields).append(";".join(info))
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        else:
+            vcf.info(fields).append("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        return fields
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(GeneStage(format=format, table=table, 
+        promoter_offset=promoter_offset, sep=sep), vcf, tmpextin, tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
 
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonStage(GeneLocationStage):
+
+    def annotate(self, fields):
+        key = self.lookupKey(fields)
+        rows = self.lookup(key)
+        info = []
+        if (len(rows) > 0):
+            pos = int(key[1])
+            cnt = 1
+            for row in rows:
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(self.promoter_offset)
+                promoter_minus = txtEnd + int(self.promoter_offset)
+                region = ""
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in self.transcripts.exons(row, pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum =  exonCount - e
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.non_coding_exonic_count = \
+                            self.non_coding_exonic_count + 1
+                    if (len(exons) > 0):
+                        region='positionType=non_coding_exon;' + ";".join(exons)
                     else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+                        self.non_coding_intronic_count = \
+                            self.non_coding_intronic_count + 1
+                        region = 'positionType=non_coding_intron'
+
+                elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                    self.cds_count = self.cds_count + 1
+                    for e in self.transcripts.exons(row, pos):
+                        exnum = e + 1
+                        if (strand == '-'):
+                            exnum =  exonCount - e
+                        exons.append("exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = 'positionType=CDS;' + ";".join(exons)
+                    else:
+                        self.intronic_count = self.intronic_count + 1
+                        region = 'positionType=CDS;' + 'intron'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    self.utr5_count = self.utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    self.utr3_count = self.utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif ((u.isBetween(pos, promoter_plus, txtStart) and \
+                    (strand == "+")) or 
+                    (u.isBetween(pos, txtEnd, promoter_minus) and \
+                    (strand == "-"))):
+                    island = self.getCpgIsland(key)
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + island
+                        self.promoter_count = self.promoter_count + 1
+
+                if (region != ''):
+                    info.append(collapseGeneNames(
+                        row=row, indices=indicesKnownGenes, 
+                        region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            vcf.info(fields).append(";".join(info))
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+            vcf.info(fields).append("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        return fields
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(ExonStage(format=format, table=table, 
+        promoter_offset=promoter_offset, sep=sep), vcf, tmpextin, tmpextout)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+"""Overlap of the variant position with the intervals of a reference table
+"""
+class OverlapStage(Stage):
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+
+    """index: optional interval_index.IntervalIndex of the table; when set
+       the rows are read from it instead of the database
+    """
+    def __init__(self, format='vcf', table=None, sep='\t', index=None):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.index = index
+        self.join = None
+
+    def begin(self, cursor):
+        Stage.begin(self, cursor)
+        self.join = self.indexJoin(self.index)
+
+    def lookupKey(self, fields):
+        return (withChr(fields[self.inds[0]]), fields[self.inds[1]].strip())
+
+    def queryRows(self, key):
+        chr, pos = key
+        return self.query('overlap', (chr, int(pos), int(pos)),
+            chrom=self.chromName, start=self.startName, end=self.endName)
+
+    def queryBatch(self, keys):
+        return self.batchByChrom(keys, lambda chr, keys: batchSelect(
+            self.cursor, self.table, ('pos',),
+            [(int(pos),) for c, pos in keys],
+            on='t.' + self.startName + ' <= p.pos AND p.pos <= t.' +
+                self.endName,
+            where='t.' + self.chromName + ' = %s', wherevalues=(chr,),
+            order=(self.startName, self.endName)))
+
+    def indexTables(self):
+        return {'index': self.table}
+
+    """With an index the whole window is joined per chromosome at once,
+       by a sweep over the index if overlapJoin is 'sweep'
+    """
+    def prefetch(self, records):
+        if self.index is None:
+            Stage.prefetch(self, records)
+            return
+        self.prefetched = self.batchByChrom(self.recordKeys(records),
+            lambda chr, keys: (self.join or self.index).queryMany(chr,
+                [int(pos) for c, pos in keys]))
+
+    def lookup(self, key):
+        if self.index is None:
+            return Stage.lookup(self, key)
+        rows = self.prefetched.get(key)
+        if rows is None:
+            rows = self.index.query(key[0], int(key[1]))
+        return rows
+
+    """First overlapping row or None, as cursor.fetchone() would give
+    """
+    def lookupOne(self, key):
+        rows = self.lookup(key)
+        if (len(rows) == 0):
+            return None
+        return rows[0]
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesStage(OverlapStage):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
+    def __init__(self, format='vcf', table='tfbsConsSites', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
+
+    """Keyed by chromosome number; only listed chromosomes have a table
+    """
+    def lookupKey(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chrIndex = withChr(fields[self.inds[0]]).replace('chr', '')
+        if (chrIndex not in self.allowed_chrom):
+            return None
+        return (chrIndex, fields[self.inds[1]].strip())
+
+    def queryRows(self, key):
+        chrIndex, pos = key
+        return self.query('tfbsConsSites', (int(pos), int(pos)),
+            table='tfbsConsSites' + chrIndex)
+
+    def queryBatch(self, keys):
+        return self.batchByChrom(keys, lambda chrIndex, keys: batchSelect(
+            self.cursor, 'tfbsConsSites' + chrIndex, ('pos',),
+            [(int(pos),) for c, pos in keys],
+            on='t.chromStart <= p.pos AND p.pos <= t.chromEnd',
+            select='t.chrom, t.chromStart, t.chromEnd, t.name',
+            order=('chromStart', 'chromEnd')))
+
+    def annotate(self, fields):
+        key = self.lookupKey(fields)
+        if key is None:
+            # chrom is not on the list
+            return None
+
+        rows = self.lookup(key)
+        if (len(rows) == 0):
+            return None
+
+        records = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            t = t.strip()
+            records.append('tfbsRegion' + '=' + t)
+
+        appendInfo(fields, ';'.join(records))
+        return fields
+
+
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(TfbsConsSitesStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    chromName = 'chromosome'
+    # indents all other columns
+    spliceable = False
+
+    def __init__(self, format='vcf', table='gadAll', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
+
+    def lookupKey(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        return (withoutChr(fields[self.inds[0]]),
+            fields[self.inds[1]].strip())
+
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
+
+        records = []
+        self.line_count = self.line_count + 1
+        r_tmp = []
+        for row in rows:
+            self.var_count = self.var_count + 1
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
+
+        appendInfo(fields, ';'.join(records))
+        # Matched records have always been written '\t '-separated
+        vcf.info(fields).prepend(' ')
+        return fields[:1] + [' ' + f for f in fields[1:7]] + fields[7:8] + \
+            [' ' + f for f in fields[8:]]
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t'):
+    runStage(GadAllStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def __init__(self, format='vcf', table='gwasCatalog', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
 
+    def queryRows(self, key):
+        chr, pos = key
+        return self.query('gwasCatalog', (chr, int(pos)))
 
-"""Overlap with GadAll table
-"""
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    def queryBatch(self, keys):
+        return self.batchByChrom(keys, lambda chr, keys: batchSelect(
+            self.cursor, self.table, ('pos',),
+            [(int(pos),) for c, pos in keys], on='t.chromEnd = p.pos',
+            where='t.chrom = %s', wherevalues=(chr,),
+            order=('chromStart', 'chromEnd')))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        records = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        appendInfo(fields, ';'.join(records))
+        return fields
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    runStage(GwasCatalogStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+class HugoStage(OverlapStage):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def __init__(self, format='vcf', table='hugo', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
 
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        records = []
+        self.line_count = self.line_count + 1
+        r_tmp = []
+        for row in rows:
+            self.var_count = self.var_count + 1
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        appendInfo(fields, ','.join(records).replace(';', ','))
+        return fields
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(HugoStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+class GenomicSuperDupsStage(OverlapStage):
+
+    def __init__(self, format='vcf', table='genomicSuperDups', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
+
+    def annotate(self, fields):
+        rows = self.lookupOne(self.lookupKey(fields))
+        if rows is None:
+            return None
+
+        self.line_count = self.line_count + 1
+        self.var_count = self.var_count + 1
+        isOverlap = True
+        otherChrom = rows[7]
+        otherStart = rows[8]
+        otherEnd = rows[9]
+        vcf.info(fields).append(str(self.table) + '=' + \
+            str(isOverlap) + ';' + 'otherChrom=' + \
+            str(otherChrom) + ';otherStart=' + \
+            str(otherStart) + ';otherEnd=' + str(otherEnd))
+        return fields
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    runStage(GenomicSuperDupsStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneStage(OverlapStage):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1499,128 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+    def __init__(self, format='vcf', table='refGene', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        overlapsWith = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            overlapsWith.append(self.name2 + '=' + \
+                str(row[self.colindex2]) + ';' + self.name + '=' + \
+                str(row[self.colindex]))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        genes = ';'.join([str(x) for x in overlapsWith])
+        appendInfo(fields, str(genes))
+        return fields
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(RefGeneStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+class CytobandStage(OverlapStage):
+
+    def __init__(self, format='vcf', table='cytoBand', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def annotate(self, fields):
+        rows = self.lookup(self.lookupKey(fields))
+        if (len(rows) == 0):
+            return None
+
+        overlapsWith = []
+        self.line_count = self.line_count + 1
+        for row in rows:
+            self.var_count = self.var_count + 1
+            overlapsWith.append(str(row[self.colindex]))
+        overlapsWith = u.dedup(overlapsWith)
+        cytoband = ';'.join([str(x) for x in overlapsWith])
+
+        appendInfo(fields, str(self.table) + '=' + str(cytoband))
+        return fields
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+    runStage(CytobandStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Method to find overlap with CNV tables
+"""
+class CnvStage(OverlapStage):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def __init__(self, format='vcf', table='dgv_Cnv', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def annotate(self, fields):
+        rows = self.lookupOne(self.lookupKey(fields))
+        if rows is None:
+            return None
 
+        self.line_count = self.line_count + 1
+        self.var_count = self.var_count + 1
+        isOverlap = True
+        appendInfo(fields, str(self.table) + '=' + str(isOverlap))
+        return fields
 
-"""Method to find overlap with CNV tables
-"""
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+    runStage(CnvStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAStage(OverlapStage):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def __init__(self, format='vcf', table='targetScanS', sep='\t', index=None):
+        OverlapStage.__init__(self, format=format, table=table, sep=sep,
+            index=index)
 
+    def annotate(self, fields):
+        rows = self.lookupOne(self.lookupKey(fields))
+        if rows is None:
+            return None
 
-"""Method to find overlap with targetScanS tables
-"""
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+        self.line_count = self.line_count + 1
+        self.var_count = self.var_count + 1
+        t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+            str(rows[2]) + '_' + str(rows[3])
+        t = 'miRNAsites=' + t.strip()
+        appendInfo(fields, t)
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(MiRNAStage(format=format, table=table, sep=sep),
+        vcf, tmpextin, tmpextout)
 
-### EOF
\ No newline at end of file
+### EOF
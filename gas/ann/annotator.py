@@ -1,6 +1,7 @@
 import uuid
 import subprocess
 import os
+import time
 import re
 import json
 import boto3
@@ -9,6 +10,9 @@ from botocore.client import Config
 import requests
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
+import s3_stream
+import aws_async
+import asyncio
 
 # Get util configuration
 from configparser import SafeConfigParser
@@ -20,84 +24,265 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue
 sqs = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
 queue = sqs.Queue(url=config['aws']['QueueUrl'])
-s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+s3_stream.configure(config['transfer'])
+s3 = s3_stream.s3_client(config['aws']['AwsRegionName'],
+                         localdir=config['aws']['LocalS3Dir'])
+if config['aws']['LocalS3Dir']:
+    annotations = aws_async.LocalTable()
+else:
+    dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+    annotations = dynamo.Table(config['aws']['AWSDynamodbAnnotationsTable'])
+aws = aws_async.AsyncAws(s3, annotations, None)
 
 
-def s3_download_file(key, bucket, job_id, filename, username):
+async def s3_download_file(key, bucket, job_id, filename, username):
     path = os.path.join(os.path.dirname(__file__),  username)
     os.makedirs(path, exist_ok=True)
     # print(f"Path created: {path}")
     try:
         filepath: str = path + '/' + job_id + '~'+ filename
         # print(f'Filepath created {filepath}')
-        with open(filepath, 'wb') as data:
-            s3.download_file(bucket, key, data.name)
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_fileobj
+        await aws.download_file(bucket, key, filepath)
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_fileobj
     except Exception as e:
         # print("Failed to create local folder with job ID of: {} \n{}".format(job_id, str(e)))
         raise e
 
 
-# Poll the message queue in a loop
-while True:
-    # Attempt to read a message from teh Queue
-    # Use long polloing, here as 20 second wait times
-    # print(f"Polling SQS with {config['aws']['PollWaitTime']} seconds wait time")
-    response = queue.receive_messages(
-        WaitTimeSeconds=int(config['aws']['PollWaitTime']),
-    )
+"""Available memory in MB from /proc/meminfo, or None where there is none
+"""
+def available_memory_mb():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+"""True while the instance is too busy to start another job: the 1 minute
+   load per CPU or the available memory is past its configured limit
+"""
+def saturated():
+    load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    if load > float(config['ann']['MaxLoadPerCpu']):
+        return True
+    memory = available_memory_mb()
+    return memory is not None and memory < float(config['ann']['MinFreeMemoryMB'])
+
+
+"""Raised when a job request is no longer PENDING: another annotator took
+   it, or the request was redelivered
+"""
+class JobTaken(Exception):
+    pass
+
+
+"""Marks the job of a request RUNNING, then downloads its input (unless it
+   is streamed) and launches run.py for it; returns the child process (or
+   the worker_pool.WorkerJob, which is polled the same way). Raises
+   JobTaken if the job is not PENDING; if the download or the launch
+   fails, the job is put back to PENDING for the redelivered request.
+"""
+async def launch_job(message):
+    message_body = json.loads(message.body)
+    message_data = json.loads(message_body["Message"])
+    # print("Message Read!")
+    # print(f'{message_data}')
+
+    job_id = message_data["job_id"]
+    filename = message_data["input_file_name"]
+    bucket = message_data["s3_inputs_bucket"]
+    key = message_data["s3_key_input_file"]
+    username = key.split('/')[1]
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs-example-long-polling.html
+    # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/dynamodb.html#updating-item
+    # print("Uploading to dynamodb with new status")
+    # the job is claimed before anything is written locally, so a request
+    # taken elsewhere never overwrites the input of a running job
+    try:
+        await aws.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="SET job_status = :status",
+            ConditionExpression=Attr('job_status').eq("PENDING"),
+            ExpressionAttributeValues={
+                ':status': "RUNNING",
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise JobTaken(job_id)
+        raise e
+
+    # a streamed job reads its input from S3 itself; run.py gets the
+    # bucket and key after the (not downloaded) local path
+    args = [
+        'python',
+        '{}/run.py'.format(os.path.dirname(__file__)),
+        '{}/{}/{}~{}'.format(os.path.dirname(__file__), username, job_id, filename),
+    ]
+    try:
+        if config['ann'].getboolean('StreamS3'):
+            os.makedirs(os.path.join(os.path.dirname(__file__), username), exist_ok=True)
+            args = args + [str(bucket), str(key)]
+        else:
+            await s3_download_file(str(key), str(bucket), str(job_id), str(filename), str(username))
+            # print(f'Download path from s3: {username} with job_ID: {job_id}')
+
+        # Launch annotation job as a background process, or hand it to a
+        # warm worker (see worker_pool.py)
+        # print("launching annotator with Popen")
+        if workers is not None:
+            ann_process = workers.submit(args[2:])
+        else:
+            ann_process = subprocess.Popen(args)
+    except Exception as e:
+        # print("Failed to run subprocess run.py: {}".format(str(e)))
+        await aws.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="SET job_status = :status",
+            ConditionExpression=Attr('job_status').eq("RUNNING"),
+            ExpressionAttributeValues={
+                ':status': "PENDING",
+            }
+        )
+        raise e
 
-    # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-short-and-long-polling.html#sqs-long-polling
-    if response:
-        message_body = json.loads(response[0].body)
-        message_data = json.loads(message_body["Message"])
-        # print("Message Read!")
-        # print(f'{message_data}')
+    return ann_process
 
-        job_id = message_data["job_id"]
-        filename = message_data["input_file_name"]
-        bucket = message_data["s3_inputs_bucket"]
-        key = message_data["s3_key_input_file"]
-        username = key.split('/')[1]
 
-        s3_download_file(str(key), str(bucket), str(job_id), str(filename), str(username))
-        # print(f'Download path from s3: {username} with job_ID: {job_id}')
+"""Jobs of this instance, as {'process', 'message', 'extended'}; process
+   is None while the job is being launched (its input downloaded). A job's
+   message stays in flight (its visibility extended) until run.py exits,
+   so the request goes back to the queue if this instance dies mid-job.
+   Jobs are launched in tasks of their own and checked on a timer, so a
+   long download holds up neither the other jobs nor the queue.
+"""
+class Supervisor(object):
 
+    def __init__(self, max_jobs, visibility_timeout):
+        self.max_jobs = max_jobs
+        self.visibility_timeout = visibility_timeout
+        self.jobs = []
+        self.tasks = set()
+
+    def free_slots(self):
+        return self.max_jobs - len(self.jobs)
+
+    """Launches the job of message in a task of its own
+    """
+    def start(self, message):
+        job = {'process': None, 'message': message, 'extended': time.time()}
+        self.jobs.append(job)
+        task = asyncio.create_task(self.launch(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    """A request whose job is taken is deleted; one that failed to launch
+       is left to come back to the queue once its visibility runs out
+    """
+    async def launch(self, job):
         try:
-            # Launch annotation job as a background process
-            # print("launching annotator with Popen")
-            ann_process = subprocess.Popen([
-                'python',
-                '{}/run.py'.format(os.path.dirname(__file__)),
-                '{}/{}/{}~{}'.format(os.path.dirname(__file__), username, job_id, filename),
-            ],
-            )
+            job['process'] = await launch_job(job['message'])
+            return
+        except JobTaken as e:
+            print(f"Job {e} is not PENDING, request dropped")
+            self.drop(job)
+            try:
+                await aws.delete_message(job['message'])
+            except Exception as e:
+                print(f"Failed to delete message from sqs: {e}")
         except Exception as e:
-            # print("Failed to run subprocess run.py: {}".format(str(e)))
-            raise e
+            print(f"Failed to launch job: {e}")
+            self.drop(job)
+
+    def drop(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    """Deletes the messages of finished jobs and extends the visibility of
+       the others (including the ones still launching) once half of their
+       timeout has passed, all concurrently
+    """
+    async def reap(self):
+        running = []
+        calls = []
+        for job in self.jobs:
+            if (job['process'] is not None) and (job['process'].poll() is not None):
+                # print("Deleting Message now")
+                calls.append(aws.delete_message(job['message']))
+            else:
+                if time.time() - job['extended'] > self.visibility_timeout / 2:
+                    # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html
+                    calls.append(aws.change_visibility(job['message'],
+                                                       self.visibility_timeout))
+                    job['extended'] = time.time()
+                running.append(job)
+        self.jobs = running
+        for result in await asyncio.gather(*calls, return_exceptions=True):
+            if isinstance(result, Exception):
+                # the message of a finished job comes back and is dropped
+                # as not PENDING; one not extended may be redelivered
+                print(f"Failed to update message in sqs: {result}")
+
+    """Reaps every interval seconds, for as long as the annotator runs
+    """
+    async def supervise(self, interval):
+        while True:
+            await self.reap()
+            await asyncio.sleep(interval)
+
 
-        dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-        annotations = dynamo.Table(config['aws']['AWSDynamodbAnnotationsTable'])
+# pre-forked run.py workers, one per job slot (see __main__)
+workers = None
+
+"""Poll the message queue in a loop; each message is started in a task
+   of its own, while the supervisor reaps its jobs on a timer
+"""
+async def main():
+    supervisor = Supervisor(int(config['ann']['MaxConcurrentJobs']),
+                            int(config['aws']['VisibilityTimeout']))
+    interval = int(config['ann']['SupervisorInterval'])
+    reaper = asyncio.create_task(supervisor.supervise(interval))
+    while True:
+        # backpressure: no new messages while every slot is taken or the
+        # instance is saturated; they stay in the queue for other annotators
+        if supervisor.free_slots() <= 0 or saturated():
+            await asyncio.sleep(interval)
+            continue
+
+        # Attempt to read up to 10 messages (the SQS maximum) from the Queue
+        # Use long polloing, here as 20 second wait times
+        # print(f"Polling SQS with {config['aws']['PollWaitTime']} seconds wait time")
         try:
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs-example-long-polling.html
-            # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/dynamodb.html#updating-item
-            # print("Uploading to dynamodb with new status")
-            annotations.update_item(
-                Key={"job_id": job_id},
-                UpdateExpression="SET job_status = :status",
-                ConditionExpression=Attr('job_status').eq("PENDING"),
-                ExpressionAttributeValues={
-                    ':status': "RUNNING",
-                }
+            response = await aws.receive_messages(
+                queue,
+                MaxNumberOfMessages=min(supervisor.free_slots(), 10),
+                VisibilityTimeout=supervisor.visibility_timeout,
+                WaitTimeSeconds=int(config['aws']['PollWaitTime']),
             )
-        except dynamo.meta.client.exceptions.ConditionalCheckFailedException as e:
-            # print("Failed to connect and update dynamodb: {}".format(str(e)))
-            raise e
+        except ClientError as e:
+            print(f"Failed to receive messages from sqs: {e}")
+            await asyncio.sleep(interval)
+            continue
 
-        try:
-            # print("Deleting Message now")
-            response[0].delete()
-        except Exception as e:
-            # print("Failed to delete message from sqs: {}".format(str(e)))
-            raise e
+        # https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-short-and-long-polling.html#sqs-long-polling
+        for message in response:
+            supervisor.start(message)
+
+
+if __name__ == '__main__':
+    if config['ann'].getboolean('WarmWorkers'):
+        import worker_pool
+        workers = worker_pool.WorkerPool(int(config['ann']['MaxConcurrentJobs']))
+    try:
+        asyncio.run(main())
+    finally:
+        # let the warm workers finish their jobs and exit
+        if workers is not None:
+            workers.close()
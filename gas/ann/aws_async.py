@@ -0,0 +1,108 @@
+# aws_async.py
+#
+# Asyncio front end to the AWS calls of the annotator job lifecycle. The
+# boto3 clients block, so every call runs in a thread pool and the calls
+# that do not depend on each other (the result and log uploads, the two
+# SNS publishes, the input download and the RUNNING update) are awaited
+# together instead of one after the other.
+#
+# LocalTable and LocalSns stand in for DynamoDB and SNS, next to
+# s3_stream.LocalS3, when the annotator runs off AWS (LocalS3Dir).
+#
+##
+
+import re
+import uuid
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+import s3_stream
+
+# AWS calls in flight at once per process
+THREADS = 8
+
+
+"""Async calls on an S3 client, a DynamoDB table and an SNS client
+"""
+class AsyncAws(object):
+
+    def __init__(self, s3, table, sns, threads=THREADS):
+        self.s3 = s3
+        self.table = table
+        self.sns = sns
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+            functools.partial(fn, *args, **kwargs))
+
+    """Parallel multipart transfers with retries (see s3_stream.py)
+    """
+    def upload_file(self, filename, bucket, key):
+        return self.call(s3_stream.upload_file, self.s3, filename, bucket,
+            key)
+
+    def download_file(self, bucket, key, filename):
+        return self.call(s3_stream.download_file, self.s3, bucket, key,
+            filename)
+
+    def update_item(self, **kwargs):
+        return self.call(self.table.update_item, **kwargs)
+
+    def publish(self, **kwargs):
+        return self.call(self.sns.publish, **kwargs)
+
+    def receive_messages(self, queue, **kwargs):
+        return self.call(queue.receive_messages, **kwargs)
+
+    def delete_message(self, message):
+        return self.call(message.delete)
+
+    def change_visibility(self, message, timeout):
+        return self.call(message.change_visibility, VisibilityTimeout=timeout)
+
+
+"""DynamoDB table stand-in: items in memory, updated by the SET clauses
+   of update_item; a condition may test one attribute for equality, e.g.
+   Attr('job_status').eq('PENDING'), and fails like DynamoDB's
+"""
+class LocalTable(object):
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues,
+        ConditionExpression=None):
+        item = self.items.get(tuple(Key.items()), dict(Key))
+        if ConditionExpression is not None:
+            condition = ConditionExpression.get_expression()
+            if (condition['operator'] != '='):
+                raise NotImplementedError(condition['operator'])
+            attr, value = condition['values']
+            if (item.get(attr.name) != value):
+                raise ClientError({'Error': {
+                    'Code': 'ConditionalCheckFailedException',
+                    'Message': 'The conditional request failed'}},
+                    'UpdateItem')
+        for name, value in re.findall(r'(\w+)\s*=\s*(:\w+)',
+            UpdateExpression):
+            item[name] = ExpressionAttributeValues[value]
+        self.items[tuple(Key.items())] = item
+        return {}
+
+
+"""SNS client stand-in keeping the published messages
+"""
+class LocalSns(object):
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, **kwargs):
+        self.published.append(kwargs)
+        return {'MessageId': uuid.uuid4().hex}
+
+### EOF
@@ -0,0 +1,305 @@
+# bgzf.py
+#
+# Compressed VCF input and output for the annotation pipeline.
+#
+# bgzip files are a series of independent gzip blocks of at most 64 KB,
+# so they are read one block at a time and the blocks are inflated in a
+# pool of threads (zlib releases the GIL) while the records of earlier
+# blocks are being annotated. Plain gzip files are streamed through the
+# gzip module. Annotated output of a compressed input is written as
+# bgzip, optionally with a tabix (.tbi) index.
+#
+##
+
+import io
+import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# threads inflating the blocks of one bgzip input
+THREADS = 4
+
+# uncompressed bytes per block, as bgzip writes them
+BLOCK_SIZE = 0xff00
+
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+TABIX_WINDOW = 14
+
+"""True for a gzip file (bgzip included), from its magic bytes
+"""
+def isGzip(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
+
+
+"""Size of the BGZF block whose header starts data, or None if the gzip
+   member has no BC extra field
+"""
+def blockSize(header):
+    if (len(header) < 18) or (header[:2] != b'\x1f\x8b') or \
+        not (header[3] & 4):
+        return None
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    i = 0
+    while (i + 4 <= len(extra)):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if (extra[i:i + 2] == b'BC') and (slen == 2):
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i = i + 4 + slen
+    return None
+
+
+def isBgzf(path):
+    with open(path, 'rb') as fh:
+        return blockSize(fh.read(18)) is not None
+
+
+"""Raw deflate data of a whole BGZF block -> uncompressed bytes
+"""
+def inflate(block):
+    xlen = struct.unpack('<H', block[10:12])[0]
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    crc, size = struct.unpack('<II', block[-8:])
+    if (len(data) != size) or (zlib.crc32(data) != crc):
+        raise IOError("Corrupt BGZF block")
+    return data
+
+
+"""Compressed blocks of a BGZF file, as (file offset, block)
+"""
+def readBlocks(fh):
+    offset = 0
+    while True:
+        header = fh.read(18)
+        if (len(header) == 0):
+            return
+        size = blockSize(header)
+        if size is None:
+            raise IOError("Not a BGZF block at offset " + str(offset))
+        block = header + fh.read(size - 18)
+        yield offset, block
+        offset = offset + size
+
+
+"""Uncompressed stream of a BGZF file (a path or a binary stream); up to
+   threads * 4 blocks are being inflated ahead of the reader
+"""
+class BgzfReader(io.RawIOBase):
+
+    def __init__(self, source, threads=None):
+        self.fh = open(source, 'rb') if isinstance(source, str) else source
+        self.blocks = readBlocks(self.fh)
+        self.executor = ThreadPoolExecutor(max_workers=threads or THREADS)
+        self.ahead = (threads or THREADS) * 4
+        self.pending = deque()
+        self.data = b''
+        self.pos = 0
+        self.fill()
+
+    def fill(self):
+        while (len(self.pending) < self.ahead):
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            self.pending.append(self.executor.submit(inflate, block[1]))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (self.pos >= len(self.data)):
+            if (len(self.pending) == 0):
+                return 0
+            self.data = self.pending.popleft().result()
+            self.pos = 0
+            self.fill()
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos = self.pos + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.fh.close()
+        io.RawIOBase.close(self)
+
+
+"""Writes the data given to it as BGZF blocks, then the EOF block, to a
+   path or a binary stream
+"""
+class BgzfWriter(io.RawIOBase):
+
+    def __init__(self, target, level=6):
+        self.fh = open(target, 'wb') if isinstance(target, str) else target
+        self.level = level
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.writeBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(b)
+
+    def writeBlock(self, data):
+        deflate = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = deflate.compress(data) + deflate.flush()
+        self.fh.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255,
+            6, 66, 67, 2, len(cdata) + 25))
+        self.fh.write(cdata)
+        self.fh.write(struct.pack('<II', zlib.crc32(data), len(data)))
+
+    def close(self):
+        if not self.closed:
+            if (len(self.buffer) > 0):
+                self.writeBlock(bytes(self.buffer))
+            self.fh.write(EOF_BLOCK)
+            self.fh.close()
+        io.RawIOBase.close(self)
+
+
+"""Opens a VCF for reading as text, whether plain, gzip or bgzip
+"""
+def openText(path, threads=None):
+    if not isGzip(path):
+        return open(path)
+    if isBgzf(path):
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(path, threads)))
+    return gzip.open(path, 'rt')
+
+
+"""Opens path for writing as text; bgzip if it ends in .gz
+"""
+def openOutput(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(path)))
+    return open(path, 'w')
+
+
+"""openText() for a binary stream (e.g. s3_stream.S3Reader)
+"""
+def openTextStream(raw, threads=None):
+    fh = io.BufferedReader(raw)
+    head = fh.peek(18)[:18]
+    if (head[:2] != b'\x1f\x8b'):
+        return io.TextIOWrapper(fh)
+    if blockSize(head) is not None:
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(fh, threads)))
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=fh))
+
+
+"""openOutput() for a binary stream (e.g. s3_stream.S3Writer)
+"""
+def openOutputStream(raw, compress=False):
+    if compress:
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(raw)))
+    return io.TextIOWrapper(io.BufferedWriter(raw))
+
+
+"""Tabix bin of the 0-based interval [beg, end)
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    for shift, first in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if ((beg >> shift) == (end >> shift)):
+            return first + (beg >> shift)
+    return 0
+
+
+"""Lines of a BGZF file with the virtual offsets of their start and end
+"""
+def readLines(path):
+    with open(path, 'rb') as fh:
+        line = b''
+        start = None
+        for offset, block in readBlocks(fh):
+            data = inflate(block)
+            nextBlock = (offset + len(block)) << 16
+            i = 0
+            while (i < len(data)):
+                if start is None:
+                    start = (offset << 16) | i
+                j = data.find(b'\n', i)
+                if (j < 0):
+                    line = line + data[i:]
+                    break
+                end = (offset << 16) | (j + 1) if (j + 1 < len(data)) \
+                    else nextBlock
+                yield line + data[i:j], start, end
+                line = b''
+                start = None
+                i = j + 1
+
+
+"""Writes path + '.tbi' for a bgzip VCF; the records must be sorted by
+   position within each chromosome and each chromosome must be contiguous
+"""
+def writeTabix(path):
+    names = []
+    # per chromosome: {bin: [[start, end], ...]}, linear index
+    refs = {}
+    last = None
+    for line, start, end in readLines(path):
+        if line.startswith(b'#') or (len(line) == 0):
+            continue
+        fields = line.split(b'\t', 4)
+        chrom = fields[0].decode('utf-8')
+        beg = int(fields[1]) - 1
+        stop = beg + max(len(fields[3]) if (len(fields) > 3) else 1, 1)
+
+        if (chrom != last):
+            if chrom in refs:
+                raise ValueError(f"{path} is not sorted: {chrom} is split")
+            names.append(chrom)
+            refs[chrom] = ({}, [])
+            last = chrom
+            lastBeg = -1
+        if (beg < lastBeg):
+            raise ValueError(f"{path} is not sorted at {chrom}:{beg + 1}")
+        lastBeg = beg
+
+        bins, linear = refs[chrom]
+        chunks = bins.setdefault(reg2bin(beg, stop), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == start):
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        for w in range(beg >> TABIX_WINDOW, ((stop - 1) >> TABIX_WINDOW) + 1):
+            while (len(linear) <= w):
+                linear.append(None)
+            if linear[w] is None:
+                linear[w] = start
+
+    out = io.BufferedWriter(BgzfWriter(path + '.tbi'))
+    nm = b''.join([n.encode('utf-8') + b'\0' for n in names])
+    # VCF preset: format 2, sequence/begin/end columns 1/2/0, meta '#'
+    out.write(b'TBI\1' + struct.pack('<8i', len(names), 2, 1, 2, 0,
+        ord('#'), 0, len(nm)) + nm)
+    for chrom in names:
+        bins, linear = refs[chrom]
+        out.write(struct.pack('<i', len(bins)))
+        for bin in sorted(bins):
+            out.write(struct.pack('<Ii', bin, len(bins[bin])))
+            for chunk in bins[bin]:
+                out.write(struct.pack('<QQ', chunk[0], chunk[1]))
+
+        # windows without a record point at the previous record
+        previous = 0
+        for w in range(len(linear)):
+            if linear[w] is None:
+                linear[w] = previous
+            previous = linear[w]
+        out.write(struct.pack('<i', len(linear)))
+        out.write(struct.pack('<%dQ' % len(linear), *linear))
+    out.close()
+
+### EOF
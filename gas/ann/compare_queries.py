@@ -0,0 +1,55 @@
+# compare_queries.py
+#
+# Annotates the same VCF with each query style (see annotate.QUERY_STYLES)
+# and reports the runtime of each and whether the annotated files and
+# count logs are identical.
+#
+# Usage: python compare_queries.py <vcf file> [batch size]
+##
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import tempfile
+import driver
+import annotate as ann
+
+
+"""Annotates a copy of vcf in its own directory, returns the copy's path
+   and the runtime in seconds
+"""
+def annotateCopy(vcf, querystyle, batchsize=0):
+    workdir = tempfile.mkdtemp(prefix='ann-' + querystyle + '-')
+    infile = os.path.join(workdir, os.path.basename(vcf))
+    shutil.copy(vcf, infile)
+
+    start = time.time()
+    driver.run(infile, 'vcf', batchsize=batchsize, querystyle=querystyle)
+    return infile, time.time() - start
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python compare_queries.py <vcf file> [batch size]")
+        sys.exit(1)
+
+    batchsize = int(sys.argv[2]) if (len(sys.argv) > 2) else 0
+    runs = [(style, annotateCopy(sys.argv[1], style, batchsize))
+        for style in ann.QUERY_STYLES]
+
+    base, (baseFile, baseSecs) = runs[0]
+    for style, (infile, secs) in runs:
+        print(f"{style}: {secs:.2f} seconds")
+    for style, (infile, secs) in runs[1:]:
+        same = filecmp.cmp(driver.getOutputFile(baseFile),
+            driver.getOutputFile(infile), shallow=False) and \
+            filecmp.cmp(baseFile + '.count.log', infile + '.count.log',
+            shallow=False)
+        print(f"{style} vs {base}: " + ("identical" if same else "DIFFERENT"))
+
+    for style, (infile, secs) in runs:
+        shutil.rmtree(os.path.dirname(infile))
+
+### EOF
@@ -12,110 +12,345 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
 import file_utils as fu
 import annotate as ann
+import pipeline
+import bgzf
+import lookup_cache
+import vcf_sort
+import stage_versions
+from transcripts import TranscriptModels
 
-def run(infile, format):
+_shared = {}
 
-    print("Running . . .")
+"""Read-only reference data (interval indexes, exon models) loaded once per
+   process by load(key), so a warm worker reuses it for all of its jobs
+"""
+def loadShared(key, load):
+    if key not in _shared:
+        _shared[key] = load(key)
+    return _shared[key]
+
+
+"""Annotation stages in the order they are applied, with their labels
+   Stages read from a local snapshot (see snapshot.py) or interval index
+   if indexdir has one for their table; stages on the same table share it,
+   and stages that read no table from the database need no connection.
+   dbSNP lookups are prefiltered by indexdir/dbSNP.positions (see
+   position_filter.py) if it exists. Exon models are preloaded
+   from indexdir/transcripts.pickle (see transcripts.py) if it exists.
+   querystyle is one of annotate.QUERY_STYLES, overlapjoin one of
+   annotate.OVERLAP_JOINS
+   Lookups go through the process-wide lookup_cache, if it is enabled,
+   keyed by the stage's reference table versions (versions, see
+   stage_versions.py) so none survive a table refresh. Without versions a
+   refresh cannot be told apart, so the stages get a cache of their own
+   that lasts for this job only.
+"""
+def getStages(format='vcf', indexdir=None, querystyle='params',
+    overlapjoin='sweep', versions=None):
+    if querystyle not in ann.QUERY_STYLES:
+        raise ValueError(f"Unknown query style: {querystyle}")
+    if overlapjoin not in ann.OVERLAP_JOINS:
+        raise ValueError(f"Unknown overlap join: {overlapjoin}")
+
+    transcripts = None
+    if indexdir and os.path.exists(os.path.join(indexdir,
+        'transcripts.pickle')):
+        transcripts = loadShared(os.path.join(indexdir, 'transcripts.pickle'),
+            TranscriptModels.load)
+
+    stages = [
+        ("dbSNP", ann.DbSnpStage(format=format)),
+        ("BigRefGene", ann.BigRefGeneStage(format=format)),
+        ("BigRefGene", ann.GeneStage(format=format, table='refGene',
+            promoter_offset=500, transcripts=transcripts)),
+        ("Cytoband", ann.CytobandStage(format=format, table='cytoBand')),
+        ("gadAll", ann.GadAllStage(format=format, table='gadAll')),
+        ("GwasCatalog", ann.GwasCatalogStage(format=format,
+            table='gwasCatalog')),
+        ("miRNA", ann.MiRNAStage(format=format, table='targetScanS')),
+        ("HUGO Gene Nomenclature Committee", ann.HugoStage(format=format,
+            table='hugo')),
+        ("dgv_Cnv", ann.CnvStage(format=format, table='dgv_Cnv')),
+        ("abParts_IG_T_CelReceptors", ann.CnvStage(format=format,
+            table='abParts_IG_T_CelReceptors')),
+        ("mcCarroll_Cnv", ann.CnvStage(format=format, table='mcCarroll_Cnv')),
+        ("conrad_Cnv", ann.CnvStage(format=format, table='conrad_Cnv')),
+        ("genomicSuperDups", ann.GenomicSuperDupsStage(format=format,
+            table='genomicSuperDups')),
+        ("addOverlapWithTfbsConsSites", ann.TfbsConsSitesStage(
+            format=format, table='tfbsConsSites')),
+    ]
+
+    if indexdir:
+        import interval_index
+        import snapshot
+        import position_filter
+        for label, stage in stages:
+            for attr, table in stage.indexTables().items():
+                # both are only used once complete (schema.json, index.json
+                # written last); a snapshot still being built is neither
+                if snapshot.exists(indexdir, table):
+                    load = lambda key: snapshot.Snapshot(*key)
+                elif interval_index.exists(indexdir, table) and \
+                    (table in interval_index.TABLES):
+                    load = lambda key: interval_index.IntervalIndex(*key)
+                else:
+                    continue
+                setattr(stage, attr, loadShared((indexdir, table), load))
+            for attr, table in stage.filterTables().items():
+                if not position_filter.exists(indexdir, table):
+                    continue
+                setattr(stage, attr, loadShared((indexdir, table,
+                    'positions'), lambda key:
+                    position_filter.PositionFilter(*key[:2])))
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    cache = lookup_cache.shared()
+    if (cache is not None) and (versions is None):
+        cache = lookup_cache.LookupCache(cache.maxbytes)
+    for label, stage in stages:
+        stage.queryStyle = querystyle
+        stage.overlapJoin = overlapjoin
+        stage.cache = cache
+        if versions is not None:
+            stage.cacheVersion = stage_versions.stageVersion(stage, versions)
+    return stages
+
+
+"""Name of the final annotated file for infile; compressed inputs give
+   bgzip output
+"""
+def getOutputFile(infile):
+    if infile.endswith('.gz'):
+        return getOutputFile(infile[:-3]) + '.gz'
+    return (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+
+
+"""Original pipeline: each stage reads infile.N and writes infile.N+1
+"""
+def run_staged(infile, format, batchsize=0, indexdir=None,
+    querystyle='params', overlapjoin='sweep', versions=None):
+    tmpextin = 0
+    for label, stage in getStages(format, indexdir, querystyle,
+        overlapjoin, versions):
+        tmpextout = tmpextin + 1
+        ann.runStage(stage, infile,
+            '' if (tmpextin == 0) else '.' + str(tmpextin),
+            '.' + str(tmpextout), batchsize=batchsize)
+        print(f"{label} - done.")
+        tmpextin = tmpextout
 
     ## Cleanup
     for i in range(1, tmpextin):
         fu.delete(infile + '.' + str(i))
 
     os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if infile.endswith('.gz'):
+        fh = open(infile + '.annot')
+        fh_out = bgzf.openOutput(getOutputFile(infile))
+        shutil.copyfileobj(fh, fh_out)
+        fh.close()
+        fh_out.close()
+        fu.delete(infile + '.annot')
+    else:
+        os.rename(infile + '.annot', getOutputFile(infile))
+
+
+"""Single pass: all stages are applied to a record before it is written
+"""
+def run_fused(infile, format, batchsize=0, indexdir=None,
+    querystyle='params', overlapjoin='sweep', versions=None):
+    stages = getStages(format, indexdir, querystyle, overlapjoin, versions)
+    pipeline.run(infile, getOutputFile(infile),
+        [stage for label, stage in stages], batchsize=batchsize,
+        versions=versions)
+    for label, stage in stages:
+        print(f"{label} - done.")
+
+
+"""Splits infile into shard files of up to shardsize lines and yields
+   their names. A shard also ends where the chromosome changes once it
+   holds a quarter of shardsize, so sorted input is split by chromosome
+   without unsorted input turning into tiny shards.
+"""
+def writeShards(infile, shardsize):
+    fh = bgzf.openText(infile)
+    fh_out = None
+    n = 0
+    count = 0
+    chrom = None
+    for line in fh:
+        if not line.startswith('#'):
+            c = line.split('\t', 1)[0]
+            if (fh_out is not None) and ((count >= shardsize) or
+                ((c != chrom) and (count >= shardsize // 4))):
+                fh_out.close()
+                yield shard
+                fh_out = None
+            chrom = c
+
+        if fh_out is None:
+            shard = infile + '.shard.' + str(n)
+            fh_out = open(shard, 'w')
+            n = n + 1
+            count = 0
+        fh_out.write(line)
+        count = count + 1
+
+    fh.close()
+    if fh_out is not None:
+        fh_out.close()
+        yield shard
+
+
+"""Worker of run_parallel: annotates one shard, returns the stage counters
+"""
+def annotateShard(shard, format, batchsize, indexdir, querystyle,
+    overlapjoin, versions):
+    stages = [stage for label, stage in getStages(format, indexdir,
+        querystyle, overlapjoin, versions)]
+    return pipeline.runShard(shard, shard + '.annot', stages,
+        batchsize=batchsize, versions=versions)
+
+
+"""Fused pipeline over shards of the file in a pool of worker processes
+   Shard outputs are concatenated in input order and the stage counters of
+   all shards are summed into one log, so the result is the same as
+   run_fused. So are their stage sidecars.
+"""
+def run_parallel(infile, format, batchsize=0, indexdir=None, workers=2,
+    shardsize=100000, querystyle='params', overlapjoin='sweep',
+    versions=None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    # only used to add up the counters and write the log
+    stages = getStages(format)
+
+    fh_out = bgzf.openOutput(getOutputFile(infile))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shards = [(shard, executor.submit(annotateShard, shard, format,
+            batchsize, indexdir, querystyle, overlapjoin, versions))
+            for shard in writeShards(infile, shardsize)]
+
+        for shard, future in shards:
+            for (label, stage), counts in zip(stages, future.result()):
+                stage.addCounts(counts)
+            with open(shard + '.annot') as fh:
+                shutil.copyfileobj(fh, fh_out)
+            fu.delete(shard)
+            fu.delete(shard + '.annot')
+    fh_out.close()
+
+    for label, stage in stages:
+        ann.writeStageLog(stage, infile)
+        print(f"{label} - done.")
+
+    if versions is not None:
+        parts = [shard + '.annot.stages' for shard, future in shards]
+        stage_versions.mergeSidecars(infile + '.stages', parts,
+            [stage for label, stage in stages], versions)
+        for part in parts:
+            fu.delete(part)
+
+
+"""Fused pipeline from an S3 object straight into another, without local
+   copies: the input is read in ranged GETs while the output goes up as a
+   multipart upload. logbase is the local path of the job; the counters
+   are written to logbase + '.count.log'. compress writes bgzip output.
+"""
+def run_s3(s3, bucket, key, outbucket, outkey, logbase, format,
+    batchsize=0, indexdir=None, querystyle='params', overlapjoin='sweep',
+    compress=False, versions=None):
+    import s3_stream
+
+    print("Running . . .")
+
+    stages = getStages(format, indexdir, querystyle, overlapjoin, versions)
+    fh = bgzf.openTextStream(s3_stream.S3Reader(s3, bucket, key))
+    fh_out = bgzf.openOutputStream(s3_stream.S3Writer(s3, outbucket, outkey),
+        compress=compress)
+    pipeline.runStream(fh, fh_out, logbase,
+        [stage for label, stage in stages], batchsize=batchsize,
+        versions=versions)
+    for label, stage in stages:
+        print(f"{label} - done.")
+
+
+"""mode is 'fused' (default) or 'staged'; both produce the same output
+   batchsize is the number of lines whose reference rows are fetched
+   together, 0 queries the database once per record and table
+   indexdir holds local snapshots built with snapshot.py or interval
+   indexes built with interval_index.py
+   workers > 1 runs the fused pipeline over shards of shardsize lines in
+   that many processes
+   querystyle 'params' binds the values of per-record lookups, 'inline'
+   pastes them into the SQL as the stages used to
+   overlapjoin 'sweep' merges sorted input with the interval indexes in
+   one pass per chromosome, 'probe' searches them per window
+   infile may be a .vcf.gz (gzip or bgzip); the output is then bgzip, with
+   a tabix index if tabix is set and the records are sorted
+   sort sorts an unsorted infile in place first (see vcf_sort.py), holding
+   at most sortbytes of records in memory
+   versions ({table: version}, see stage_versions.py) has the fused
+   pipeline record the stage versions in the header and a sidecar
+   infile + '.stages', so the result can be re-annotated stage by stage;
+   cached lookups are only reused for the same versions
+"""
+def run(infile, format, mode='fused', batchsize=0, indexdir=None, workers=1,
+    shardsize=100000, querystyle='params', overlapjoin='sweep', tabix=False,
+    sort=False, sortbytes=None, versions=None):
+
+    print("Running . . .")
+
+    if sort and vcf_sort.sortFile(infile, sortbytes):
+        print("Input sorted by chromosome and position.")
+
+    if (mode == 'staged'):
+        run_staged(infile, format, batchsize=batchsize, indexdir=indexdir,
+            querystyle=querystyle, overlapjoin=overlapjoin, versions=versions)
+    elif (mode == 'fused') and (workers > 1):
+        run_parallel(infile, format, batchsize=batchsize, indexdir=indexdir,
+            workers=workers, shardsize=shardsize, querystyle=querystyle,
+            overlapjoin=overlapjoin, versions=versions)
+    elif (mode == 'fused'):
+        run_fused(infile, format, batchsize=batchsize, indexdir=indexdir,
+            querystyle=querystyle, overlapjoin=overlapjoin, versions=versions)
+    else:
+        raise ValueError(f"Unknown annotation pipeline mode: {mode}")
+
+    if tabix and getOutputFile(infile).endswith('.gz'):
+        try:
+            bgzf.writeTabix(getOutputFile(infile))
+        except ValueError as e:
+            print(f"No tabix index written: {e}")
+
+
+"""Recomputes the stages of annotated file annotfile whose code or
+   reference table versions changed since it was annotated (see
+   stage_versions.py); logbase + '.stages' is its sidecar and
+   logbase + '.count.log' its log. Returns stage_versions.CURRENT,
+   UPDATED, or RERUN if the file needs a full run instead.
+"""
+def reannotate(annotfile, logbase, format, versions, batchsize=0,
+    indexdir=None, querystyle='params', overlapjoin='sweep'):
+    stages = getStages(format, indexdir, querystyle, overlapjoin, versions)
+    status, stale, changed = stage_versions.reannotateFile(annotfile,
+        logbase, [stage for label, stage in stages], versions,
+        batchsize=batchsize)
+
+    for k in stale:
+        label = stages[k][0]
+        if (status == stage_versions.UPDATED):
+            print(f"{label} - recomputed" +
+                (" (output changed)." if k in changed else "."))
+        else:
+            print(f"{label} - out of date.")
+
+    if (status == stage_versions.UPDATED) and \
+        os.path.exists(annotfile + '.tbi'):
+        bgzf.writeTabix(annotfile)
+    return status
 
-### EOF
\ No newline at end of file
+### EOF
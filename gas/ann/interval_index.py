@@ -0,0 +1,300 @@
+# interval_index.py
+#
+# Local, memory-mapped interval index for the overlap reference tables,
+# so overlap stages can be answered without the annotator database.
+#
+# Each table is exported once (see the __main__ block below) into its own
+# directory with, for every chromosome:
+#   <chrom>.start.npy, <chrom>.end.npy  interval coordinates sorted by start
+#   <chrom>.maxend.npy                   running maximum of end
+#   <chrom>.rank.npy                     row number of each interval
+#   <chrom>.offset.npy, <chrom>.rows     the rows (one JSON list each), in
+#                                        table order
+# and an index.json listing the chromosomes, written last: an index is
+# only used once it is complete, like a snapshot with its schema.json.
+#
+# Intervals with start <= pos are a prefix of the sorted arrays; maxend
+# never decreases, so the ones that can still reach pos begin at the first
+# maxend >= pos. A point query is two binary searches plus a short scan,
+# and joinPoints() does the same for a whole array of positions at once.
+#
+# Usage: python interval_index.py <index dir> [table ...]
+##
+
+import os
+import sys
+import json
+import mmap
+from array import array
+
+import numpy as np
+
+"""Tables the overlap stages read, as
+   name: (source tables, chrom column, start column, end column, columns)
+   Source tables map the chromosome key used by the stage to a table name;
+   None means one table partitioned on its chrom column.
+"""
+TABLES = {
+    'cytoBand': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'gadAll': (None, 'chromosome', 'chromStart', 'chromEnd', '*'),
+    'gwasCatalog': (None, 'chrom', 'chromEnd', 'chromEnd', '*'),
+    'targetScanS': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'hugo': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'dgv_Cnv': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'abParts_IG_T_CelReceptors': (None, 'chrom', 'chromStart', 'chromEnd',
+        '*'),
+    'mcCarroll_Cnv': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'conrad_Cnv': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'genomicSuperDups': (None, 'chrom', 'chromStart', 'chromEnd', '*'),
+    'refGene': (None, 'chrom', 'txStart', 'txEnd', '*'),
+    'cpgIslandExt': (None, 'chrom', 'chromStart', 'chromEnd',
+        'chrom, chromStart, chromEnd, name'),
+    'tfbsConsSites': (dict([(c, 'tfbsConsSites' + c) for c in
+        [str(i) for i in range(1, 23)] + ['X', 'Y']]),
+        'chrom', 'chromStart', 'chromEnd', 'chrom, chromStart, chromEnd, name'),
+}
+
+COLUMNS = ['start', 'end', 'maxend', 'rank', 'offset']
+# chromosomes of a complete index
+MANIFEST = 'index.json'
+
+
+"""Column values as JSON; bytes (e.g. refGene exonStarts) are kept as bytes
+   and anything JSON has no type for is stored as its str()
+"""
+def encodeValue(value):
+    if (value is None) or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return {'b': bytes(value).decode('latin-1')}
+    return str(value)
+
+
+def decodeValue(value):
+    if isinstance(value, dict):
+        return value['b'].encode('latin-1')
+    return value
+
+
+"""Vectorized point-in-interval join
+   positions: int64 array of variant positions, in any order
+   start, end, maxend: interval columns sorted by start, maxend being the
+   running maximum of end
+   Returns (variant_idx, interval_idx) arrays with one entry per pair where
+   start - pad <= position <= end + pad, grouped by variant and in start
+   order within a variant.
+"""
+def joinPoints(positions, start, end, maxend, pad=0):
+    positions = np.asarray(positions, dtype=np.int64)
+    hi = np.searchsorted(start, positions + pad, side='right')
+    lo = np.searchsorted(maxend, positions - pad, side='left')
+
+    # candidates of variant i are lo[i] .. hi[i]-1, laid out back to back
+    counts = np.maximum(hi - lo, 0)
+    variant_idx = np.repeat(np.arange(len(positions)), counts)
+    first = np.cumsum(counts) - counts
+    interval_idx = np.arange(int(counts.sum())) - \
+        np.repeat(first - lo, counts)
+
+    keep = np.asarray(end)[interval_idx] + pad >= positions[variant_idx]
+    return variant_idx[keep], interval_idx[keep]
+
+
+"""Lists of row numbers per variant from the pairs of a join, in table
+   order within each variant; given the start and end of each pair, by
+   start and end first, as the table queries sort them (annotate.QUERIES)
+"""
+def groupRanks(count, variant_idx, ranks, start=None, end=None):
+    if start is None:
+        order = np.lexsort((ranks, variant_idx))
+    else:
+        order = np.lexsort((ranks, end, start, variant_idx))
+    found = [[] for i in range(count)]
+    for v, r in zip(variant_idx[order].tolist(), ranks[order].tolist()):
+        found[v].append(r)
+    return found
+
+
+"""Sorted, max-end augmented intervals of one chromosome
+"""
+class Partition(object):
+
+    def __init__(self, path):
+        for c in COLUMNS:
+            setattr(self, c, np.load(path + '.' + c + '.npy', mmap_mode='r'))
+        self.fh = open(path + '.rows', 'rb')
+        self.rows = None
+        if (os.path.getsize(path + '.rows') > 0):
+            self.rows = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    """Row numbers of the intervals within pad of pos, by start and end
+       (then in table order)
+    """
+    def find(self, pos, pad=0):
+        hi = int(np.searchsorted(self.start, pos + pad, side='right'))
+        lo = int(np.searchsorted(self.maxend[:hi], pos - pad, side='left'))
+        if (lo >= hi):
+            return []
+        keep = self.end[lo:hi] + pad >= pos
+        ranks = self.rank[lo:hi][keep]
+        return ranks[np.lexsort((ranks, self.end[lo:hi][keep],
+            self.start[lo:hi][keep]))].tolist()
+
+    """Row numbers for each of positions, see joinPoints()
+    """
+    def findMany(self, positions, pad=0):
+        variant_idx, interval_idx = joinPoints(positions, self.start,
+            self.end, self.maxend, pad=pad)
+        return groupRanks(len(positions), variant_idx,
+            np.asarray(self.rank)[interval_idx],
+            np.asarray(self.start)[interval_idx],
+            np.asarray(self.end)[interval_idx])
+
+    def row(self, rank):
+        start = int(self.offset[rank])
+        end = int(self.offset[rank + 1])
+        return tuple([decodeValue(v) for v in
+            json.loads(self.rows[start:end])])
+
+    def close(self):
+        if self.rows is not None:
+            self.rows.close()
+        self.fh.close()
+
+
+"""Interval index of one table, partitions are opened on first use
+"""
+class IntervalIndex(object):
+
+    def __init__(self, indexdir, table):
+        self.path = os.path.join(indexdir, table)
+        if not exists(indexdir, table):
+            raise IOError(f"No interval index for {table} in {indexdir}")
+        with open(os.path.join(self.path, MANIFEST)) as fh:
+            self.chroms = set(json.load(fh)['chroms'])
+        self.table = table
+        self.partitions = {}
+
+    def partition(self, chrom):
+        if chrom not in self.partitions:
+            self.partitions[chrom] = None
+            if chrom in self.chroms:
+                self.partitions[chrom] = Partition(os.path.join(self.path,
+                    chrom))
+        return self.partitions[chrom]
+
+    """Rows whose interval (widened by pad) contains pos, as the table
+       query would give them
+    """
+    def query(self, chrom, pos, pad=0):
+        part = self.partition(chrom)
+        if part is None:
+            return []
+        return [part.row(r) for r in part.find(pos, pad)]
+
+    """query() for many positions on one chromosome with a single join;
+       rows hit by several positions are only decoded once
+    """
+    def queryMany(self, chrom, positions, pad=0):
+        part = self.partition(chrom)
+        if part is None:
+            return [[] for p in positions]
+
+        rows = {}
+        found = []
+        for ranks in part.findMany(positions, pad):
+            for r in ranks:
+                if r not in rows:
+                    rows[r] = part.row(r)
+            found.append([rows[r] for r in ranks])
+        return found
+
+    def close(self):
+        for part in self.partitions.values():
+            if part is not None:
+                part.close()
+        self.partitions = {}
+
+
+def exists(indexdir, table):
+    return os.path.exists(os.path.join(indexdir, table, MANIFEST))
+
+
+"""Writes the arrays of one chromosome; starts/ends/offsets are in table
+   order, offsets has one extra entry for the end of the last row
+"""
+def savePartition(path, starts, ends, offsets):
+    start = np.frombuffer(starts, dtype=np.int64)
+    end = np.frombuffer(ends, dtype=np.int64)
+    rank = np.argsort(start, kind='stable')
+
+    np.save(path + '.start.npy', start[rank])
+    np.save(path + '.end.npy', end[rank])
+    np.save(path + '.maxend.npy', np.maximum.accumulate(end[rank]))
+    np.save(path + '.rank.npy', rank.astype(np.int64))
+    np.save(path + '.offset.npy', np.frombuffer(offsets, dtype=np.int64))
+
+
+"""Exports one table (streamed with an unbuffered cursor) into its index;
+   index.json is removed first and written last, so the index is not used
+   while it is being built
+"""
+def build(conn, indexdir, table):
+    import pymysql.cursors
+
+    sources, chromName, startName, endName, columns = TABLES[table]
+    if sources is None:
+        sources = {None: table}
+
+    outdir = os.path.join(indexdir, table)
+    os.makedirs(outdir, exist_ok=True)
+    if exists(indexdir, table):
+        os.remove(os.path.join(outdir, MANIFEST))
+
+    chroms = []
+    for key, source in sources.items():
+        # chrom -> [rows file, starts, ends, offsets]
+        parts = {}
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute('select ' + chromName + ', ' + startName + ', ' +
+            endName + ', ' + columns + ' from ' + source)
+
+        for row in cursor:
+            chrom = str(row[0]) if key is None else key
+            if chrom not in parts:
+                parts[chrom] = [open(os.path.join(outdir, chrom + '.rows'),
+                    'wb'), array('q'), array('q'), array('q', [0])]
+            part = parts[chrom]
+            data = json.dumps([encodeValue(x) for x in
+                row[3:]]).encode('utf-8')
+            part[0].write(data)
+            part[1].append(int(row[1]))
+            part[2].append(int(row[2]))
+            part[3].append(part[3][-1] + len(data))
+        cursor.close()
+
+        for chrom, part in parts.items():
+            part[0].close()
+            savePartition(os.path.join(outdir, chrom), part[1], part[2],
+                part[3])
+            chroms.append(chrom)
+        print(f"{source}: {len(parts)} chromosomes")
+
+    with open(os.path.join(outdir, MANIFEST), 'w') as fh:
+        json.dump({'table': table, 'chroms': chroms}, fh)
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) < 2:
+        print("Usage: python interval_index.py <index dir> [table ...]")
+        sys.exit(1)
+
+    tables = sys.argv[2:] if (len(sys.argv) > 2) else list(TABLES)
+    conn = u.db_connect()
+    for table in tables:
+        build(conn, sys.argv[1], table)
+    conn.close()
+
+### EOF
@@ -0,0 +1,91 @@
+# lookup_cache.py
+#
+# Bounded LRU cache of reference lookups, keyed by the query (stage and
+# table) and the variant coordinates. One cache is shared by all stages
+# and all jobs of an annotator process, so sites that come up again
+# (multi-sample and trio VCFs, popular variants) are not queried twice.
+# Entries are keyed by the reference table versions; without versions the
+# driver gives each job a cache of its own (see driver.getStages).
+#
+##
+
+import sys
+import threading
+from collections import OrderedDict
+
+# rough per-entry overhead of the key and the OrderedDict slot
+ENTRY_OVERHEAD = 200
+
+"""Approximate memory held by a list of result rows
+"""
+def sizeOf(rows):
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size = size + sys.getsizeof(row) + \
+            sum([sys.getsizeof(v) for v in row])
+    return size
+
+
+"""Least recently used entries are dropped once the cached rows take more
+   than maxbytes
+"""
+class LookupCache(object):
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    """Cached rows of key, or None
+    """
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[0]
+
+    def put(self, key, rows):
+        size = sizeOf(rows) + ENTRY_OVERHEAD
+        if (size > self.maxbytes):
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size = self.size - old[1]
+            self.entries[key] = (rows, size)
+            self.size = self.size + size
+            while (self.size > self.maxbytes):
+                key, (rows, size) = self.entries.popitem(last=False)
+                self.size = self.size - size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+_shared = None
+
+"""The process-wide cache; maxmb configures it (0 disables caching)
+   Returns None while caching is disabled
+"""
+def shared(maxmb=None):
+    global _shared
+
+    if maxmb is not None:
+        if (maxmb <= 0):
+            _shared = None
+        elif _shared is None:
+            _shared = LookupCache(int(maxmb * 1024 * 1024))
+        else:
+            _shared.maxbytes = int(maxmb * 1024 * 1024)
+    return _shared
+
+### EOF
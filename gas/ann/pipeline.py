@@ -0,0 +1,223 @@
+# pipeline.py
+#
+# Fused annotation pipeline: every VCF record is parsed once and run
+# through all annotation stages in memory, instead of writing one
+# temporary file per stage.
+#
+# The output is byte-identical to running the stages one after another
+# through temp files (annotate.runStage), so the two modes can be A/B'd.
+#
+##
+
+import io
+import utils as u
+import annotate as ann
+import vcf
+import bgzf
+import site_cache
+from stage_versions import StageTracker
+
+"""Mimics '\t'.join(fields).strip().split('\t'), i.e. what the next stage
+   would have read back from the temp file; only rebuilds the record when
+   the outer fields actually carry whitespace (beyond the end of INFO)
+"""
+def restrip(fields):
+    first = fields[0]
+    last = fields[-1]
+    if first and last and not first[0].isspace() and not last[-1].isspace():
+        return fields
+    if first and not first[0].isspace() and isinstance(last, vcf.Info) and \
+        last.text().strip():
+        # only the INFO column ends in whitespace: strip it in place, so
+        # its pieces keep their owners
+        last.rstrip()
+        return fields
+    return '\t'.join([str(f) for f in fields]).strip().split('\t')
+
+
+"""True if a stage put a tab or line break into the record (e.g. from a
+   reference table value); the temp-file pipeline would have read it back
+   as different fields or several lines
+"""
+def needsReparse(fields):
+    for f in (fields[2], fields[7]):
+        if ('\t' in f) or ('\n' in f) or ('\r' in f):
+            return True
+    return False
+
+
+"""Runs a chain of stages over the records of one VCF file
+"""
+class FusedPipeline(object):
+
+    """tracker: optional stage_versions.StageTracker recording the stage
+       versions and which stage wrote what
+       sites: optional site_cache.SiteAnnotator of the records annotated
+       before
+    """
+    def __init__(self, stages, tracker=None, sites=None):
+        self.stages = stages
+        self.tracker = tracker
+        self.sites = sites
+        self.conn = None
+
+    """Takes a database connection from the pool for the stages, unless
+       all of them read local indexes or snapshots only
+    """
+    def begin(self):
+        self.conn = None
+        if not all([stage.isLocal() for stage in self.stages]):
+            self.conn = u.db_pool().acquire()
+        for stage in self.stages:
+            stage.begin(None if self.conn is None else self.conn.cursor())
+
+    def end(self):
+        if self.conn is not None:
+            u.db_pool().release(self.conn)
+            self.conn = None
+
+    """Runs a window of vcf.VcfRecords through all stages and returns the
+       output records. The window goes through one stage at a time, so each
+       stage can fetch the reference rows of the whole window at once.
+    """
+    def annotateWindow(self, records, prefetch=True):
+        # ids of the records taken from the site cache, which skip the
+        # stages
+        served = set()
+        if self.tracker is not None:
+            records = self.tracker.header(records)
+        if self.sites is not None:
+            served = self.sites.begin(records)
+        if self.tracker is not None:
+            self.tracker.begin(records)
+
+        for k, stage in enumerate(self.stages):
+            if self.tracker is not None:
+                self.tracker.stage(k)
+            if self.sites is not None:
+                self.sites.stage(k)
+            data = [record for record in records
+                if not stage.isHeader(record.head()) and
+                (id(record) not in served)]
+            for record in data:
+                record.split(stage.sep)
+
+            if prefetch:
+                stage.prefetch([record.fields for record in data])
+
+            # records a stage turned into several lines, by id
+            pieces = {}
+            for record in data:
+                if self.sites is not None:
+                    self.sites.beginRecord(stage, record)
+                out = stage.annotate(record.fields)
+                if self.sites is not None:
+                    self.sites.endRecord(k, stage, record)
+                if out is None:
+                    continue
+                if needsReparse(out):
+                    text = io.StringIO('\t'.join([str(f) for f in out]) +
+                        '\n', newline=None)
+                    pieces[id(record)] = [vcf.VcfRecord(piece.strip())
+                        for piece in text]
+                else:
+                    record.update(restrip(out))
+
+            if (len(pieces) > 0):
+                records = [r for record in records
+                    for r in pieces.get(id(record), [record])]
+
+        if self.sites is not None:
+            self.sites.end(records)
+        if self.tracker is not None:
+            self.tracker.end(records)
+        return records
+
+    def writeLogs(self, basefile):
+        for stage in self.stages:
+            ann.writeStageLog(stage, basefile)
+        if self.tracker is not None:
+            self.tracker.finish()
+
+
+"""Pipeline of stages; with reference versions (see stage_versions.py) it
+   writes the stage versions and sidecar path, and uses the node's site
+   cache if one is configured (its entries are only valid for the versions)
+"""
+def makePipeline(stages, versions, path):
+    if versions is None:
+        return FusedPipeline(stages)
+    sites = None
+    if site_cache.shared() is not None:
+        sites = site_cache.SiteAnnotator(site_cache.shared(), stages,
+            versions)
+    return FusedPipeline(stages, StageTracker(stages, versions, path), sites)
+
+
+"""Runs the lines of infile through pipeline into outfile
+   Lines are read in windows of batchsize; 0 looks up each record on its own
+   infile may be gzip/bgzip compressed, outfile is bgzip if it ends in .gz
+"""
+def annotateFile(pipeline, infile, outfile, batchsize=0):
+    annotateStream(pipeline, bgzf.openText(infile),
+        bgzf.openOutput(outfile), batchsize)
+
+
+"""Runs the lines of text stream fh through pipeline into text stream
+   fh_out, closing both
+"""
+def annotateStream(pipeline, fh, fh_out, batchsize=0):
+    writer = vcf.VcfWriter(fh_out)
+    for records in vcf.readWindows(fh, batchsize):
+        for record in pipeline.annotateWindow(records,
+            prefetch=(batchsize > 0)):
+            writer.write(record)
+    fh.close()
+    writer.close()
+
+
+"""Annotates infile and writes the result to outfile in a single pass
+   With versions, the stage sidecar is written to infile + '.stages'
+"""
+def run(infile, outfile, stages, batchsize=0, versions=None):
+    pipeline = makePipeline(stages, versions, infile + '.stages')
+    pipeline.begin()
+
+    annotateFile(pipeline, infile, outfile, batchsize)
+    pipeline.writeLogs(infile)
+
+    pipeline.end()
+
+
+"""Annotates text stream fh into fh_out (e.g. straight from and to S3),
+   writing the counters to logbase + '.count.log' (and the stage sidecar
+   to logbase + '.stages', with versions)
+"""
+def runStream(fh, fh_out, logbase, stages, batchsize=0, versions=None):
+    pipeline = makePipeline(stages, versions, logbase + '.stages')
+    pipeline.begin()
+
+    annotateStream(pipeline, fh, fh_out, batchsize)
+    pipeline.writeLogs(logbase)
+
+    pipeline.end()
+
+
+"""Annotates one shard of a file in a worker process and returns how much
+   each stage's log counters grew; with versions, the stage sidecar of the
+   shard is written to outfile + '.stages'
+"""
+def runShard(infile, outfile, stages, batchsize=0, versions=None):
+    pipeline = makePipeline(stages, versions, outfile + '.stages')
+    pipeline.begin()
+    start = [stage.counts() for stage in stages]
+
+    annotateFile(pipeline, infile, outfile, batchsize)
+    if pipeline.tracker is not None:
+        pipeline.tracker.finish()
+
+    pipeline.end()
+    return [dict([(c, value - before[c]) for c, value in
+        stage.counts().items()]) for stage, before in zip(stages, start)]
+
+### EOF
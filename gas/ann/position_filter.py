@@ -0,0 +1,150 @@
+# position_filter.py
+#
+# Prefilter for the dbSNP lookups: the distinct positions of the table,
+# per chromosome, as sorted int32 arrays (<chrom>.npy in the filter's
+# directory). A variant at a position the table does not have cannot
+# match, so the stage only queries the database for the positions found
+# here; np.searchsorted answers a whole window at once.
+#
+# Unlike a Bloom filter the arrays are exact on position, so the only
+# false positives are variants whose position is in dbSNP but whose
+# alleles or variant class are not; the stage counts those for its log.
+#
+# Each array is written under a temporary name and renamed into place,
+# and chroms.json, listing every chromosome of the table, is written
+# last: a filter is only used once it is complete, and a chromosome it
+# lists must have its array.
+#
+# Usage: python position_filter.py <index dir> [table]
+##
+
+import os
+import sys
+import json
+from array import array
+
+import numpy as np
+
+"""Tables a filter can be built for, as name: (chrom column, position
+   column)
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS'),
+}
+
+# chromosomes of a complete filter
+MANIFEST = 'chroms.json'
+
+
+def path(indexdir, table):
+    return os.path.join(indexdir, table + '.positions')
+
+
+def exists(indexdir, table):
+    return os.path.exists(os.path.join(path(indexdir, table), MANIFEST))
+
+
+"""Sorted distinct positions of one table, per chromosome; chromosomes
+   are mapped on first use
+"""
+class PositionFilter(object):
+
+    def __init__(self, indexdir, table):
+        self.path = path(indexdir, table)
+        if not exists(indexdir, table):
+            raise IOError(f"No position filter for {table} in {indexdir}")
+        with open(os.path.join(self.path, MANIFEST)) as fh:
+            self.chroms = set(json.load(fh))
+        self.table = table
+        self.positions = {}
+
+    """Positions of chrom, or None if the table has none there
+    """
+    def chrom(self, chrom):
+        if chrom not in self.positions:
+            known = None
+            if chrom in self.chroms:
+                # skipping a listed chromosome would silently drop its
+                # dbSNP matches
+                filename = os.path.join(self.path, chrom + '.npy')
+                if not os.path.exists(filename):
+                    raise IOError(f"Position filter {self.path} has no " +
+                        f"positions for {chrom}")
+                known = np.load(filename, mmap_mode='r')
+            self.positions[chrom] = known
+        return self.positions[chrom]
+
+    """Boolean array, True for each of positions the table may have
+    """
+    def containsMany(self, chrom, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        known = self.chrom(chrom)
+        if (known is None) or (len(known) == 0):
+            return np.zeros(len(positions), dtype=bool)
+        i = np.minimum(np.searchsorted(known, positions), len(known) - 1)
+        return np.asarray(known)[i] == positions
+
+    def contains(self, chrom, pos):
+        return bool(self.containsMany(chrom, [pos])[0])
+
+    """Bytes of the chromosomes mapped so far
+    """
+    def nbytes(self):
+        return sum([p.nbytes for p in self.positions.values()
+            if p is not None])
+
+
+"""Writes array to filename by way of a temporary file, so readers see
+   either the old file or the complete new one
+"""
+def saveAtomic(filename, values):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        np.save(fh, values)
+    os.replace(tmp, filename)
+
+
+"""Exports the positions of table (streamed with an unbuffered cursor);
+   the manifest is written last
+"""
+def build(conn, indexdir, table='dbSNP'):
+    import pymysql.cursors
+
+    chromName, posName = TABLES[table]
+    outdir = path(indexdir, table)
+    os.makedirs(outdir, exist_ok=True)
+
+    positions = {}
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select ' + chromName + ', ' + posName + ' from ' +
+        table)
+    for chrom, pos in cursor:
+        positions.setdefault(str(chrom), array('i')).append(int(pos))
+    cursor.close()
+
+    total = 0
+    for chrom, values in positions.items():
+        values = np.unique(np.frombuffer(values, dtype=np.int32))
+        saveAtomic(os.path.join(outdir, chrom + '.npy'), values)
+        total = total + len(values)
+
+    tmp = os.path.join(outdir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as fh:
+        json.dump(sorted(positions), fh)
+    os.replace(tmp, os.path.join(outdir, MANIFEST))
+    print(f"{table}: {total} positions on {len(positions)} chromosomes " +
+        f"({total * 4 / (1024 * 1024):.1f} MB)")
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) < 2:
+        print("Usage: python position_filter.py <index dir> [table]")
+        sys.exit(1)
+
+    conn = u.db_connect()
+    build(conn, sys.argv[1], *sys.argv[2:3])
+    conn.close()
+
+### EOF
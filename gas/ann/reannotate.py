@@ -0,0 +1,96 @@
+# reannotate.py
+#
+# Brings the stored results up to date after a reference table refresh:
+# for each result under the results prefix (of one user, if given), the
+# stages whose table versions (ReferenceVersions) changed are recomputed
+# in place (see stage_versions.py) and the .annot file, its .count.log
+# and its .stages sidecar are uploaded back. Results that need a full run
+# instead (no sidecar, or a changed dbSNP, BigRefGene or gadAll table)
+# are listed.
+#
+# Usage: python reannotate.py [user id]
+##
+
+import os
+import sys
+import shutil
+import tempfile
+from botocore.exceptions import ClientError
+
+import run
+import driver
+import stage_versions
+import s3_stream
+from run import config
+
+"""Results keys (without .annot) under prefix of bucket
+"""
+def resultKeys(s3, bucket, prefix):
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for item in response.get('Contents', []):
+            if item['Key'].endswith('.annot'):
+                yield item['Key'][:-len('.annot')]
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+"""Re-annotates the result at key of bucket in tmpdir and uploads it back
+   if it changed; returns the stage_versions status
+"""
+def reannotateResult(s3, bucket, key, versions, tmpdir):
+    try:
+        s3.head_object(Bucket=bucket, Key=key + '.stages')
+    except ClientError:
+        return stage_versions.RERUN
+
+    base = os.path.join(tmpdir, os.path.basename(key))
+    extensions = ('.annot', '.stages', '.count.log')
+    try:
+        for ext in extensions:
+            s3_stream.download_file(s3, bucket, key + ext, base + ext)
+        status = driver.reannotate(base + '.annot', base, 'vcf', versions,
+            batchsize=int(config['ann']['BatchSize']),
+            indexdir=config['ann']['IntervalIndexDir'],
+            querystyle=config['ann']['QueryStyle'],
+            overlapjoin=config['ann']['OverlapJoin'])
+        if (status == stage_versions.UPDATED):
+            for ext in extensions:
+                s3_stream.upload_file(s3, base + ext, bucket, key + ext)
+    finally:
+        for ext in extensions:
+            if os.path.exists(base + ext):
+                os.remove(base + ext)
+    return status
+
+
+if __name__ == '__main__':
+    run.configure()
+    versions = stage_versions.loadVersions(config['ann']['ReferenceVersions'])
+    if versions is None:
+        print("ReferenceVersions is not set in ann_config.ini")
+        sys.exit(1)
+
+    s3 = run.aws_clients().s3
+    bucket = config['aws']['AWSS3ResultsBucket']
+    prefix = config['aws']['AWSS3Prefix'] + '/'
+    if (len(sys.argv) > 1):
+        prefix = prefix + sys.argv[1] + '/'
+
+    totals = {}
+    tmpdir = tempfile.mkdtemp(prefix='reannotate.')
+    try:
+        for key in resultKeys(s3, bucket, prefix):
+            status = reannotateResult(s3, bucket, key, versions, tmpdir)
+            totals[status] = totals.get(status, 0) + 1
+            print(f"{key}: {status}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(f"{totals.get(stage_versions.UPDATED, 0)} updated, " +
+        f"{totals.get(stage_versions.CURRENT, 0)} current, " +
+        f"{totals.get(stage_versions.RERUN, 0)} need a full run")
+
+### EOF
@@ -0,0 +1,96 @@
+# result_cache.py
+#
+# Content-addressed cache of annotation results. The input of a job is
+# identified by the SHA-256 of its bytes (or, when it is streamed from
+# S3, by its ETag), together with a digest of the stage and reference
+# table versions (see stage_versions.py); the results index maps that to
+# the results key of the first job that annotated it. The index lives in
+# the results bucket, one small object per entry under
+# <prefix>/result-index/, so it needs no table of its own.
+#
+# A repeat submission copies the .annot, .count.log and .stages of the
+# earlier job server-side instead of annotating again. Results archived
+# or deleted since then simply miss, and the job runs as usual.
+##
+
+import json
+import hashlib
+from botocore.exceptions import ClientError
+
+import stage_versions
+import vcf_sort
+
+INDEX = 'result-index'
+# files of a result; a result without a sidecar has no .stages
+EXTENSIONS = ('.annot', '.count.log')
+OPTIONAL = ('.stages',)
+
+"""SHA-256 of local file path, read in blocks of blocksize
+"""
+def fileDigest(path, blocksize=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            digest.update(block)
+    return 'sha256-' + digest.hexdigest()
+
+
+"""ETag of an S3 object, for inputs that are not downloaded
+"""
+def objectDigest(s3, bucket, key):
+    etag = s3.head_object(Bucket=bucket, Key=key).get('ETag')
+    if not etag:
+        return None
+    return 'etag-' + etag.strip('"')
+
+
+"""Digest of what the results depend on besides the input: the versions
+   of the stages and their tables, and whether (and in which order) the
+   input gets sorted
+"""
+def versionDigest(stages, versions, sort):
+    text = stage_versions.digest(stages, versions) + (
+        f'-sorted{vcf_sort.ORDER}' if sort else '')
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def indexKey(prefix, version, digest):
+    return f'{prefix}/{INDEX}/{version}/{digest}'
+
+
+"""Results key (without extension) of the index entry at key, or None
+"""
+def lookup(s3, bucket, key):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError:
+        return None
+    return json.loads(body.decode('utf-8')).get('results_key')
+
+
+def record(s3, bucket, key, results_key):
+    s3.put_object(Bucket=bucket, Key=key,
+        Body=json.dumps({'results_key': results_key}).encode('utf-8'))
+
+
+"""Copies the result files of source to target within bucket; False if
+   the source result is gone
+"""
+def copyResults(s3, bucket, source, target):
+    extensions = list(EXTENSIONS)
+    for ext in OPTIONAL:
+        try:
+            s3.head_object(Bucket=bucket, Key=source + ext)
+            extensions.append(ext)
+        except ClientError:
+            pass
+
+    try:
+        for ext in extensions:
+            s3.copy({'Bucket': bucket, 'Key': source + ext}, bucket,
+                target + ext)
+    except ClientError:
+        return False
+    return True
+
+### EOF
@@ -6,10 +6,20 @@
 import sys
 import time
 import driver
+import utils
+import lookup_cache
+import site_cache
+import bgzf
+import s3_stream
+import stage_versions
+import result_cache
+import aws_async
+import asyncio
 import os
 import boto3
 import shutil
 import json
+import glob
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
@@ -38,120 +48,230 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
+"""Configures the process-wide database pool, lookup cache, bgzip threads
+   and S3 transfers; called once per process, before the first job
+"""
+def configure():
+    utils.DB_SECRET_TTL = int(config['ann']['DbSecretTTL'])
+    utils.db_pool(size=int(config['ann']['DbPoolSize']))
+    lookup_cache.shared(maxmb=float(config['ann']['LookupCacheMB']))
+    site_cache.shared(path=config['ann']['SiteCache'],
+        maxmb=float(config['ann']['SiteCacheMB']))
+    bgzf.THREADS = int(config['ann']['BgzfThreads'])
+    s3_stream.configure(config['transfer'])
+
+
+_clients = {}
+
+"""aws_async.AsyncAws on the S3 client, DynamoDB annotations table and SNS
+   client (local stand-ins if LocalS3Dir is set), created once per process
+   and reused by all of its jobs
+"""
+def aws_clients():
+    if os.getpid() not in _clients:
+        s3 = s3_stream.s3_client(config['aws']['AwsRegionName'],
+                                 signature_version=config['aws']['SignatureVersion'],
+                                 localdir=config['aws']['LocalS3Dir'])
+        if config['aws']['LocalS3Dir']:
+            _clients[os.getpid()] = aws_async.AsyncAws(s3, aws_async.LocalTable(), aws_async.LocalSns())
+        else:
+            dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+            _clients[os.getpid()] = aws_async.AsyncAws(
+                s3, dynamo.Table(config['aws']['AWSDynamodbAnnotationsTable']),
+                boto3.client('sns', region_name=config['aws']['AwsRegionName']))
+    return _clients[os.getpid()]
+
+
+"""Uploads the results of a job, marks it COMPLETED and notifies the user
+   and the archive; independent calls run concurrently. cached results
+   were copied from an earlier job and are not uploaded.
+"""
+async def finish_job(aws, directory_name, filename, user_id, streamed, cached=False):
+    results_key = '{}/{}/{}'.format(config['aws']['AWSS3Prefix'], user_id, filename)
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        # upload results file (a streamed job has already written it) and log file
+        # print("Attempting to upload: {}/{}.annot".format(directory_name, filename))
+        uploads = []
+        if not cached:
+            uploads.append(aws.upload_file("{}/{}.count.log".format(directory_name, filename),
+                                           config['aws']['AWSS3ResultsBucket'],
+                                           results_key + '.count.log'))
+        if not (streamed or cached):
+            # the annotated file as the driver names it (.annot.vcf, .annot.vcf.gz)
+            uploads.append(aws.upload_file(driver.getOutputFile(os.path.join(directory_name, filename)),
+                                           config['aws']['AWSS3ResultsBucket'],
+                                           results_key + '.annot'))
+        # stage sidecar, if reference versions are configured
+        if not cached and os.path.exists("{}/{}.stages".format(directory_name, filename)):
+            uploads.append(aws.upload_file("{}/{}.stages".format(directory_name, filename),
+                                           config['aws']['AWSS3ResultsBucket'],
+                                           results_key + '.stages'))
+        await asyncio.gather(*uploads)
+    except ClientError as e:
+        # print("Error in uploading s3 files to the gas-results: {}".format(str(e)))
+        raise e
+
+    try:
+        # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html
+        # status and result locations in one update
+        await aws.update_item(
+            Key={"job_id": filename.split('~')[0]},
+            UpdateExpression="SET job_status = :p, s3_results_bucket = :a, complete_time = :b, \
+                s3_key_log_file = :c, s3_key_result_file = :d",
+            ExpressionAttributeValues={
+                ':p': "COMPLETED",
+                ':a': config['aws']['AWSS3ResultsBucket'],
+                ':b': int(time.time()),
+                ':c': results_key + '.count.log',
+                ':d': results_key + '.annot',
+            })
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
+    except ClientError as e:
+        # print("Error in updating dynamobd: {}".format(str(e)))
+        raise e
+
+    # now notify the user problem #3, and
+    # problem #7 create an archive
+    # will send to archive SNS regardless and user type (free vs premium) checked in archive.py
+    try:
+        data = {'job_id': filename.split('~')[0],
+                "input_file_name": filename.split('~')[1],
+                "user_id": directory_name.split('/')[-1],
+                }
+        json_message = json.dumps({"default": json.dumps(data)})
+        await asyncio.gather(
+            aws.publish(TopicArn=config['aws']['AwsSNSJobResultsTopic'],
+                        MessageStructure=config['aws']['MessageStructure'],
+                        Message=json_message),
+            aws.publish(TopicArn=config['aws']['AwsSNSJobArchiveTopic'],
+                        MessageStructure=config['aws']['MessageStructure'],
+                        Message=json_message))
+        # print(f"Successful message results to SNS queues after finishing run.py operations")
+    except ClientError as e:
+        # print(f"Unsuccessful message results to SNS queues after finishing run.py operations")
+        # print(f'{str(e)}')
+        raise ClientError
+
+
+"""Key of the job's input in the results index (see result_cache.py), or
+   None if the result cache is off; streamed inputs are known by their ETag
+"""
+def result_index_key(aws, path, bucket, key, versions):
+    if not config['ann'].getboolean('ResultCache') or versions is None:
+        return None
+    if key is not None:
+        digest = result_cache.objectDigest(aws.s3, bucket, key)
+    else:
+        digest = result_cache.fileDigest(path)
+    if not digest:
+        return None
+    stages = [stage for label, stage in driver.getStages('vcf')]
+    return result_cache.indexKey(config['aws']['AWSS3Prefix'],
+                                 result_cache.versionDigest(stages, versions,
+                                                            config['ann'].getboolean('SortInput')),
+                                 digest)
+
+
+"""Removes the files of job filename (<job id>~<input name>) from
+   directory_name: its input, results, logs and temporary files all start
+   with '<job id>~'. The directory is removed too if nothing else is left
+"""
+def remove_job_files(directory_name, filename):
+    prefix = filename.split('~')[0] + '~'
+    for name in glob.glob(os.path.join(glob.escape(directory_name), glob.escape(prefix) + '*')):
+        if os.path.isdir(name):
+            shutil.rmtree(name)
+        else:
+            os.remove(name)
+    try:
+        os.rmdir(directory_name)
+    except OSError:
+        # other jobs' files
+        pass
+
+
+"""Annotates the job at local path, uploads the results and notifies the
+   user; with the bucket and key, the input is streamed from S3 instead of
+   being read from the (not downloaded) local path. An input annotated
+   before gets a copy of the earlier results.
+"""
+def run_job(path, bucket=None, key=None):
+    streamed = key is not None
+
+    # print(f'The input to run.py looks like this: {path}')
+    # get the directory name from inputs [this needs to be cleaned up!]
+    directory_name = os.path.abspath(os.path.dirname(path))
+    input_path = path.split('/')
+    path_items = len(input_path)
+    filename = input_path[path_items - 1]
+    job_id = input_path[path_items - 2].replace('/', '')
+    user_id = input_path[-2]
+
+    # catch if there's an error reading those string parsed inputs above (if they're empty)
+    if not input_path or not path_items or not filename or not job_id:
+        # print("Could not read input strings for run.py -- found empty string")
+        raise ValueError
+
+    aws = aws_clients()
+    versions = stage_versions.loadVersions(config['ann']['ReferenceVersions'])
+    results_key = '{}/{}/{}'.format(config['aws']['AWSS3Prefix'], user_id, filename)
+
+    # results of an earlier job on the same input and reference versions
+    index_key = result_index_key(aws, path, bucket, key, versions)
+    cached_key = None if index_key is None else \
+        result_cache.lookup(aws.s3, config['aws']['AWSS3ResultsBucket'], index_key)
+    cached = bool(cached_key) and result_cache.copyResults(
+        aws.s3, config['aws']['AWSS3ResultsBucket'], cached_key, results_key)
+    if cached:
+        print(f"Results copied from {cached_key}")
+    else:
+        with Timer():
+            if streamed:
+                driver.run_s3(aws.s3, bucket, key,
+                              config['aws']['AWSS3ResultsBucket'],
+                              results_key + '.annot',
+                              path, 'vcf',
+                              batchsize=int(config['ann']['BatchSize']),
+                              indexdir=config['ann']['IntervalIndexDir'],
+                              querystyle=config['ann']['QueryStyle'],
+                              overlapjoin=config['ann']['OverlapJoin'],
+                              compress=key.endswith('.gz'),
+                              versions=versions)
+            else:
+                driver.run(path, 'vcf', mode=config['ann']['PipelineMode'],
+                           batchsize=int(config['ann']['BatchSize']),
+                           indexdir=config['ann']['IntervalIndexDir'],
+                           workers=int(config['ann']['Workers']),
+                           shardsize=int(config['ann']['ShardSize']),
+                           querystyle=config['ann']['QueryStyle'],
+                           overlapjoin=config['ann']['OverlapJoin'],
+                           tabix=config['ann'].getboolean('TabixIndex'),
+                           sort=config['ann'].getboolean('SortInput'),
+                           sortbytes=int(float(config['ann']['SortMemoryMB']) * 1024 * 1024),
+                           versions=versions)
+
+    asyncio.run(finish_job(aws, directory_name, filename, user_id, streamed, cached=cached))
+    if (index_key is not None) and not cached:
+        result_cache.record(aws.s3, config['aws']['AWSS3ResultsBucket'], index_key, results_key)
+
+    try:
+        # delete this job's files; other jobs of the user may still be running
+        # in the same directory, which goes once it is empty
+        remove_job_files(directory_name, filename)
+    except Exception as e:
+        # print("Error while deleting job files in {}".format(directory_name))
+        # print(f"{str(e)}")
+        raise e
+
+
 if __name__ == '__main__':
     # Call the AnnTools pipeline
+    # Usage: run.py <local input path> [<input bucket> <input key>]
     if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        # print(f'The input to run.py looks like this: {sys.argv[1]}')
-        # get the directory name from inputs [this needs to be cleaned up!]
-        directory_name = os.path.abspath(os.path.dirname(sys.argv[1]))
-        input_path = sys.argv[1].split('/')
-        path_items = len(input_path)
-        filename = input_path[path_items - 1]
-        job_id = input_path[path_items - 2].replace('/', '')
-        user_id = input_path[-2]
-
-        # catch if there's an error reading those string parsed inputs above (if they're empty)
-        if not input_path or not path_items or not filename or not job_id:
-            # print("Could not read input strings for run.py -- found empty string")
-            raise ValueError
-
-        try:
-            s3 = boto3.client('s3',
-                              region_name=config['aws']['AwsRegionName'],
-                              config=Config(signature_version=config['aws']['SignatureVersion']))
-
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-            # upload results file
-            # print("Attempting to upload: {}/{}.annot".format(directory_name, filename))
-            s3.upload_file("{}/{}.annot".format(directory_name, filename),
-                           '{}'.format(config['aws']['AWSS3ResultsBucket']),
-                           '{}/{}/{}.annot'.format(config['aws']['AWSS3Prefix'], user_id, filename))
-            # upload log file
-            # print("Attempting to upload: {}/{}.count.log".format(directory_name, filename))
-            s3.upload_file("{}/{}.count.log".format(directory_name, filename),
-                           '{}'.format(config['aws']['AWSS3ResultsBucket']),
-                           '{}/{}/{}.count.log'.format(config['aws']['AWSS3Prefix'], user_id, filename))
-        except ClientError as e:
-            # print("Error in uploading s3 files to the gas-results: {}".format(str(e)))
-            raise e
-
-        try:
-            # https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html
-            dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-            annotations = dynamo.Table(config['aws']['AWSDynamodbAnnotationsTable'])
-
-            annotations.update_item(
-                Key={"job_id": filename.split('~')[0]},
-                UpdateExpression="SET job_status = :p",
-                ExpressionAttributeValues={':p': "COMPLETED"}
-            )
-
-            annotations.update_item(
-                Key={"job_id": filename.split('~')[0]},
-                UpdateExpression="SET s3_results_bucket = :a, complete_time = :b, \
-                    s3_key_log_file = :c, s3_key_result_file = :d",
-                ExpressionAttributeValues={
-                    ':a': config['aws']['AWSS3ResultsBucket'],
-                    ':b': int(time.time()),
-                    ':c': '{}/{}/{}.count.log'.format(config['aws']['AWSS3Prefix'], user_id, filename),
-                    ':d': '{}/{}/{}.annot'.format(config['aws']['AWSS3Prefix'], user_id, filename),
-                })
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
-        except ClientError as e:
-            # print("Error in updating dynamobd: {}".format(str(e)))
-            raise e
-
-            # now notify the user problem #3
-        try:
-            data = {'job_id': filename.split('~')[0],
-                    "input_file_name": filename.split('~')[1],
-                    "user_id": directory_name.split('/')[-1],
-                    }
-            json_message = json.dumps({"default": json.dumps(data)})
-            snsClient = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
-            ann_job_response = snsClient.publish(
-                TopicArn=config['aws']['AwsSNSJobResultsTopic'],
-                MessageStructure=config['aws']['MessageStructure'],
-                Message=json_message)
-            # print(f"Successful message results to SNS queue after finishing run.py operations")
-        except ClientError as e:
-            # print(f"Unsuccessful message results to SNS queue after finishing run.py operations")
-            # print(f'{str(e)}')
-            raise ClientError
-
-        # problem #7 create an archive
-        # will send to archive SNS regardless and user type (free vs premium) checked in archive.py
-        try:
-            data = {'job_id': filename.split('~')[0],
-                    "input_file_name": filename.split('~')[1],
-                    "user_id": directory_name.split('/')[-1],
-                    }
-            json_message = json.dumps({"default": json.dumps(data)})
-            snsClient = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
-
-            ann_job_response = snsClient.publish(
-                TopicArn=config['aws']['AwsSNSJobArchiveTopic'],
-                MessageStructure=config['aws']['MessageStructure'],
-                Message=json_message,
-            )
-            # print(f"Successful message results to archive SNS queue after finishing run.py operations")
-        except ClientError as e:
-            # print(f"Unsuccessful message results to  archive SNS queue after finishing run.py operations")
-            # print(f'{str(e)}')
-            raise ClientError
-
-        try:
-            # delete the directory
-            shutil.rmtree("{}/{}/".format(os.path.dirname(__file__), job_id))
-        except Exception as e:
-            # print("Error while deleting file on instance {}{}/".format(os.path.dirname(__file__), job_id))
-            # print(f"{str(e)}")
-            raise e
-
+        configure()
+        run_job(*sys.argv[1:4])
 
     # else:
     #     print("A valid .vcf file must be provided as input to this program.")
@@ -0,0 +1,403 @@
+# s3_stream.py
+#
+# Streaming reads and writes of S3 objects, so an annotation job can read
+# its input and write its result without a full local copy of either.
+#
+# S3Reader fetches the object in ranged GETs, a few parts ahead of the
+# reader; S3Writer sends what is written to it as a multipart upload,
+# uploading each part while the next one fills. Both are raw binary
+# streams, see bgzf.openTextStream() and bgzf.openOutputStream().
+#
+# upload_file() and download_file() move whole local files the same way,
+# in parallel parts. Every part is retried on its own with backoff, so a
+# failed part is resent without restarting the transfer; uploaded parts
+# can carry a checksum S3 verifies, and all transfers of a process share
+# an optional bandwidth cap. The settings below are the [transfer] section
+# of ann_config.ini (see configure()).
+#
+# LocalS3 implements the S3 calls the annotator uses on top of a local
+# directory (one subdirectory per bucket), as a stand-in for S3 when
+# running off AWS (LocalS3Dir in ann_config.ini).
+#
+##
+
+import io
+import os
+import time
+import uuid
+import base64
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+# bytes per ranged GET / uploaded part (S3 parts must be at least 5 MB)
+PART_SIZE = 8 * 1024 * 1024
+# parts fetched or uploaded concurrently
+THREADS = 4
+# attempts per part (and per single-request object) before giving up
+RETRIES = 3
+# bytes per second over all transfers of the process, 0 for no cap
+MAX_BANDWIDTH = 0
+# checksum S3 verifies on uploaded parts: None, 'md5' or 'sha256'
+CHECKSUM = None
+CHECKSUMS = [None, 'md5', 'sha256']
+
+
+"""Sets the transfer settings from the [transfer] section of the config
+"""
+def configure(section):
+    global PART_SIZE, THREADS, RETRIES, MAX_BANDWIDTH, CHECKSUM
+
+    PART_SIZE = int(float(section['PartSizeMB']) * 1024 * 1024)
+    THREADS = int(section['Concurrency'])
+    RETRIES = max(int(section['Retries']), 1)
+    MAX_BANDWIDTH = int(float(section['MaxBandwidthMBps']) * 1024 * 1024)
+    CHECKSUM = section['Checksum'].lower() or None
+    if CHECKSUM not in CHECKSUMS:
+        raise ValueError(f"Unknown transfer checksum: {CHECKSUM}")
+
+
+"""Token bucket shared by the transfers of a process; wait(n) blocks until
+   n more bytes fit under MAX_BANDWIDTH
+"""
+class Throttle(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self, nbytes):
+        if (MAX_BANDWIDTH <= 0):
+            return
+        with self.lock:
+            now = time.time()
+            start = max(self.next, now)
+            self.next = start + nbytes / MAX_BANDWIDTH
+        if (start > now):
+            time.sleep(start - now)
+
+
+throttle = Throttle()
+
+
+"""Calls fn() up to RETRIES times, backing off between attempts
+"""
+def retry(fn):
+    for attempt in range(RETRIES):
+        try:
+            return fn()
+        except Exception:
+            if (attempt + 1 >= RETRIES):
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+"""Checksum arguments of a put_object / upload_part call for data
+"""
+def checksumArgs(data):
+    if (CHECKSUM == 'md5'):
+        return {'ContentMD5':
+            base64.b64encode(hashlib.md5(data).digest()).decode('ascii')}
+    if (CHECKSUM == 'sha256'):
+        return {'ChecksumSHA256':
+            base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')}
+    return {}
+
+
+"""S3 client for the annotator: the local stand-in if localdir is set
+"""
+def s3_client(region_name, signature_version=None, localdir=None):
+    if localdir:
+        return LocalS3(localdir)
+    if signature_version:
+        return boto3.client('s3', region_name=region_name,
+            config=Config(signature_version=signature_version))
+    return boto3.client('s3', region_name=region_name)
+
+
+"""Reads an S3 object in ranged GETs of partsize bytes, fetching up to
+   threads parts ahead of the reader (PART_SIZE and THREADS by default)
+"""
+class S3Reader(io.RawIOBase):
+
+    def __init__(self, client, bucket, key, partsize=None, threads=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partsize = partsize or PART_SIZE
+        self.size = retry(lambda: client.head_object(Bucket=bucket,
+            Key=key))['ContentLength']
+        self.executor = ThreadPoolExecutor(max_workers=threads or THREADS)
+        self.ahead = threads or THREADS
+        self.next = 0
+        self.pending = deque()
+        self.data = b''
+        self.pos = 0
+        self.fill()
+
+    def fetch(self, start):
+        end = min(start + self.partsize, self.size) - 1
+        return retry(lambda: self.fetchRange(start, end))
+
+    def fetchRange(self, start, end):
+        throttle.wait(end - start + 1)
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end}")
+        data = response['Body'].read()
+        if (len(data) != end - start + 1):
+            raise IOError(f"Short read of s3://{self.bucket}/{self.key} "
+                f"at {start}")
+        return data
+
+    def fill(self):
+        while (len(self.pending) < self.ahead) and (self.next < self.size):
+            self.pending.append(self.executor.submit(self.fetch, self.next))
+            self.next = self.next + self.partsize
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (self.pos >= len(self.data)):
+            if (len(self.pending) == 0):
+                return 0
+            self.data = self.pending.popleft().result()
+            self.pos = 0
+            self.fill()
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos = self.pos + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        io.RawIOBase.close(self)
+
+
+"""Writes an S3 object as a multipart upload of partsize parts; objects
+   smaller than one part are sent with a single put_object on close()
+   At most threads parts are in flight, so memory stays bounded.
+"""
+class S3Writer(io.RawIOBase):
+
+    def __init__(self, client, bucket, key, partsize=None, threads=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partsize = partsize or PART_SIZE
+        self.threads = threads or THREADS
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.buffer = bytearray()
+        self.uploadId = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while (len(self.buffer) >= self.partsize):
+            self.uploadPart(bytes(self.buffer[:self.partsize]))
+            del self.buffer[:self.partsize]
+        return len(b)
+
+    def uploadPart(self, data):
+        if self.uploadId is None:
+            args = {'ChecksumAlgorithm': 'SHA256'} \
+                if (CHECKSUM == 'sha256') else {}
+            self.uploadId = retry(lambda: self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **args))['UploadId']
+
+        # wait for the oldest part once threads of them are in flight
+        running = [p for p in self.parts if not p.done()]
+        if (len(running) >= self.threads):
+            running[0].result()
+        self.parts.append(self.executor.submit(self.sendPart,
+            len(self.parts) + 1, data))
+
+    def sendPart(self, number, data):
+        args = checksumArgs(data)
+        def send():
+            throttle.wait(len(data))
+            return self.client.upload_part(Bucket=self.bucket, Key=self.key,
+                UploadId=self.uploadId, PartNumber=number, Body=data, **args)
+        part = {'ETag': retry(send)['ETag'], 'PartNumber': number}
+        if 'ChecksumSHA256' in args:
+            part['ChecksumSHA256'] = args['ChecksumSHA256']
+        return part
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.uploadId is None:
+                data = bytes(self.buffer)
+                args = checksumArgs(data)
+                def put():
+                    throttle.wait(len(data))
+                    return self.client.put_object(Bucket=self.bucket,
+                        Key=self.key, Body=data, **args)
+                retry(put)
+            else:
+                if (len(self.buffer) > 0):
+                    self.uploadPart(bytes(self.buffer))
+                parts = [p.result() for p in self.parts]
+                retry(lambda: self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                    MultipartUpload={'Parts': parts}))
+        except Exception:
+            if self.uploadId is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket,
+                    Key=self.key, UploadId=self.uploadId)
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+            io.RawIOBase.close(self)
+
+
+"""Uploads local file filename in parallel parts
+"""
+def upload_file(client, filename, bucket, key):
+    writer = S3Writer(client, bucket, key)
+    try:
+        with open(filename, 'rb') as fh:
+            shutil.copyfileobj(fh, writer, writer.partsize)
+    finally:
+        writer.close()
+
+
+"""Downloads an object to local file filename in parallel ranged GETs
+"""
+def download_file(client, bucket, key, filename):
+    reader = S3Reader(client, bucket, key)
+    try:
+        with open(filename, 'wb') as fh:
+            shutil.copyfileobj(reader, fh, reader.partsize)
+    finally:
+        reader.close()
+
+
+"""S3 client stand-in storing objects under root/<bucket>/<key>
+"""
+class LocalS3(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def error(self, code, operation):
+        return ClientError({'Error': {'Code': code, 'Message': code}},
+            operation)
+
+    def head_object(self, Bucket, Key):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self.error('404', 'HeadObject')
+        digest = hashlib.md5()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b''):
+                digest.update(block)
+        return {'ContentLength': os.path.getsize(path),
+            'ETag': '"' + digest.hexdigest() + '"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self.error('NoSuchKey', 'GetObject')
+        with open(path, 'rb') as fh:
+            if Range is None:
+                data = fh.read()
+            else:
+                start, end = Range.replace('bytes=', '').split('-')
+                fh.seek(int(start))
+                data = fh.read(int(end) - int(start) + 1)
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    """Checks the ContentMD5 / ChecksumSHA256 sent with data, like S3
+    """
+    def verify(self, data, operation, ContentMD5=None, ChecksumSHA256=None):
+        if (ContentMD5 is not None) and (ContentMD5 != base64.b64encode(
+            hashlib.md5(data).digest()).decode('ascii')):
+            raise self.error('BadDigest', operation)
+        if (ChecksumSHA256 is not None) and (ChecksumSHA256 !=
+            base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')):
+            raise self.error('BadDigest', operation)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.verify(data, 'PutObject', **kwargs)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return {'ETag': '"' + hashlib.md5(data).hexdigest() + '"'}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.head_object(Bucket=Bucket, Key=Key)
+        shutil.copyfile(self.path(Bucket, Key), Filename)
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self.head_object(Bucket=CopySource['Bucket'], Key=CopySource['Key'])
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(self.path(CopySource['Bucket'], CopySource['Key']),
+            path)
+
+    """All keys under Prefix in one page, as S3 lists them
+    """
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        root = os.path.join(self.root, Bucket)
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), root)
+                if key.startswith(Prefix):
+                    keys.append(key)
+        return {'Contents': [{'Key': key, 'Size': os.path.getsize(
+            self.path(Bucket, key))} for key in sorted(keys)],
+            'IsTruncated': False}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        uploadId = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, '.uploads', uploadId))
+        return {'UploadId': uploadId}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.verify(Body, 'UploadPart', **kwargs)
+        path = os.path.join(self.root, '.uploads', UploadId, str(PartNumber))
+        with open(path, 'wb') as fh:
+            fh.write(Body)
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+        MultipartUpload):
+        parts = os.path.join(self.root, '.uploads', UploadId)
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            for part in MultipartUpload['Parts']:
+                with open(os.path.join(parts, str(part['PartNumber'])),
+                    'rb') as fh_part:
+                    shutil.copyfileobj(fh_part, fh)
+        shutil.rmtree(parts)
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(os.path.join(self.root, '.uploads', UploadId),
+            ignore_errors=True)
+
+### EOF
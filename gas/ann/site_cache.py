@@ -0,0 +1,277 @@
+# site_cache.py
+#
+# Node-local cache of whole-record annotations, shared by all jobs and
+# users of an annotator node. A sqlite file maps a site (chromosome,
+# position, ref, alt) and the digest of the stage and reference table
+# versions (see stage_versions.py) to what the whole pipeline did to the
+# record: its ID column, the runs of its INFO column per stage, whether
+# the gadAll stage indented the columns, and how much each stage's log
+# counters grew. The fused pipeline looks up each window before any stage
+# runs; records found there skip every stage, and the records annotated
+# from scratch are stored afterwards.
+#
+# Besides the site, the stages read the ID column (which the dbSNP stage
+# may keep) and, of the INFO column, whether it is '.', whether it ends in
+# ';' and its positionType, so those are part of the key too. Records
+# whose INFO column is rebuilt from text (see pipeline.needsReparse) are
+# not cached. Once the file holds more
+# than its size limit, the least recently used sites are dropped.
+#
+##
+
+import os
+import json
+import time
+import sqlite3
+
+import vcf
+import stage_versions
+
+# counters of the lookups a record took rather than of the record; a
+# cached record takes none
+WORK_COUNTERS = ('cache_hits', 'cache_misses', 'filter_skips',
+    'filter_hits', 'filter_false')
+# share of the sites dropped at once when the file is over its limit
+EVICT_SHARE = 0.1
+# sqlite host parameters per query
+CHUNK = 500
+
+"""sqlite store of the cached sites, key: JSON value, with the time each
+   was last used
+"""
+class SiteCache(object):
+
+    def __init__(self, path, maxbytes):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sites " +
+            "(key TEXT PRIMARY KEY, value TEXT, used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sites_used " +
+            "ON sites (used)")
+        self.conn.commit()
+
+    """Values of the cached keys among keys, by key; marks them used
+    """
+    def get(self, keys):
+        found = {}
+        for i in range(0, len(keys), CHUNK):
+            chunk = keys[i:i + CHUNK]
+            cursor = self.conn.execute("SELECT key, value FROM sites " +
+                "WHERE key IN (" + ','.join(['?'] * len(chunk)) + ")", chunk)
+            found.update([(key, json.loads(value)) for key, value in cursor])
+        self.hits = self.hits + len(found)
+        self.misses = self.misses + len(keys) - len(found)
+        if (len(found) > 0):
+            now = time.time()
+            self.conn.executemany("UPDATE sites SET used = ? WHERE key = ?",
+                [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    """Stores the key, value pairs of entries, then evicts down to the
+       size limit
+    """
+    def put(self, entries):
+        if (len(entries) == 0):
+            return
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO sites VALUES (?, ?, ?)",
+            [(key, json.dumps(value), now) for key, value in entries])
+        self.conn.commit()
+        self.evict()
+
+    """Bytes of the file in use (freed pages are reused, not returned)
+    """
+    def size(self):
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pagesize = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (pages - free) * pagesize
+
+    """Drops the least recently used sites while the file is over its limit
+    """
+    def evict(self):
+        while (self.size() > self.maxbytes):
+            count = self.conn.execute("SELECT COUNT(*) FROM sites").fetchone()[0]
+            if (count == 0):
+                return
+            self.conn.execute("DELETE FROM sites WHERE key IN (SELECT key " +
+                "FROM sites ORDER BY used LIMIT ?)",
+                (max(int(count * EVICT_SHARE), 1),))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+"""Key part of what the stages read from the INFO column of fields, or
+   None if the record cannot be cached
+"""
+def infoContext(fields):
+    text = str(fields[7])
+    if text.startswith('.') and (text != '.'):
+        # the dbSNP stage drops a leading '.', which would cut into the
+        # input's run
+        return None
+    positionType = '.'
+    if 'positionType' in text:
+        positionType = vcf.Info(text).get('positionType')
+    return '|'.join([str(len(fields)), str(text == '.'),
+        str(text.endswith(';')), positionType])
+
+
+"""Looks up and stores the records of one pipeline in a SiteCache
+"""
+class SiteAnnotator(object):
+
+    def __init__(self, cache, stages, versions):
+        self.cache = cache
+        self.stages = stages
+        self.version = stage_versions.digest(stages, versions)
+        # per record id of the window to store: key, input fields, Info,
+        # counter growth per stage
+        self.pending = {}
+        self.before = None
+
+    def isData(self, record):
+        return not self.stages[0].isHeader(record.head())
+
+    def key(self, fields):
+        if (len(fields) < 8) or fields[0].startswith('#'):
+            return None
+        context = infoContext(fields)
+        if context is None:
+            return None
+        return '\t'.join([self.version] + fields[:5] + [context])
+
+    """Annotates the cached records of a window and returns their ids;
+       the others are wrapped to be stored once the stages ran
+    """
+    def begin(self, records):
+        self.pending = {}
+        keys = {}
+        for record in records:
+            if self.isData(record):
+                key = self.key(record.split(self.stages[0].sep))
+                if key is not None:
+                    keys[id(record)] = key
+        found = self.cache.get(list(set(keys.values())))
+
+        served = set()
+        for record in records:
+            key = keys.get(id(record))
+            if key is None:
+                continue
+            if key in found:
+                self.apply(record, found[key])
+                served.add(id(record))
+            else:
+                fields = record.split(self.stages[0].sep)
+                self.pending[id(record)] = (key, [str(f) for f in fields],
+                    vcf.info(fields), {})
+        return served
+
+    """Turns record into its cached annotation
+    """
+    def apply(self, record, value):
+        fields = record.split(self.stages[0].sep)
+        text = str(fields[7])
+        out = [fields[0]] + [(' ' + f) if value['indent'] else f
+            for f in fields[1:]]
+        out[2] = value['id']
+        info = vcf.Info('')
+        for owner, piece in value['runs']:
+            info.owner = owner
+            info.push(text if owner is None else piece)
+        info.owner = None
+        if value['added']:
+            info.added = set(value['added'])
+        out[7] = info
+        record.update(out)
+        for k, counts in value['counts'].items():
+            self.stages[int(k)].addCounts(counts)
+
+    """Tokens added from now on belong to stage k
+    """
+    def stage(self, k):
+        for entry in self.pending.values():
+            entry[2].owner = k
+
+    def beginRecord(self, stage, record):
+        self.before = None
+        if id(record) in self.pending:
+            self.before = stage.counts()
+
+    def endRecord(self, k, stage, record):
+        if self.before is None:
+            return
+        counts = dict([(c, value - self.before[c]) for c, value in
+            stage.counts().items()
+            if (c not in WORK_COUNTERS) and (value != self.before[c])])
+        if (len(counts) > 0):
+            self.pending[id(record)][3][k] = counts
+        self.before = None
+
+    """Stores the annotated records of a window
+    """
+    def end(self, records):
+        entries = []
+        for record in records:
+            entry = self.pending.get(id(record))
+            if entry is None:
+                continue
+            value = self.value(record, *entry[1:])
+            if value is not None:
+                entries.append((entry[0], value))
+        self.pending = {}
+        self.cache.put(entries)
+
+    """Cache value of record annotated from fields (as read), or None if it
+       cannot be rebuilt from them
+    """
+    def value(self, record, fields, info, counts):
+        out = record.split(self.stages[0].sep)
+        if (len(out) != len(fields)) or (out[7] is not info):
+            return None
+        indent = (len(out[1]) == len(fields[1]) + 1)
+        runs = []
+        start = 0
+        text = info.text()
+        for owner, length in info.runs():
+            runs.append([owner, text[start:start + length]])
+            start = start + length
+        inputs = [piece for owner, piece in runs if owner is None]
+        if (len(inputs) > 1) or (len(inputs) == 1 and inputs[0] != fields[7]):
+            return None
+        return {'id': out[2], 'indent': indent, 'runs': [[owner, None]
+            if owner is None else [owner, piece] for owner, piece in runs],
+            'added': sorted(info.added or []), 'counts': counts}
+
+
+_config = None
+_shared = None
+_shared_pid = None
+
+"""The node's cache; path configures it (a blank path disables it), bounded
+   to maxmb. Returns None while disabled
+"""
+def shared(path=None, maxmb=None):
+    global _config, _shared, _shared_pid
+
+    if path is not None:
+        _config = (path, int(maxmb * 1024 * 1024)) if path else None
+        _shared = None
+    if _config is None:
+        return None
+    if (_shared is None) or (_shared_pid != os.getpid()):
+        # sqlite connections do not survive a fork
+        _shared = SiteCache(*_config)
+        _shared_pid = os.getpid()
+    return _shared
+
+### EOF
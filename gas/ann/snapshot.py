@@ -0,0 +1,477 @@
+# snapshot.py
+#
+# Columnar snapshots of the annotator reference tables, so a node can
+# annotate without reaching the database (see driver.getStages).
+#
+# Each table is exported once (see the __main__ block below) into its own
+# directory with a schema.json (chrom, start and end columns, column names
+# and chromosomes) and, for every chromosome, a directory <chrom>/ with
+# the rows sorted by start:
+#   start.npy, end.npy, maxend.npy  interval coordinates, running maximum
+#                                   of end
+#   rank.npy, place.npy             table row number of each sorted row,
+#                                   and the sorted place of each table row
+#   columns.json                    how each column is stored
+#   <i>.npy                         integer column i in the narrowest dtype
+#                                   that holds it, or a float column
+#   <i>.codes.npy, <i>.dict.json    dictionary-encoded string column
+#   <i>.offset.npy, <i>.data        any other string or bytes column
+#   <i>.null.npy                    where column i is NULL, if it ever is
+#
+# Narrow integers and dictionary codes keep the files small while leaving
+# them memory-mappable. A column is only mapped when it is first read, so a
+# lookup touches the columns it reads and the rows near its positions.
+# Snapshot answers the calls of interval_index.IntervalIndex (and its
+# partitions those of interval_index.Partition), so the overlap stages and
+# sweep_join.py read either; matchMany() adds the equality lookups of the
+# dbSNP and chrom_pos_* tables.
+#
+# Usage: python snapshot.py <snapshot dir> [table ...]
+##
+
+import os
+import sys
+import json
+import mmap
+from array import array
+
+import numpy as np
+
+import interval_index
+from interval_index import groupRanks
+
+"""Tables as in interval_index.TABLES, plus the ones the dbSNP and
+   BigRefGene stages look variants up in
+"""
+TABLES = dict(interval_index.TABLES)
+TABLES.update({
+    'dbSNP': (None, 'CHR', 'POS', 'POS', '*'),
+    'chrom_pos_equal_base': (None, 'CHR', 'start', 'end', '*'),
+    'chrom_pos_equal_nobase': (None, 'CHR', 'start', 'end', '*'),
+    'chrom_pos_unequal': (None, 'CHR', 'start', 'end', '*'),
+})
+
+# distinct values up to which a string column is dictionary-encoded
+MAX_DICT = 65536
+
+COLUMNS = ['start', 'end', 'maxend', 'rank', 'place']
+
+
+"""Storage kind of a column value: int, float, str or bytes; anything else
+   (e.g. DECIMAL) is stored as its str()
+"""
+def valueKind(value):
+    if isinstance(value, (bool, int)):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    return 'str'
+
+
+"""Narrowest integer dtype holding all of values
+"""
+def narrowInt(values):
+    if (len(values) == 0):
+        return np.int8
+    lo = int(values.min())
+    hi = int(values.max())
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32,
+        np.int32):
+        if (np.iinfo(dtype).min <= lo) and (hi <= np.iinfo(dtype).max):
+            return dtype
+    return np.int64
+
+
+"""Values of one column of a partition while it is exported
+"""
+class ColumnBuilder(object):
+
+    def __init__(self):
+        self.kind = None
+        self.count = 0
+        self.nulls = bytearray()
+        # int/float values, string codes or offsets into data
+        self.values = None
+        self.dict = None
+        self.words = None
+        self.data = None
+
+    def append(self, value):
+        if value is None:
+            self.nulls.append(1)
+            self.count = self.count + 1
+            if self.kind is not None:
+                self.appendValue(self.emptyValue())
+            return
+
+        kind = valueKind(value)
+        if self.kind is None:
+            self.start(kind)
+        elif (kind != self.kind):
+            if ({kind, self.kind} == {'int', 'float'}):
+                kind = 'float'
+            else:
+                kind = 'str'
+            if (kind != self.kind):
+                self.convert(kind)
+        if (self.kind == 'float'):
+            value = float(value)
+        elif (self.kind == 'str') and not isinstance(value, str):
+            value = str(value)
+
+        self.nulls.append(0)
+        self.count = self.count + 1
+        self.appendValue(value)
+
+    """Starts storing values of kind, after the NULLs seen so far
+    """
+    def start(self, kind):
+        self.kind = kind
+        if (kind == 'int'):
+            self.values = array('q')
+        elif (kind == 'float'):
+            self.values = array('d')
+        elif (kind == 'str'):
+            self.values = array('q')
+            self.dict = {}
+            self.words = []
+        else:
+            self.values = array('q', [0])
+            self.data = bytearray()
+        for i in range(self.count):
+            self.appendValue(self.emptyValue())
+
+    def emptyValue(self):
+        return {'int': 0, 'float': 0.0, 'str': None, 'bytes': b''}[self.kind]
+
+    def appendValue(self, value):
+        if (self.data is not None):
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            self.data.extend(value or b'')
+            self.values.append(len(self.data))
+        elif (self.dict is not None):
+            if value is None:
+                self.values.append(-1)
+                return
+            if value not in self.dict:
+                if (len(self.dict) >= MAX_DICT):
+                    self.undict()
+                    self.appendValue(value)
+                    return
+                self.dict[value] = len(self.words)
+                self.words.append(value)
+            self.values.append(self.dict[value])
+        else:
+            self.values.append(value)
+
+    """Value of row i as it will be read back
+    """
+    def get(self, i):
+        if self.nulls[i]:
+            return None
+        if (self.data is not None):
+            value = bytes(self.data[self.values[i]:self.values[i + 1]])
+            return value.decode('utf-8') if (self.kind == 'str') else value
+        if (self.dict is not None):
+            return self.words[self.values[i]]
+        return self.values[i]
+
+    """Switches a string column from codes to offsets into data
+    """
+    def undict(self):
+        words = self.words
+        codes = self.values
+        self.dict = self.words = None
+        self.values = array('q', [0])
+        self.data = bytearray()
+        for code in codes:
+            self.appendValue('' if (code < 0) else words[code])
+
+    """Re-stores the values so far as kind
+    """
+    def convert(self, kind):
+        values = [self.get(i) for i in range(self.count)]
+        if (kind == 'str'):
+            values = [v if (v is None) or isinstance(v, str) else str(v)
+                for v in values]
+        self.count = 0
+        self.nulls = bytearray()
+        self.values = self.dict = self.words = self.data = None
+        self.start(kind)
+        for value in values:
+            self.append(value)
+
+    """Writes the column in the sorted order of the rows (order[i] is the
+       table row of sorted row i), returns its storage in columns.json
+    """
+    def save(self, path, order):
+        spec = {'kind': self.kind or 'null', 'nulls': False}
+        nulls = np.frombuffer(bytes(self.nulls), dtype=np.uint8)[order]
+        if (self.kind is not None) and nulls.any():
+            np.save(path + '.null.npy', nulls.astype(bool))
+            spec['nulls'] = True
+
+        if (self.kind is None):
+            spec['encoding'] = 'null'
+        elif (self.data is not None):
+            offset = np.frombuffer(self.values, dtype=np.int64)
+            with open(path + '.data', 'wb') as fh:
+                for i in order.tolist():
+                    fh.write(self.data[offset[i]:offset[i + 1]])
+            lengths = (offset[1:] - offset[:-1])[order]
+            np.save(path + '.offset.npy', np.concatenate([[0],
+                np.cumsum(lengths)]).astype(np.int64))
+            spec['encoding'] = 'offset'
+        elif (self.dict is not None):
+            codes = np.frombuffer(self.values, dtype=np.int64)[order]
+            np.save(path + '.codes.npy', codes.astype(narrowInt(
+                np.array([-1, len(self.dict)]))))
+            with open(path + '.dict.json', 'w') as fh:
+                json.dump(self.words, fh)
+            spec['encoding'] = 'dict'
+        elif (self.kind == 'int'):
+            values = np.frombuffer(self.values, dtype=np.int64)[order]
+            np.save(path + '.npy', values.astype(narrowInt(values)))
+            spec['encoding'] = 'array'
+        else:
+            np.save(path + '.npy', np.frombuffer(self.values,
+                dtype=np.float64)[order])
+            spec['encoding'] = 'array'
+        return spec
+
+
+"""One stored column of a partition, see ColumnBuilder.save()
+"""
+class Column(object):
+
+    def __init__(self, path, spec):
+        self.kind = spec['kind']
+        self.encoding = spec['encoding']
+        self.nulls = None
+        self.fh = None
+        self.data = b''
+        if spec['nulls']:
+            self.nulls = np.load(path + '.null.npy', mmap_mode='r')
+
+        if (self.encoding == 'array'):
+            self.values = np.load(path + '.npy', mmap_mode='r')
+        elif (self.encoding == 'dict'):
+            self.codes = np.load(path + '.codes.npy', mmap_mode='r')
+            with open(path + '.dict.json') as fh:
+                self.words = json.load(fh)
+        elif (self.encoding == 'offset'):
+            self.offset = np.load(path + '.offset.npy', mmap_mode='r')
+            self.fh = open(path + '.data', 'rb')
+            if (os.path.getsize(path + '.data') > 0):
+                self.data = mmap.mmap(self.fh.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+
+    """Value of sorted row i
+    """
+    def get(self, i):
+        if (self.encoding == 'null') or \
+            ((self.nulls is not None) and self.nulls[i]):
+            return None
+        if (self.encoding == 'dict'):
+            code = int(self.codes[i])
+            return None if (code < 0) else self.words[code]
+        if (self.encoding == 'offset'):
+            value = self.data[int(self.offset[i]):int(self.offset[i + 1])]
+            return value.decode('utf-8') if (self.kind == 'str') else value
+        if (self.kind == 'int'):
+            return int(self.values[i])
+        return float(self.values[i])
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self.fh is not None:
+            self.fh.close()
+
+
+"""Rows of one chromosome, sorted by start; columns are opened on first use
+"""
+class Partition(interval_index.Partition):
+
+    def __init__(self, path, names):
+        for c in COLUMNS:
+            setattr(self, c, np.load(os.path.join(path, c + '.npy'),
+                mmap_mode='r'))
+        with open(os.path.join(path, 'columns.json')) as fh:
+            self.specs = json.load(fh)
+        self.path = path
+        # column names as in MySQL, i.e. case-insensitive
+        self.names = dict([(n.lower(), i) for i, n in enumerate(names)])
+        self.columns = {}
+
+    def column(self, name):
+        i = name if isinstance(name, int) else self.names[name.lower()]
+        if i not in self.columns:
+            self.columns[i] = Column(os.path.join(self.path, str(i)),
+                self.specs[i])
+        return self.columns[i]
+
+    """Value of column name in row rank (table order)
+    """
+    def value(self, rank, name):
+        return self.column(name).get(int(self.place[rank]))
+
+    def row(self, rank):
+        i = int(self.place[rank])
+        return tuple([self.column(c).get(i) for c in range(len(self.specs))])
+
+    """Row numbers of the rows starting at each of positions, in table
+       order
+    """
+    def atMany(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        lo = np.searchsorted(self.start, positions, side='left')
+        hi = np.searchsorted(self.start, positions, side='right')
+
+        counts = hi - lo
+        variant_idx = np.repeat(np.arange(len(positions)), counts)
+        first = np.cumsum(counts) - counts
+        idx = np.arange(int(counts.sum())) - np.repeat(first - lo, counts)
+        return groupRanks(len(positions), variant_idx,
+            np.asarray(self.rank)[idx])
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        self.columns = {}
+
+
+"""Snapshot of one table, partitions are opened on first use
+"""
+class Snapshot(interval_index.IntervalIndex):
+
+    def __init__(self, snapdir, table):
+        self.path = os.path.join(snapdir, table)
+        if not exists(snapdir, table):
+            raise IOError(f"No snapshot of {table} in {snapdir}")
+        with open(os.path.join(self.path, 'schema.json')) as fh:
+            self.schema = json.load(fh)
+        self.table = table
+        self.partitions = {}
+
+    def partition(self, chrom):
+        if chrom not in self.partitions:
+            self.partitions[chrom] = None
+            if chrom in self.schema['chroms']:
+                self.partitions[chrom] = Partition(os.path.join(self.path,
+                    chrom), self.schema['columns'])
+        return self.partitions[chrom]
+
+    """Rows starting at each of positions, as an equality query on the
+       start column gives them. With columns, only rows whose values of
+       those columns are among accept[i] (a set of tuples) are returned
+       for position i; other columns are only read for the matching rows.
+    """
+    def matchMany(self, chrom, positions, columns=(), accept=None):
+        part = self.partition(chrom)
+        if part is None:
+            return [[] for p in positions]
+
+        found = []
+        for i, ranks in enumerate(part.atMany(positions)):
+            if (len(columns) > 0):
+                ranks = [r for r in ranks if tuple([part.value(r, c)
+                    for c in columns]) in accept[i]]
+            found.append([part.row(r) for r in ranks])
+        return found
+
+
+def exists(snapdir, table):
+    return os.path.exists(os.path.join(snapdir, table, 'schema.json'))
+
+
+"""Writes the rows of one chromosome; starts/ends are in table order
+"""
+def savePartition(path, starts, ends, builders):
+    os.makedirs(path, exist_ok=True)
+    start = np.frombuffer(starts, dtype=np.int64)
+    end = np.frombuffer(ends, dtype=np.int64)
+    rank = np.argsort(start, kind='stable')
+    place = np.empty(len(rank), dtype=np.int64)
+    place[rank] = np.arange(len(rank))
+
+    np.save(os.path.join(path, 'start.npy'), start[rank])
+    np.save(os.path.join(path, 'end.npy'), end[rank])
+    np.save(os.path.join(path, 'maxend.npy'), np.maximum.accumulate(
+        end[rank]) if (len(rank) > 0) else end)
+    np.save(os.path.join(path, 'rank.npy'), rank.astype(np.int64))
+    np.save(os.path.join(path, 'place.npy'), place)
+
+    specs = [b.save(os.path.join(path, str(i)), rank)
+        for i, b in enumerate(builders)]
+    with open(os.path.join(path, 'columns.json'), 'w') as fh:
+        json.dump(specs, fh)
+
+
+"""Exports one table into its snapshot, one chromosome at a time (each
+   streamed with an unbuffered cursor); schema.json is written last, so a
+   snapshot is only used once it is complete
+"""
+def build(conn, snapdir, table):
+    import pymysql.cursors
+
+    sources, chromName, startName, endName, columns = TABLES[table]
+    select = 'select ' + chromName + ', ' + startName + ', ' + endName + \
+        ', ' + columns + ' from '
+    if sources is None:
+        cursor = conn.cursor()
+        cursor.execute('select distinct ' + chromName + ' from ' + table)
+        parts = [(str(row[0]), select + table + ' where ' + chromName +
+            ' = %s', (row[0],)) for row in cursor.fetchall()]
+        cursor.close()
+    else:
+        parts = [(chrom, select + source, None)
+            for chrom, source in sources.items()]
+
+    outdir = os.path.join(snapdir, table)
+    os.makedirs(outdir, exist_ok=True)
+
+    names = None
+    chroms = []
+    for chrom, sql, params in parts:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(sql, params)
+        names = [d[0] for d in cursor.description[3:]]
+        starts = array('q')
+        ends = array('q')
+        builders = [ColumnBuilder() for n in names]
+        for row in cursor:
+            starts.append(int(row[1]))
+            ends.append(int(row[2]))
+            for builder, value in zip(builders, row[3:]):
+                builder.append(value)
+        cursor.close()
+
+        if (len(starts) > 0):
+            savePartition(os.path.join(outdir, chrom), starts, ends,
+                builders)
+            chroms.append(chrom)
+
+    with open(os.path.join(outdir, 'schema.json'), 'w') as fh:
+        json.dump({'table': table, 'chrom': chromName, 'start': startName,
+            'end': endName, 'columns': names or [], 'chroms': chroms}, fh)
+    print(f"{table}: {len(chroms)} chromosomes")
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) < 2:
+        print("Usage: python snapshot.py <snapshot dir> [table ...]")
+        sys.exit(1)
+
+    tables = sys.argv[2:] if (len(sys.argv) > 2) else list(TABLES)
+    conn = u.db_connect()
+    for table in tables:
+        build(conn, sys.argv[1], table)
+    conn.close()
+
+### EOF
@@ -0,0 +1,442 @@
+# stage_versions.py
+#
+# Stage versions and incremental re-annotation. With reference versions
+# configured (a JSON file of table: version), the fused pipeline adds an
+# ##ANN_STAGE line per stage to the VCF header, with the code version of
+# the stage and the versions of its reference tables, and writes a
+# sidecar next to the .count.log (<base>.stages): a JSON summary line with
+# the versions, a hash of the INFO tokens of each stage and its log
+# counters, then one line per record with the runs of the INFO column
+# each stage wrote ("stage:length", '.' for the input). The hashes are
+# only known once the whole file is written, so they are kept in the
+# sidecar rather than in the header.
+#
+# reannotateFile() compares the versions of an annotated file with the
+# current ones and recomputes only the stages that are out of date: their
+# runs are cut out of every record and the stage is run again on the
+# INFO column as it saw it. Stages that do more than append to INFO
+# (annotate.Stage.spliceable) cannot be recomputed on their own; if one
+# of them is out of date, the file needs a full run.
+#
+##
+
+import os
+import json
+import shutil
+import hashlib
+
+import utils as u
+import annotate as ann
+import vcf
+import bgzf
+
+HEADER = '##ANN_STAGE='
+
+# results of reannotateFile()
+CURRENT = 'current'
+UPDATED = 'updated'
+RERUN = 'rerun'
+
+"""A stage's new tokens cannot be put back into the record as they are
+"""
+class SpliceError(Exception):
+    pass
+
+
+"""Reference table versions from JSON file path ({table: version}), or
+   None (no versions recorded) if path is empty
+"""
+def loadVersions(path):
+    if not path:
+        return None
+    with open(path) as fh:
+        return dict([(table, str(version)) for table, version in
+            json.load(fh).items()])
+
+
+"""Version of a stage: its code version and the versions of its tables
+"""
+def stageVersion(stage, versions):
+    return ','.join([str(stage.version)] + [table + ':' +
+        versions.get(table, '') for table in stage.referenceTables()])
+
+
+"""Short digest of the versions of all stages
+"""
+def digest(stages, versions):
+    text = json.dumps([[stage.__class__.__name__, stageVersion(stage,
+        versions)] for stage in stages])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def headerLines(stages, versions):
+    return [f'{HEADER}<ID={k},Stage={stage.__class__.__name__},' +
+        f'Version="{stageVersion(stage, versions)}">'
+        for k, stage in enumerate(stages)]
+
+
+"""Hash of the tokens text a stage added to the record with fields
+"""
+def tokenHash(fields, text):
+    key = '\t'.join([f.strip() for f in fields[:5]]) + '\t' + text
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'),
+        digest_size=8).digest(), 'big')
+
+
+def encodeRuns(runs):
+    return ' '.join([('.' if owner is None else str(owner)) + ':' +
+        str(len(text)) for owner, text in runs])
+
+
+"""[owner, text] runs of the INFO column of fields from a sidecar line, or
+   None for a record without an INFO column
+"""
+def decodeRuns(line, fields):
+    line = line.rstrip('\n')
+    if (line == '-'):
+        return None
+    if (line == '?') or (len(fields) < 8):
+        raise SpliceError("Record without stage runs")
+    info = fields[7]
+    runs = []
+    start = 0
+    for run in line.split():
+        owner, length = run.split(':')
+        end = start + int(length)
+        runs.append([None if (owner == '.') else int(owner),
+            info[start:end]])
+        start = end
+    if (start != len(info)):
+        raise SpliceError("Stage runs do not match the INFO column")
+    return runs
+
+
+"""Summary line of sidecar path
+"""
+def readSummary(path):
+    with open(path) as fh:
+        return json.loads(fh.readline())
+
+
+"""Summary line of a sidecar for stages
+"""
+def summarize(stages, versions, hashes, adders, records, unknown):
+    return {
+        'stages': [{
+            'id': k,
+            'stage': stage.__class__.__name__,
+            'version': stageVersion(stage, versions),
+            'hash': f'{hashes[k]:016x}',
+            'adds': k in adders,
+            'counts': stage.counts(),
+        } for k, stage in enumerate(stages)],
+        'records': records,
+        'unknown': unknown,
+    }
+
+
+"""Writes sidecar path: summary, then the run lines of spanfiles in order
+   (sidecars themselves if sidecars is set)
+"""
+def writeSidecar(path, summary, spanfiles, sidecars=False):
+    with open(path, 'w') as fh:
+        fh.write(json.dumps(summary) + '\n')
+        for spanfile in spanfiles:
+            with open(spanfile) as fh_spans:
+                if sidecars:
+                    fh_spans.readline()
+                shutil.copyfileobj(fh_spans, fh)
+
+
+"""Records which stage wrote which part of the INFO column of each record
+   going through a pipeline, and writes them to sidecar path
+"""
+class StageTracker(object):
+
+    def __init__(self, stages, versions, path):
+        self.stages = stages
+        self.versions = versions
+        self.path = path
+        self.fh = open(path + '.spans', 'w')
+        self.hashes = [0] * len(stages)
+        # stages that appended with Info.add(), which leaves out the ';'
+        # after one
+        self.adders = set()
+        self.records = 0
+        self.unknown = 0
+        # Info of each data record of the window, by record id
+        self.infos = {}
+
+    def isData(self, record):
+        return not self.stages[0].isHeader(record.head())
+
+    """Window without the stage lines of an earlier annotation, with the
+       current ones before the column header
+    """
+    def header(self, records):
+        out = []
+        for record in records:
+            head = record.head()
+            if head.startswith(HEADER):
+                continue
+            if head.startswith('#CHROM'):
+                out.extend([vcf.VcfRecord(line) for line in
+                    headerLines(self.stages, self.versions)])
+            out.append(record)
+        return out
+
+    """Wraps the INFO columns of a window before the first stage
+    """
+    def begin(self, records):
+        self.infos = {}
+        for record in records:
+            if self.isData(record):
+                fields = record.split(self.stages[0].sep)
+                if (len(fields) > 7):
+                    self.infos[id(record)] = vcf.info(fields)
+
+    """Tokens added from now on belong to stage k
+    """
+    def stage(self, k):
+        for info in self.infos.values():
+            info.owner = k
+
+    """Records the runs of the output records of a window; a record whose
+       INFO column had to be rebuilt from text has none
+    """
+    def end(self, records):
+        for record in records:
+            if not self.isData(record):
+                continue
+            info = self.infos.get(id(record))
+            fields = record.split(self.stages[0].sep)
+            if (len(fields) < 8):
+                self.record(fields, None)
+            elif (info is None) or (fields[7] is not info):
+                self.record(fields, False)
+            else:
+                if info.added is not None:
+                    self.adders.update(info.added)
+                runs = []
+                start = 0
+                for owner, length in info.runs():
+                    runs.append([owner, info.text()[start:start + length]])
+                    start = start + length
+                self.record(fields, runs)
+        self.infos = {}
+
+    """Writes the runs of one record: None without an INFO column, False if
+       they are not known
+    """
+    def record(self, fields, runs):
+        self.records = self.records + 1
+        if runs is None:
+            self.fh.write('-\n')
+            return
+        if runs is False:
+            self.unknown = self.unknown + 1
+            self.fh.write('?\n')
+            return
+
+        self.fh.write(encodeRuns(runs) + '\n')
+        texts = {}
+        for owner, text in runs:
+            if owner is not None:
+                texts[owner] = texts.get(owner, '') + text
+        for owner, text in texts.items():
+            self.hashes[owner] = (self.hashes[owner] +
+                tokenHash(fields, text)) % (1 << 64)
+
+    """Writes the sidecar with the current stage counters
+    """
+    def finish(self):
+        self.fh.close()
+        writeSidecar(self.path, summarize(self.stages, self.versions,
+            self.hashes, self.adders, self.records, self.unknown),
+            [self.path + '.spans'])
+        os.remove(self.path + '.spans')
+
+
+"""Writes sidecar path for stages from the sidecars of the shards of a
+   file (in order); the counters come from stages, which hold the totals
+"""
+def mergeSidecars(path, parts, stages, versions):
+    hashes = [0] * len(stages)
+    adders = set()
+    records = 0
+    unknown = 0
+    for part in parts:
+        summary = readSummary(part)
+        for k, stage in enumerate(summary['stages']):
+            hashes[k] = (hashes[k] + int(stage['hash'], 16)) % (1 << 64)
+            if stage['adds']:
+                adders.add(k)
+        records = records + summary['records']
+        unknown = unknown + summary['unknown']
+
+    writeSidecar(path, summarize(stages, versions, hashes, adders, records,
+        unknown), parts, sidecars=True)
+
+
+"""Stages of the sidecar summary whose version differs from the current
+   one; all of them if the stages themselves changed
+"""
+def staleStages(summary, stages, versions):
+    old = summary['stages']
+    if [s['stage'] for s in old] != [stage.__class__.__name__
+        for stage in stages]:
+        return list(range(len(stages)))
+    return [k for k, stage in enumerate(stages)
+        if old[k]['version'] != stageVersion(stage, versions)]
+
+
+"""Runs stage k again on the fields of one record, whose INFO column is
+   made of runs; returns the runs with the new tokens of the stage. The
+   stages in adders put their tokens in after a ';' only if the column did
+   not already end in one, so theirs are fixed up if that changed.
+"""
+def splice(stage, k, fields, runs, adders):
+    old = ''.join([text for owner, text in runs if owner == k])
+    runs = [run for run in runs if run[0] != k]
+    # the stage appended after the tokens of the input and earlier stages
+    at = 0
+    for i, (owner, text) in enumerate(runs):
+        if (owner is None) or (owner < k):
+            at = i + 1
+    prefix = ''.join([text for owner, text in runs[:at]])
+
+    info = vcf.Info(prefix)
+    info.owner = k
+    fields[7] = info
+    stage.annotate(fields)
+    if (len(fields) == 8):
+        # the end of the line, which the pipeline strips after each stage
+        info.rstrip()
+    if info.added is not None:
+        adders.update(info.added)
+
+    if (''.join([piece for piece, owner in zip(info.pieces, info.owners)
+        if owner != k]) != prefix):
+        raise SpliceError(f"{stage.__class__.__name__} changed the INFO " +
+            "column before its tokens")
+    text = ''.join([piece for piece, owner in zip(info.pieces, info.owners)
+        if owner == k])
+    if ('\t' in text) or ('\n' in text) or ('\r' in text):
+        raise SpliceError(f"{stage.__class__.__name__} tokens span columns")
+    if (len(text) > 0):
+        runs.insert(at, [k, text])
+        at = at + 1
+
+    # whether the text before each following run ends in ';', before and
+    # after the splice
+    before = (prefix + old).endswith(';')
+    after = (prefix + text).endswith(';')
+    while (at < len(runs)) and (before != after):
+        owner, text = runs[at]
+        if owner in adders:
+            tokens = text if before else text[1:]
+            runs[at] = [owner, tokens if after else ';' + tokens]
+        before = text.endswith(';')
+        after = runs[at][1].endswith(';') if runs[at][1] else after
+        if (len(runs[at][1]) == 0):
+            del runs[at]
+        else:
+            at = at + 1
+    return runs
+
+
+"""Recomputes the out-of-date stages of annotated file annotfile in place;
+   its sidecar and log are logbase + '.stages' and logbase + '.count.log'
+   and are rewritten with it. Returns (status, stale stages, stages whose
+   output changed), status one of CURRENT, UPDATED or RERUN (the file
+   needs a full run: no sidecar, or a stale stage cannot be spliced)
+"""
+def reannotateFile(annotfile, logbase, stages, versions, batchsize=0):
+    sidecar = logbase + '.stages'
+    if not os.path.exists(sidecar):
+        return RERUN, list(range(len(stages))), []
+    summary = readSummary(sidecar)
+    stale = staleStages(summary, stages, versions)
+    if (len(stale) == 0):
+        return CURRENT, stale, []
+    if (summary['unknown'] > 0) or (len(stale) == len(stages)) or \
+        not all([stages[k].spliceable for k in stale]):
+        return RERUN, stale, []
+
+    # counters of the current stages are as they were
+    for k, stage in enumerate(stages):
+        if k not in stale:
+            stage.begin(None)
+            for c, value in summary['stages'][k]['counts'].items():
+                setattr(stage, c, value)
+
+    conn = None
+    if not all([stages[k].isLocal() for k in stale]):
+        conn = u.db_pool().acquire()
+    for k in stale:
+        stages[k].begin(None if conn is None else conn.cursor())
+
+    tmp = annotfile + '.reannotate' + \
+        ('.gz' if bgzf.isGzip(annotfile) else '')
+    tracker = StageTracker(stages, versions, sidecar + '.reannotate')
+    tracker.adders = set([k for k, stage in enumerate(summary['stages'])
+        if stage['adds']])
+    fh = bgzf.openText(annotfile)
+    fh_spans = open(sidecar)
+    fh_spans.readline()
+    writer = vcf.VcfWriter(bgzf.openOutput(tmp))
+    try:
+        for records in vcf.readWindows(fh, batchsize):
+            records = tracker.header(records)
+            data = [record for record in records if tracker.isData(record)]
+            runs = [decodeRuns(fh_spans.readline(),
+                record.split(stages[0].sep)) for record in data]
+
+            for k in stale:
+                stage = stages[k]
+                todo = [i for i, record in enumerate(data)
+                    if (runs[i] is not None) and
+                    not stage.isHeader(record.head())]
+                if (batchsize > 0):
+                    stage.prefetch([data[i].fields for i in todo])
+                for i in todo:
+                    runs[i] = splice(stage, k, data[i].fields, runs[i],
+                        tracker.adders)
+
+            for record, record_runs in zip(data, runs):
+                if record_runs is not None:
+                    record.fields[7] = ''.join([text for owner, text in
+                        record_runs])
+                    record.update(record.fields)
+                tracker.record(record.fields, record_runs)
+            for record in records:
+                writer.write(record)
+
+        if (tracker.records != summary['records']) or fh_spans.readline():
+            raise SpliceError("Sidecar does not match the annotated file")
+    except SpliceError:
+        fh.close()
+        fh_spans.close()
+        writer.close()
+        tracker.fh.close()
+        for path in (tmp, tracker.path + '.spans'):
+            os.remove(path)
+        return RERUN, stale, []
+    finally:
+        if conn is not None:
+            u.db_pool().release(conn)
+
+    fh.close()
+    fh_spans.close()
+    writer.close()
+    tracker.finish()
+    os.replace(tmp, annotfile)
+    os.replace(tracker.path, sidecar)
+    for stage in stages:
+        ann.writeStageLog(stage, logbase)
+
+    changed = [k for k in stale if
+        summary['stages'][k]['hash'] != f'{tracker.hashes[k]:016x}']
+    return UPDATED, stale, changed
+
+### EOF
@@ -0,0 +1,114 @@
+# sweep_join.py
+#
+# Sweep-line merge join of sorted variants against the sorted intervals of
+# an interval index (see interval_index.py). For each chromosome the join
+# keeps a cursor into the start-sorted intervals and the set of intervals
+# that can still overlap a later variant; a window of variants is joined
+# against those and the intervals starting within the window only, and
+# intervals ending before the window's last variant are dropped. Over a
+# sorted file every interval enters and leaves the active set once, so a
+# table is read in one linear pass per chromosome, with memory for the
+# active intervals (and their decoded rows) only.
+#
+# Windows that are not in position order (unsorted input) fall back to
+# the index's own binary search, so results never depend on the order.
+#
+##
+
+import numpy as np
+
+from interval_index import joinPoints, groupRanks
+
+"""Sweep over the intervals of one interval_index.Partition, widened by pad
+"""
+class Sweep(object):
+
+    def __init__(self, part, pad=0):
+        self.part = part
+        self.pad = pad
+        # intervals before next have been seen; active ones may still match
+        self.next = 0
+        self.active = np.empty(0, dtype=np.int64)
+        self.activeStart = np.empty(0, dtype=np.int64)
+        self.activeEnd = np.empty(0, dtype=np.int64)
+        self.last = None
+        # decoded rows of the active intervals, by row number
+        self.rows = {}
+
+    """Row numbers for each of positions, as Partition.findMany() gives them
+    """
+    def findMany(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if (len(positions) == 0):
+            return []
+        if ((self.last is not None) and (positions[0] < self.last)) or \
+            np.any(positions[1:] < positions[:-1]):
+            return self.part.findMany(positions, pad=self.pad)
+        self.last = int(positions[-1])
+
+        # active intervals, then the ones starting up to the last variant;
+        # both are in start order
+        hi = max(int(np.searchsorted(self.part.start, self.last + self.pad,
+            side='right')), self.next)
+        candidates = np.concatenate([self.active,
+            np.arange(self.next, hi, dtype=np.int64)])
+        start = np.concatenate([self.activeStart, self.part.start[self.next:hi]])
+        end = np.concatenate([self.activeEnd, self.part.end[self.next:hi]])
+        self.next = hi
+
+        variant_idx, interval_idx = joinPoints(positions, start, end,
+            np.maximum.accumulate(end) if (len(end) > 0) else end,
+            pad=self.pad)
+        keep = end + self.pad >= self.last
+        self.active = candidates[keep]
+        self.activeStart = start[keep]
+        self.activeEnd = end[keep]
+
+        return groupRanks(len(positions), variant_idx,
+            np.asarray(self.part.rank)[candidates[interval_idx]],
+            start[interval_idx], end[interval_idx])
+
+    """Decoded rows of ranks; rows of intervals still active are kept for
+       the next window
+    """
+    def decode(self, found):
+        rows = self.rows
+        result = []
+        for ranks in found:
+            for r in ranks:
+                if r not in rows:
+                    rows[r] = self.part.row(r)
+            result.append([rows[r] for r in ranks])
+
+        active = np.asarray(self.part.rank)[self.active].tolist()
+        self.rows = dict([(r, rows[r]) for r in active if r in rows])
+        return result
+
+
+"""query()/queryMany() of an interval_index.IntervalIndex, answered with
+   one sweep per chromosome (and pad)
+"""
+class SweepJoin(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.table = index.table
+        self.sweeps = {}
+
+    def sweep(self, chrom, pad):
+        if (chrom, pad) not in self.sweeps:
+            part = self.index.partition(chrom)
+            self.sweeps[(chrom, pad)] = None if part is None \
+                else Sweep(part, pad)
+        return self.sweeps[(chrom, pad)]
+
+    def query(self, chrom, pos, pad=0):
+        return self.index.query(chrom, pos, pad=pad)
+
+    def queryMany(self, chrom, positions, pad=0):
+        sweep = self.sweep(chrom, pad)
+        if sweep is None:
+            return [[] for p in positions]
+        return sweep.decode(sweep.findMany(positions))
+
+### EOF
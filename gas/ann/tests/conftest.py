@@ -0,0 +1,329 @@
+# conftest.py
+#
+# Fixtures shared by the annotator tests: the modules of gas/ann on the
+# path, a small reference database in sqlite standing in for the MySQL
+# annotator database (utils.db_connect), and a VCF over its variants;
+# helpers to build the local tables from it and run the driver, and
+# random intervals with a brute-force overlap check for the index tests.
+#
+##
+
+import os
+import io
+import re
+import sys
+import json
+import random
+import sqlite3
+import contextlib
+from array import array
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import driver
+import interval_index
+import vcf_sort
+
+CHROMS = ['1', '2', 'X']
+LENGTH = 50000
+REFSEQ = ['CHR', 'start', 'end', 'haplotypeReference', 'haplotypeAlternate',
+    'name', 'name2', 'transcriptStrand', 'positionType', 'frame', 'mrnaCoord',
+    'codonCoord', 'spliceDist', 'referenceCodon', 'referenceAA',
+    'variantCodon', 'variantAA', 'changesAA', 'functionalClass',
+    'codingCoordStr', 'proteinCoordStr', 'inCodingRegion', 'spliceInfo',
+    'uorfChange']
+
+
+"""sqlite cursor taking the pymysql '%s' parameters
+"""
+class Cursor(object):
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+
+    def execute(self, sql, args=None):
+        # 'end' is a keyword in sqlite
+        sql = re.sub(r'<= end\b', '<= "end"', sql)
+        if args is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql.replace('%s', '?'), args)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursorclass=None):
+        return Cursor(self.conn)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+"""Writes a reference database with every table the stages read to path;
+   returns the variants it was built around
+"""
+def makeReference(path, nvar=400):
+    rand = random.Random(7)
+    conn = sqlite3.connect(path)
+    execute = conn.execute
+    # sqlite reads a double-quoted "X" (inline queries) as a column if
+    # there is one of that name
+    execute("create table dbSNP (CHR, POS, c2, ID, REF, ALT, c6, MAF, INFO)")
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        execute(f"create table {table} (id, " +
+            ', '.join([f'"{c}"' for c in REFSEQ]) + ")")
+    execute("create table refGene (bin, name, chrom, strand, txStart, " +
+        "txEnd, cdsStart, cdsEnd, exonCount, exonStarts BLOB, " +
+        "exonEnds BLOB, score, name2, cdsStartStat, cdsEndStat, exonFrames)")
+    execute("create table cpgIslandExt (chrom, chromStart, chromEnd, name)")
+    execute("create table cytoBand (chrom, chromStart, chromEnd, name, " +
+        "gieStain)")
+    execute("create table gadAll (id, chromosome, chromStart, name, chromEnd)")
+    execute("create table gwasCatalog (bin, chrom, chromStart, chromEnd, " +
+        "c4, pubmed, c6, c7, c8, c9, trait)")
+    execute("create table targetScanS (bin, chrom, chromStart, chromEnd, " +
+        "name)")
+    execute("create table hugo (bin, chrom, chromStart, chromEnd, a, sym, " +
+        "descr)")
+    for table in ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+        'conrad_Cnv']:
+        execute(f"create table {table} (bin, chrom, chromStart, chromEnd, " +
+            "name)")
+    execute("create table genomicSuperDups (bin, chrom, chromStart, " +
+        "chromEnd, name, score, strand, otherChrom, otherStart, otherEnd)")
+    for c in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+        execute(f"create table tfbsConsSites{c} (chrom, chromStart, " +
+            "chromEnd, name)")
+
+    def insert(table, values):
+        execute(f"insert into {table} values (" +
+            ', '.join(['?'] * len(values)) + ")", values)
+
+    def interval(width):
+        chrom = rand.choice(CHROMS)
+        start = rand.randint(1, LENGTH)
+        return chrom, start, start + rand.randint(0, width)
+
+    variants = [(rand.choice(CHROMS), rand.randint(1, LENGTH),
+        rand.choice('ACGT'), rand.choice('ACGT')) for i in range(nvar)]
+    for chrom, pos, ref, alt in rand.sample(variants, nvar // 3):
+        for k in range(rand.randint(1, 2)):
+            insert('dbSNP', (chrom, pos, 0, f'rs{rand.randint(1, 10**6)}',
+                rand.choice([ref, 'A']), alt, 0, rand.choice(['.', '0.12']),
+                rand.choice(['SNV', 'SNV', 'DIV'])))
+    def refseq(chrom, start, end, ref, alt):
+        return [0, chrom, start, end, ref, alt] + [rand.choice(['', '0',
+            f'NM_{rand.randint(1, 99)}', 'x y']) for c in REFSEQ[5:]]
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase']:
+        for chrom, pos, ref, alt in rand.sample(variants, nvar // 5):
+            for k in range(rand.randint(1, 3)):
+                insert(table, refseq(chrom, pos, pos, ref, alt))
+    for k in range(60):
+        insert('chrom_pos_unequal', refseq(*interval(2000), 'A', 'C'))
+    for k in range(40):
+        chrom, start, end = interval(20000)
+        end = end + 100
+        cdsStart = start + rand.randint(0, 50)
+        cdsEnd = rand.choice([cdsStart, end - rand.randint(0, 50)])
+        n = rand.randint(1, 6)
+        points = sorted(rand.sample(range(start, end), 2 * n))
+        insert('refGene', (0, f'NM_{k}', 'chr' + chrom, rand.choice('+-'),
+            start, end, cdsStart, cdsEnd, n,
+            (','.join([str(p) for p in points[0::2]]) + ',').encode(),
+            (','.join([str(p) for p in points[1::2]]) + ',').encode(), 0,
+            f'GENE{k % 15}', 'cmpl', 'cmpl', '0,'))
+    for k in range(60):
+        chrom, start, end = interval(3000)
+        insert('cpgIslandExt', ('chr' + chrom, start, end, f'CpG: {k}'))
+    for chrom in CHROMS:
+        for start in range(0, LENGTH, 10000):
+            insert('cytoBand', ('chr' + chrom, start, start + 10000,
+                rand.choice(['p11', 'p12', 'q21']), 'gneg'))
+    for k in range(80):
+        chrom, start, end = interval(5000)
+        insert('gadAll', (k, chrom, start, rand.choice(['DIS A', 'DIS B']),
+            end))
+    for chrom, pos, ref, alt in rand.sample(variants, 40):
+        insert('gwasCatalog', (0, 'chr' + chrom, pos - 1, pos, 0,
+            rand.randint(1, 999), 0, 0, 0, 0, rand.choice(['height', 'bmi'])))
+    for k in range(80):
+        chrom, start, end = interval(5000)
+        insert('targetScanS', (0, 'chr' + chrom, start, end, f'miR-{k}'))
+    for k in range(80):
+        chrom, start, end = interval(20000)
+        insert('hugo', (0, 'chr' + chrom, start, end, 0, f'SYM{k % 30}',
+            rand.choice(['desc', 'b'])))
+    for table in ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+        'conrad_Cnv']:
+        for k in range(50):
+            chrom, start, end = interval(5000)
+            insert(table, (0, 'chr' + chrom, start, end, 'n'))
+    for k in range(50):
+        chrom, start, end = interval(5000)
+        insert('genomicSuperDups', (0, 'chr' + chrom, start, end, 'n', 0, '+',
+            'chr9', k, k + 100))
+    for k in range(150):
+        chrom, start, end = interval(3000)
+        insert('tfbsConsSites' + chrom, ('chr' + chrom, start, end,
+            f'V$TF{k % 20}'))
+    conn.commit()
+    conn.close()
+    return variants
+
+
+"""Lines of a VCF over variants, in their order, with mixed chromosome
+   naming, INFO columns and sample columns
+"""
+def vcfLines(variants, seed=3):
+    rand = random.Random(seed)
+    lines = ['##fileformat=VCFv4.0', '##INFO=<ID=DB>',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1']
+    for chrom, pos, ref, alt in variants:
+        row = [rand.choice([chrom, 'chr' + chrom]), str(pos), '.', ref, alt,
+            '50', 'PASS', rand.choice(['.', 'DP=10', 'AF=0.5;']), 'GT', '0/1']
+        lines.append('\t'.join(row[:rand.choice([10, 10, 8])]))
+    return [line + '\n' for line in lines]
+
+
+@pytest.fixture(scope='session')
+def reference(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('reference') / 'annotator.db')
+    return path, makeReference(path)
+
+
+"""Stages read the reference database; a fresh connection pool per test
+"""
+@pytest.fixture
+def database(reference, monkeypatch):
+    monkeypatch.setattr(utils, 'db_connect',
+        lambda refresh=False: Connection(reference[0]))
+    monkeypatch.setattr(utils, '_db_pool', None)
+    return reference[0]
+
+
+@pytest.fixture
+def vcf_text(reference):
+    return ''.join(vcfLines(reference[1]))
+
+
+@pytest.fixture
+def sorted_vcf_text(vcf_text):
+    return ''.join(vcf_sort.sortedLines(iter(vcf_text.splitlines(True))))
+
+
+"""Local tables and exon models are loaded once per process; each test
+   builds its own
+"""
+@pytest.fixture
+def indexdir(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(driver, '_shared', {})
+    path = tmp_path / 'index'
+    path.mkdir()
+    return str(path)
+
+
+"""Builds tables with module.build (interval_index, snapshot or
+   position_filter) from the reference database into directory
+"""
+def buildLocal(module, database, directory, tables):
+    conn = Connection(database)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for table in tables:
+            module.build(conn, directory, table)
+    conn.close()
+
+
+"""Runs driver.run on a copy of vcf_text in the new directory; returns
+   the output and the log
+"""
+def runDriver(directory, vcf_text, **kwargs):
+    directory.mkdir()
+    infile = directory / 'in.vcf'
+    infile.write_text(vcf_text)
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver.run(str(infile), 'vcf', **kwargs)
+    return (directory / 'in.annot.vcf').read_bytes(), \
+        (directory / 'in.vcf.count.log').read_bytes()
+
+"""Starts and ends of count intervals in table order: short ones, long
+   ones spanning most of the range, and runs nested in each other
+"""
+def randomIntervals(count, length=2000, seed=5):
+    rand = random.Random(seed)
+    starts = []
+    ends = []
+    while (len(starts) < count):
+        kind = rand.random()
+        start = rand.randint(0, length)
+        if (kind < 0.6):
+            width = rand.randint(0, 30)
+        elif (kind < 0.7):
+            width = rand.randint(length // 2, length)
+        else:
+            # nested: each inside the one before
+            width = rand.randint(100, 400)
+            for k in range(rand.randint(2, 5)):
+                starts.append(start)
+                ends.append(start + width)
+                start = start + rand.randint(0, width // 4)
+                width = width // 2
+            continue
+        starts.append(start)
+        ends.append(start + width)
+    return starts[:count], ends[:count]
+
+
+"""Row numbers of the intervals within pad of pos, by start and end, then
+   in table order
+"""
+def bruteForce(starts, ends, pos, pad=0):
+    found = [r for r in range(len(starts))
+        if (starts[r] - pad <= pos <= ends[r] + pad)]
+    return sorted(found, key=lambda r: (starts[r], ends[r], r))
+
+
+"""Partition of intervals in table order, with each row holding its
+   number, written under tmp_path
+"""
+def makePartition(tmp_path, starts, ends):
+    path = str(tmp_path / 'part')
+    offsets = array('q', [0])
+    with open(path + '.rows', 'wb') as fh:
+        for r in range(len(starts)):
+            data = json.dumps([r]).encode('utf-8')
+            fh.write(data)
+            offsets.append(offsets[-1] + len(data))
+    interval_index.savePartition(path, array('q', starts), array('q', ends),
+        offsets)
+    return interval_index.Partition(path)
+
+### EOF
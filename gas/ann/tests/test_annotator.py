@@ -0,0 +1,203 @@
+# test_annotator.py
+#
+# Job launch and supervision of annotator.py against the local stand-ins
+# of aws_async.py and s3_stream.py
+#
+##
+
+import json
+import time
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+
+import aws_async
+import s3_stream
+import annotator
+
+BUCKET = 'gas-inputs'
+KEY = 'ucmpcs/user1/job1~in.vcf'
+
+
+"""SQS message stand-in recording deletes and visibility changes
+"""
+class Message(object):
+
+    def __init__(self, job_id='job1', key=KEY, fail=False):
+        self.body = json.dumps({'Message': json.dumps({
+            'job_id': job_id,
+            'input_file_name': 'in.vcf',
+            's3_inputs_bucket': BUCKET,
+            's3_key_input_file': key,
+        })})
+        self.fail = fail
+        self.deleted = False
+        self.extended = []
+
+    def delete(self):
+        if self.fail:
+            raise ClientError({'Error': {'Code': 'ReceiptHandleIsInvalid'}},
+                'DeleteMessage')
+        self.deleted = True
+
+    def change_visibility(self, VisibilityTimeout):
+        self.extended.append(VisibilityTimeout)
+
+
+class Process(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.code = None
+
+    def poll(self):
+        return self.code
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    s3 = s3_stream.LocalS3(str(tmp_path / 's3'))
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=b'input')
+    table = aws_async.LocalTable()
+    table.update_item(Key={'job_id': 'job1'},
+        UpdateExpression='SET job_status = :s',
+        ExpressionAttributeValues={':s': 'PENDING'})
+    monkeypatch.setattr(annotator, 'aws', aws_async.AsyncAws(s3, table, None))
+    # job inputs go under the directory of annotator.py
+    monkeypatch.setattr(annotator, '__file__', str(tmp_path / 'annotator.py'))
+    monkeypatch.setitem(annotator.config['ann'], 'StreamS3', 'no')
+    # a missing input fails at once
+    monkeypatch.setattr(s3_stream, 'RETRIES', 1)
+    processes = []
+    monkeypatch.setattr(annotator.subprocess, 'Popen',
+        lambda args: processes.append(Process(args)) or processes[-1])
+    return table, processes, tmp_path / 'user1' / 'job1~in.vcf'
+
+
+def status(table, job_id='job1'):
+    return table.items[(('job_id', job_id),)]['job_status']
+
+
+def test_launch_job_claims_then_downloads(local):
+    table, processes, path = local
+    process = asyncio.run(annotator.launch_job(Message()))
+
+    assert status(table) == 'RUNNING'
+    assert path.read_bytes() == b'input'
+    assert processes == [process]
+    assert process.args[2:] == [str(path)]
+
+
+def test_launch_job_not_pending(local):
+    table, processes, path = local
+    table.items[(('job_id', 'job1'),)]['job_status'] = 'RUNNING'
+    # input of the job running on this node
+    path.parent.mkdir()
+    path.write_bytes(b'running')
+
+    with pytest.raises(annotator.JobTaken):
+        asyncio.run(annotator.launch_job(Message()))
+    assert path.read_bytes() == b'running'
+    assert processes == []
+
+
+def test_launch_job_failed_download_is_pending_again(local):
+    table, processes, path = local
+    with pytest.raises(ClientError):
+        asyncio.run(annotator.launch_job(Message(key='ucmpcs/user1/missing')))
+    assert status(table) == 'PENDING'
+    assert processes == []
+
+
+async def startAll(supervisor, messages):
+    await asyncio.gather(*[supervisor.start(m) for m in messages])
+
+
+def test_supervisor_drops_taken_request(local):
+    table, processes, path = local
+    supervisor = annotator.Supervisor(4, 300)
+    taken = Message(job_id='job2')
+    table.update_item(Key={'job_id': 'job2'},
+        UpdateExpression='SET job_status = :s',
+        ExpressionAttributeValues={':s': 'COMPLETED'})
+    failed = Message(key='ucmpcs/user1/missing')
+    failed.body = failed.body.replace('job1', 'job3')
+    table.update_item(Key={'job_id': 'job3'},
+        UpdateExpression='SET job_status = :s',
+        ExpressionAttributeValues={':s': 'PENDING'})
+    good = Message()
+
+    asyncio.run(startAll(supervisor, [taken, failed, good]))
+
+    # the taken request is gone, the failed one comes back from the queue
+    assert taken.deleted
+    assert not failed.deleted
+    assert status(table, 'job3') == 'PENDING'
+    assert [job['message'] for job in supervisor.jobs] == [good]
+    assert supervisor.free_slots() == 3
+
+
+def test_supervisor_reaps_finished_jobs(local):
+    table, processes, path = local
+    supervisor = annotator.Supervisor(4, 300)
+    message = Message()
+    asyncio.run(startAll(supervisor, [message]))
+
+    supervisor.jobs[0]['extended'] = time.time() - 200
+    asyncio.run(supervisor.reap())
+    assert message.extended == [300]
+    assert not message.deleted
+
+    processes[0].code = 0
+    asyncio.run(supervisor.reap())
+    assert message.deleted
+    assert supervisor.jobs == []
+
+
+def test_reap_survives_sqs_errors(local):
+    supervisor = annotator.Supervisor(4, 300)
+    message = Message(fail=True)
+    supervisor.jobs.append({'process': Process([]), 'message': message,
+        'extended': time.time()})
+    supervisor.jobs[0]['process'].code = 0
+
+    asyncio.run(supervisor.reap())
+    assert supervisor.jobs == []
+
+
+def test_download_does_not_hold_up_reaping(local, monkeypatch):
+    table, processes, path = local
+    release = None
+
+    async def slow_download(key, bucket, job_id, filename, username):
+        await release.wait()
+    monkeypatch.setattr(annotator, 's3_download_file', slow_download)
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        supervisor = annotator.Supervisor(4, 0.2)
+        running = Message(job_id='job0')
+        supervisor.jobs.append({'process': Process([]), 'message': running,
+            'extended': time.time()})
+        launching = Message()
+        task = supervisor.start(launching)
+        reaper = asyncio.create_task(supervisor.supervise(0.01))
+
+        await asyncio.sleep(0.5)
+        # both the running job and the one downloading its input kept
+        # their requests hidden meanwhile
+        assert len(running.extended) >= 2
+        assert len(launching.extended) >= 2
+        assert supervisor.jobs[1]['process'] is None
+
+        release.set()
+        await task
+        reaper.cancel()
+        return supervisor
+
+    supervisor = asyncio.run(scenario())
+    assert supervisor.jobs[1]['process'] is processes[0]
+
+### EOF
@@ -0,0 +1,42 @@
+# test_driver.py
+#
+# The pipelines of driver.run against the sqlite reference database: the
+# fused pipeline, batched or not, sharded over workers and with inline
+# queries, writes the same output and log as the original staged one
+#
+##
+
+import pytest
+
+from conftest import runDriver
+
+
+@pytest.fixture
+def staged(database, vcf_text, tmp_path):
+    return runDriver(tmp_path / 'staged', vcf_text, mode='staged')
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(mode='staged', batchsize=50),
+    dict(mode='fused'),
+    dict(mode='fused', batchsize=50),
+    dict(mode='fused', batchsize=7),
+    dict(mode='fused', batchsize=50, workers=2, shardsize=60),
+    dict(mode='fused', workers=3, shardsize=100),
+    dict(mode='fused', querystyle='inline'),
+    dict(mode='fused', batchsize=50, querystyle='inline'),
+    dict(mode='staged', batchsize=50, querystyle='inline'),
+], ids=lambda kwargs: '-'.join([f'{k}={v}' for k, v in kwargs.items()]))
+def test_matches_staged(staged, database, vcf_text, tmp_path, kwargs):
+    output, log = runDriver(tmp_path / 'run', vcf_text, **kwargs)
+    assert output == staged[0]
+    assert log == staged[1]
+
+
+def test_staged_output_is_annotated(staged):
+    output = staged[0].decode('utf-8')
+    for tag in ['\trs', 'DB;', 'cytoBand=', 'positionType=',
+        'HGNC_GeneAnnotation=', 'tfbsRegion=']:
+        assert tag in output
+
+### EOF
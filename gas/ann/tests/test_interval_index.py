@@ -0,0 +1,136 @@
+# test_interval_index.py
+#
+# Interval indexes (interval_index.py): the point join against a brute
+# force overlap check, indexes built from the sqlite reference database
+# giving the output of the database, and which local tables
+# driver.getStages picks up
+#
+##
+
+import os
+import random
+
+import numpy as np
+import pytest
+
+import interval_index
+import snapshot
+import driver
+from conftest import buildLocal, runDriver, randomIntervals, bruteForce, \
+    makePartition
+
+
+@pytest.mark.parametrize('pad', [0, 1, 25])
+def test_join_points(pad):
+    starts, ends = randomIntervals(300)
+    rank = np.argsort(np.asarray(starts), kind='stable')
+    start = np.asarray(starts)[rank]
+    end = np.asarray(ends)[rank]
+    positions = np.asarray(random.Random(pad).sample(range(-50, 2100), 400))
+
+    variant_idx, interval_idx = interval_index.joinPoints(positions, start,
+        end, np.maximum.accumulate(end), pad=pad)
+    found = interval_index.groupRanks(len(positions), variant_idx,
+        rank[interval_idx], start[interval_idx], end[interval_idx])
+
+    assert found == [bruteForce(starts, ends, int(pos), pad)
+        for pos in positions]
+
+
+def test_join_points_no_intervals():
+    empty = np.empty(0, dtype=np.int64)
+    variant_idx, interval_idx = interval_index.joinPoints([1, 2], empty,
+        empty, empty)
+    assert len(variant_idx) == 0
+    assert interval_index.groupRanks(2, variant_idx, empty) == [[], []]
+
+
+@pytest.mark.parametrize('pad', [0, 10])
+def test_partition(tmp_path, pad):
+    starts, ends = randomIntervals(200, seed=pad)
+    part = makePartition(tmp_path, starts, ends)
+    positions = list(range(-20, 2050, 7))
+
+    expected = [bruteForce(starts, ends, pos, pad) for pos in positions]
+    assert [part.find(pos, pad) for pos in positions] == expected
+    assert part.findMany(positions, pad) == expected
+    assert [part.row(r) for r in expected[100]] == \
+        [(r,) for r in expected[100]]
+    part.close()
+
+
+"""Table each overlap stage reads its index attribute from, by table
+"""
+def stageTables(indexdir):
+    found = {}
+    for label, stage in driver.getStages('vcf', indexdir):
+        for attr, table in stage.indexTables().items():
+            found[table] = type(getattr(stage, attr, None))
+    return found
+
+
+def test_complete_index_is_used(database, indexdir):
+    buildLocal(interval_index, database, indexdir,
+        ['cytoBand', 'tfbsConsSites'])
+    assert interval_index.exists(indexdir, 'cytoBand')
+    index = interval_index.IntervalIndex(indexdir, 'cytoBand')
+    assert index.chroms == {'chr1', 'chr2', 'chrX'}
+    assert index.partition('chr7') is None
+    # one source table per chromosome; empty ones have no partition
+    assert interval_index.IntervalIndex(indexdir, 'tfbsConsSites').chroms == \
+        {'1', '2', 'X'}
+
+    found = stageTables(indexdir)
+    assert found['cytoBand'] is interval_index.IntervalIndex
+    assert found['tfbsConsSites'] is interval_index.IntervalIndex
+
+
+def test_incomplete_index_is_not_used(database, indexdir):
+    buildLocal(interval_index, database, indexdir, ['cytoBand'])
+    # a build that has written the rows but not the rest
+    os.remove(os.path.join(indexdir, 'cytoBand', interval_index.MANIFEST))
+    os.remove(os.path.join(indexdir, 'cytoBand', 'chr1.start.npy'))
+
+    assert not interval_index.exists(indexdir, 'cytoBand')
+    with pytest.raises(IOError):
+        interval_index.IntervalIndex(indexdir, 'cytoBand')
+    assert stageTables(indexdir)['cytoBand'] is type(None)
+
+
+def test_snapshot_being_built_is_not_used(database, indexdir):
+    buildLocal(snapshot, database, indexdir, ['cytoBand', 'hugo'])
+    os.remove(os.path.join(indexdir, 'cytoBand', 'schema.json'))
+
+    found = stageTables(indexdir)
+    assert found['cytoBand'] is type(None)
+    assert found['hugo'] is snapshot.Snapshot
+
+
+def test_rebuild_drops_manifest_first(database, indexdir, monkeypatch):
+    buildLocal(interval_index, database, indexdir, ['cytoBand'])
+
+    seen = []
+    save = interval_index.savePartition
+    def savePartition(*args):
+        seen.append(interval_index.exists(indexdir, 'cytoBand'))
+        save(*args)
+    monkeypatch.setattr(interval_index, 'savePartition', savePartition)
+    buildLocal(interval_index, database, indexdir, ['cytoBand'])
+
+    assert seen == [False, False, False]
+    assert interval_index.exists(indexdir, 'cytoBand')
+
+@pytest.mark.parametrize('batchsize', [0, 50])
+@pytest.mark.parametrize('overlapjoin', ['sweep', 'probe'])
+@pytest.mark.parametrize('order', ['unsorted', 'sorted'])
+def test_matches_database(database, indexdir, vcf_text, sorted_vcf_text,
+    tmp_path, batchsize, overlapjoin, order):
+    text = vcf_text if (order == 'unsorted') else sorted_vcf_text
+    buildLocal(interval_index, database, indexdir, list(interval_index.TABLES))
+
+    expected = runDriver(tmp_path / 'database', text, batchsize=batchsize)
+    found = runDriver(tmp_path / 'local', text, batchsize=batchsize,
+        indexdir=indexdir, overlapjoin=overlapjoin)
+    assert found == expected
+
+### EOF
@@ -0,0 +1,102 @@
+# test_lookup_cache.py
+#
+# The lookup cache (lookup_cache.py) across jobs of one process: a job
+# after a reference table refresh gets the refreshed rows, whether or not
+# reference versions are configured
+#
+##
+
+import re
+import io
+import shutil
+import sqlite3
+import contextlib
+
+import pytest
+
+import utils
+import driver
+import lookup_cache
+from conftest import Connection
+
+
+"""Annotates a copy of vcf_text in directory against the database at path;
+   returns the output
+"""
+def annotate(path, directory, vcf_text, versions):
+    utils.db_connect = lambda refresh=False: Connection(path)
+    utils._db_pool = None
+    directory.mkdir()
+    infile = directory / 'in.vcf'
+    infile.write_text(vcf_text)
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver.run(str(infile), 'vcf', batchsize=50, versions=versions)
+    return (directory / 'in.annot.vcf').read_text()
+
+
+@pytest.fixture
+def refreshed(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'db_connect', utils.db_connect)
+    monkeypatch.setattr(utils, '_db_pool', None)
+    monkeypatch.setattr(lookup_cache, '_shared', None)
+    path = str(tmp_path / 'refreshed.db')
+    shutil.copy(database, path)
+    conn = sqlite3.connect(path)
+    conn.execute("update cytoBand set name = name || 'r'")
+    conn.execute("update gwasCatalog set trait = 'refreshed'")
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.mark.parametrize('before, after', [
+    (None, None),
+    ({'cytoBand': '1', 'gwasCatalog': '1'},
+        {'cytoBand': '2', 'gwasCatalog': '2'}),
+])
+def test_no_rows_from_before_a_refresh(database, refreshed, vcf_text,
+    tmp_path, before, after):
+    fresh = annotate(refreshed, tmp_path / 'fresh', vcf_text, after)
+
+    lookup_cache.shared(maxmb=64)
+    old = annotate(database, tmp_path / 'old', vcf_text, before)
+    warm = annotate(refreshed, tmp_path / 'warm', vcf_text, after)
+
+    assert 'refreshed' in fresh
+    assert old != fresh
+    assert warm == fresh
+
+
+"""Hits and misses of the cytoBand lookups in the log of directory
+"""
+def cytobandCounts(directory):
+    with open(directory / 'in.vcf.count.log') as fh:
+        log = fh.read()
+    hits, misses = re.search(r'\(cytoBand\): (\d+) hits, (\d+) misses',
+        log).groups()
+    return int(hits), int(misses)
+
+
+def test_shared_across_jobs_with_versions(database, vcf_text, tmp_path,
+    monkeypatch):
+    monkeypatch.setattr(lookup_cache, '_shared', None)
+    lookup_cache.shared(maxmb=64)
+    versions = {'cytoBand': '1'}
+    annotate(database, tmp_path / 'a', vcf_text, versions)
+    annotate(database, tmp_path / 'b', vcf_text, versions)
+
+    assert cytobandCounts(tmp_path / 'a')[1] > 0
+    # the second job finds every lookup of the first
+    assert cytobandCounts(tmp_path / 'b')[1] == 0
+
+
+def test_per_job_without_versions(database, vcf_text, tmp_path, monkeypatch):
+    monkeypatch.setattr(lookup_cache, '_shared', None)
+    cache = lookup_cache.shared(maxmb=64)
+    annotate(database, tmp_path / 'a', vcf_text, None)
+    annotate(database, tmp_path / 'b', vcf_text, None)
+
+    assert cytobandCounts(tmp_path / 'a') == cytobandCounts(tmp_path / 'b')
+    assert len(cache.entries) == 0
+
+### EOF
@@ -0,0 +1,95 @@
+# test_position_filter.py
+#
+# dbSNP position filters (position_filter.py) built from the sqlite
+# reference database: what they hold, annotation with them giving the
+# output of the database alone, and how an incomplete filter is treated
+#
+##
+
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+import position_filter
+from conftest import buildLocal, runDriver
+
+
+@pytest.fixture
+def filterdir(database, tmp_path):
+    buildLocal(position_filter, database, str(tmp_path), ['dbSNP'])
+    return str(tmp_path)
+
+
+def dbsnpPositions(database):
+    conn = sqlite3.connect(database)
+    positions = {}
+    for chrom, pos in conn.execute('select CHR, POS from dbSNP'):
+        positions.setdefault(chrom, set()).add(pos)
+    conn.close()
+    return positions
+
+
+def test_build_matches_table(database, filterdir):
+    assert position_filter.exists(filterdir, 'dbSNP')
+    filt = position_filter.PositionFilter(filterdir, 'dbSNP')
+    expected = dbsnpPositions(database)
+    assert filt.chroms == set(expected)
+    for chrom, positions in expected.items():
+        assert filt.chrom(chrom).tolist() == sorted(positions)
+        probe = sorted(positions) + [p + 1 for p in positions
+            if p + 1 not in positions]
+        assert filt.containsMany(chrom, probe).tolist() == \
+            [p in positions for p in probe]
+    # no temporary files left behind
+    assert not [f for f in os.listdir(position_filter.path(filterdir,
+        'dbSNP')) if f.endswith('.tmp')]
+
+
+def test_chromosome_not_in_table(filterdir):
+    filt = position_filter.PositionFilter(filterdir, 'dbSNP')
+    assert filt.containsMany('GL000192.1', [1, 2]).tolist() == [False, False]
+
+
+def test_incomplete_build_is_not_used(filterdir):
+    # a build that has not written its manifest yet
+    os.remove(os.path.join(position_filter.path(filterdir, 'dbSNP'),
+        position_filter.MANIFEST))
+    assert not position_filter.exists(filterdir, 'dbSNP')
+    with pytest.raises(IOError):
+        position_filter.PositionFilter(filterdir, 'dbSNP')
+
+
+def test_missing_chromosome_file_raises(filterdir):
+    os.remove(os.path.join(position_filter.path(filterdir, 'dbSNP'),
+        '2.npy'))
+    filt = position_filter.PositionFilter(filterdir, 'dbSNP')
+    assert filt.containsMany('1', [1]).dtype == np.bool_
+    with pytest.raises(IOError):
+        filt.containsMany('2', [1])
+    # and again, rather than as a chromosome without positions
+    with pytest.raises(IOError):
+        filt.containsMany('2', [1])
+
+
+@pytest.mark.parametrize('batchsize', [0, 50])
+@pytest.mark.parametrize('order', ['unsorted', 'sorted'])
+def test_matches_database(database, indexdir, vcf_text, sorted_vcf_text,
+    tmp_path, batchsize, order):
+    text = vcf_text if (order == 'unsorted') else sorted_vcf_text
+    buildLocal(position_filter, database, indexdir, ['dbSNP'])
+
+    expected = runDriver(tmp_path / 'database', text, batchsize=batchsize)
+    found = runDriver(tmp_path / 'filtered', text, batchsize=batchsize,
+        indexdir=indexdir)
+    assert found[0] == expected[0]
+    # the log only gains the filter's own line
+    log = found[1].decode('utf-8').splitlines(True)
+    line = [l for l in log if l.startswith('Position filter: ')]
+    assert len(line) == 1
+    assert ' 0 of ' not in line[0]
+    log.remove(line[0])
+    assert ''.join(log).encode('utf-8') == expected[1]
+
+### EOF
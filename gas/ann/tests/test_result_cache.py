@@ -0,0 +1,98 @@
+# test_result_cache.py
+#
+# The results index (result_cache.py) against the local S3 stand-in of
+# s3_stream.py: entries recorded for an input are found again under the
+# same digests, and results that are gone are not copied
+#
+##
+
+import pytest
+
+import driver
+import s3_stream
+import result_cache
+
+BUCKET = 'results'
+VERSIONS = {'cytoBand': '1', 'dbSNP': '1'}
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return s3_stream.LocalS3(str(tmp_path / 's3'))
+
+
+def stages():
+    return [stage for label, stage in driver.getStages('vcf')]
+
+
+def putResult(s3, key, sidecar=True):
+    s3.put_object(Bucket=BUCKET, Key=key + '.annot', Body=b'annotated\n')
+    s3.put_object(Bucket=BUCKET, Key=key + '.count.log', Body=b'Total: 3\n')
+    if sidecar:
+        s3.put_object(Bucket=BUCKET, Key=key + '.stages', Body=b'v1\n')
+
+
+def stored(s3, key):
+    return s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def test_lookup_record_round_trip(s3, tmp_path):
+    infile = tmp_path / 'in.vcf'
+    infile.write_bytes(b'#CHROM\n1\t100\n')
+    s3.put_object(Bucket=BUCKET, Key='input/in.vcf',
+        Body=infile.read_bytes())
+
+    version = result_cache.versionDigest(stages(), VERSIONS, False)
+    digests = [result_cache.fileDigest(str(infile), blocksize=3),
+        result_cache.objectDigest(s3, BUCKET, 'input/in.vcf')]
+    for digest in digests:
+        key = result_cache.indexKey('prefix', version, digest)
+        assert result_cache.lookup(s3, BUCKET, key) is None
+        result_cache.record(s3, BUCKET, key, 'prefix/user1/job1~in.vcf')
+        assert result_cache.lookup(s3, BUCKET, key) == \
+            'prefix/user1/job1~in.vcf'
+
+    # the same input read in other block sizes
+    assert result_cache.fileDigest(str(infile)) == digests[0]
+    assert digests[0].startswith('sha256-')
+    assert digests[1].startswith('etag-')
+
+
+def test_other_versions_miss(s3):
+    version = result_cache.versionDigest(stages(), VERSIONS, False)
+    result_cache.record(s3, BUCKET, result_cache.indexKey('prefix',
+        version, 'sha256-x'), 'prefix/user1/job1~in.vcf')
+
+    for other in [
+        result_cache.versionDigest(stages(), dict(VERSIONS, dbSNP='2'), False),
+        result_cache.versionDigest(stages(), VERSIONS, True),
+        result_cache.versionDigest(stages()[:1], VERSIONS,
+            False)]:
+        assert other != version
+        assert result_cache.lookup(s3, BUCKET, result_cache.indexKey(
+            'prefix', other, 'sha256-x')) is None
+
+
+@pytest.mark.parametrize('sidecar', [True, False])
+def test_copy_results(s3, sidecar):
+    putResult(s3, 'prefix/user1/job1~in.vcf', sidecar)
+    assert result_cache.copyResults(s3, BUCKET, 'prefix/user1/job1~in.vcf',
+        'prefix/user2/job2~in.vcf')
+
+    target = 'prefix/user2/job2~in.vcf'
+    assert stored(s3, target + '.annot') == b'annotated\n'
+    assert stored(s3, target + '.count.log') == b'Total: 3\n'
+    keys = [o['Key'] for o in s3.list_objects_v2(Bucket=BUCKET,
+        Prefix='prefix/user2/')['Contents']]
+    assert (target + '.stages' in keys) == sidecar
+
+
+@pytest.mark.parametrize('gone', ['.annot', '.count.log'])
+def test_copy_results_source_gone(s3, tmp_path, gone):
+    putResult(s3, 'prefix/user1/job1~in.vcf')
+    # archived or deleted since the entry was recorded
+    (tmp_path / 's3' / BUCKET / ('prefix/user1/job1~in.vcf' + gone)).unlink()
+    assert not result_cache.copyResults(s3, BUCKET,
+        'prefix/user1/job1~in.vcf', 'prefix/user2/job2~in.vcf')
+
+### EOF
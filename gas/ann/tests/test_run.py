@@ -0,0 +1,184 @@
+# test_run.py
+#
+# Job completion of run.py (uploads, status update and notifications),
+# and whole jobs run with the real driver, against the local stand-ins of
+# aws_async.py and s3_stream.py
+#
+##
+
+import io
+import json
+import gzip
+import asyncio
+import contextlib
+
+import pytest
+
+import aws_async
+import s3_stream
+import run
+from conftest import runDriver
+
+RESULTS = run.config['aws']['AWSS3ResultsBucket']
+PREFIX = run.config['aws']['AWSS3Prefix'] + '/user1/job1~in.vcf'
+
+
+"""LocalTable recording each update_item call
+"""
+class RecordingTable(aws_async.LocalTable):
+
+    def __init__(self):
+        aws_async.LocalTable.__init__(self)
+        self.calls = []
+
+    def update_item(self, **kwargs):
+        self.calls.append(kwargs)
+        return aws_async.LocalTable.update_item(self, **kwargs)
+
+
+@pytest.fixture
+def job(tmp_path):
+    s3 = s3_stream.LocalS3(str(tmp_path / 's3'))
+    table = RecordingTable()
+    sns = aws_async.LocalSns()
+    directory = tmp_path / 'user1'
+    directory.mkdir()
+    (directory / 'job1~in.vcf.count.log').write_text('Total: 3\n')
+    (directory / 'job1~in.annot.vcf').write_text('annotated\n')
+    return aws_async.AsyncAws(s3, table, sns), str(directory)
+
+
+def stored(aws, key):
+    return aws.s3.get_object(Bucket=RESULTS, Key=key)['Body'].read()
+
+
+def results(aws):
+    return [o['Key'] for o in
+        aws.s3.list_objects_v2(Bucket=RESULTS)['Contents']]
+
+
+def test_finish_job(job):
+    aws, directory = job
+    asyncio.run(run.finish_job(aws, directory, 'job1~in.vcf', 'user1',
+        streamed=False))
+
+    assert stored(aws, PREFIX + '.count.log') == b'Total: 3\n'
+    assert stored(aws, PREFIX + '.annot') == b'annotated\n'
+
+    # status and result locations in a single update
+    assert len(aws.table.calls) == 1
+    assert aws.table.calls[0]['Key'] == {'job_id': 'job1'}
+    item = aws.table.items[(('job_id', 'job1'),)]
+    assert item['job_status'] == 'COMPLETED'
+    assert item['s3_results_bucket'] == RESULTS
+    assert item['s3_key_log_file'] == PREFIX + '.count.log'
+    assert item['s3_key_result_file'] == PREFIX + '.annot'
+
+    topics = sorted([m['TopicArn'] for m in aws.sns.published])
+    assert topics == sorted([run.config['aws']['AwsSNSJobResultsTopic'],
+        run.config['aws']['AwsSNSJobArchiveTopic']])
+    for message in aws.sns.published:
+        assert json.loads(json.loads(message['Message'])['default']) == {
+            'job_id': 'job1', 'input_file_name': 'in.vcf', 'user_id': 'user1'}
+
+
+def test_finish_streamed_job_uploads_log_only(job):
+    aws, directory = job
+    asyncio.run(run.finish_job(aws, directory, 'job1~in.vcf', 'user1',
+        streamed=True))
+
+    assert results(aws) == [PREFIX + '.count.log']
+    assert len(aws.table.calls) == 1
+    assert len(aws.sns.published) == 2
+
+
+def test_finish_cached_job_uploads_nothing(job):
+    aws, directory = job
+    asyncio.run(run.finish_job(aws, directory, 'job1~in.vcf', 'user1',
+        streamed=False, cached=True))
+
+    assert results(aws) == []
+    assert aws.table.items[(('job_id', 'job1'),)]['job_status'] == \
+        'COMPLETED'
+    assert len(aws.sns.published) == 2
+
+
+@pytest.fixture
+def local(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(run, '_clients', {})
+    monkeypatch.setitem(run.config['aws'], 'LocalS3Dir', str(tmp_path / 's3'))
+    monkeypatch.setitem(run.config['ann'], 'ReferenceVersions', '')
+    monkeypatch.setitem(run.config['ann'], 'IntervalIndexDir', '')
+    monkeypatch.setitem(run.config['ann'], 'StreamS3', 'no')
+
+
+"""Runs the job at user1/name holding data, as the annotator would;
+   returns what it printed
+"""
+def runJob(tmp_path, name, data):
+    directory = tmp_path / 'user1'
+    directory.mkdir(exist_ok=True)
+    (directory / name).write_bytes(data)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        run.run_job(str(directory / name))
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('name', ['job1~in.vcf', 'job1~in.vcf.gz'])
+def test_run_job(local, vcf_text, tmp_path, name):
+    expected = runDriver(tmp_path / 'expected', vcf_text,
+        batchsize=int(run.config['ann']['BatchSize']),
+        sort=run.config['ann'].getboolean('SortInput'))
+    data = vcf_text.encode('utf-8')
+    runJob(tmp_path, name, gzip.compress(data) if name.endswith('.gz')
+        else data)
+
+    aws = run.aws_clients()
+    key = run.config['aws']['AWSS3Prefix'] + '/user1/' + name
+    annot = stored(aws, key + '.annot')
+    if name.endswith('.gz'):
+        annot = gzip.decompress(annot)
+    assert annot == expected[0]
+    assert stored(aws, key + '.count.log') == expected[1]
+    item = aws.table.items[(('job_id', 'job1'),)]
+    assert item['s3_key_result_file'] == key + '.annot'
+    # the job's files are gone, and with them the user's directory
+    assert not (tmp_path / 'user1').exists()
+
+
+def test_run_job_copies_earlier_results(local, vcf_text, tmp_path,
+    monkeypatch):
+    versions = tmp_path / 'versions.json'
+    versions.write_text(json.dumps({'cytoBand': 1, 'dbSNP': 1}))
+    monkeypatch.setitem(run.config['ann'], 'ReferenceVersions',
+        str(versions))
+    monkeypatch.setitem(run.config['ann'], 'ResultCache', 'yes')
+    data = vcf_text.encode('utf-8')
+    runJob(tmp_path, 'job1~in.vcf', data)
+    out = runJob(tmp_path, 'job2~in.vcf', data)
+
+    aws = run.aws_clients()
+    prefix = run.config['aws']['AWSS3Prefix'] + '/user1/'
+    assert 'Results copied from ' + prefix + 'job1~in.vcf' in out
+    for ext in ['.annot', '.count.log', '.stages']:
+        assert stored(aws, prefix + 'job2~in.vcf' + ext) == \
+            stored(aws, prefix + 'job1~in.vcf' + ext)
+
+
+def test_remove_job_files_keeps_other_jobs(tmp_path):
+    directory = tmp_path / 'user1'
+    directory.mkdir()
+    job1 = ['job1~in.vcf', 'job1~in.annot.vcf', 'job1~in.vcf.count.log',
+        'job1~in.vcf.shard.0']
+    job2 = ['job2~in.vcf', 'job2~in.vcf.count.log']
+    for name in job1 + job2:
+        (directory / name).write_text('x')
+
+    run.remove_job_files(str(directory), 'job1~in.vcf')
+    assert sorted(p.name for p in directory.iterdir()) == job2
+
+    run.remove_job_files(str(directory), 'job2~in.vcf')
+    assert not directory.exists()
+
+### EOF
@@ -0,0 +1,164 @@
+# test_s3_stream.py
+#
+# Streaming S3 transfers against the LocalS3 stand-in: ranged reads,
+# multipart writes, and streamed annotation jobs matching local ones
+#
+##
+
+import os
+import io
+import gzip
+import random
+import contextlib
+
+import pytest
+
+import s3_stream
+import bgzf
+import driver
+
+BUCKET = 'gas-inputs'
+
+
+"""LocalS3 recording the ranges read and the (number, size) of the parts
+   uploaded
+"""
+class RecordingS3(s3_stream.LocalS3):
+
+    def __init__(self, root):
+        s3_stream.LocalS3.__init__(self, root)
+        self.ranges = []
+        self.parts = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.ranges.append(Range)
+        return s3_stream.LocalS3.get_object(self, Bucket, Key, Range=Range)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.parts.append((PartNumber, len(Body)))
+        return s3_stream.LocalS3.upload_part(self, Bucket, Key, UploadId,
+            PartNumber, Body, **kwargs)
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return RecordingS3(str(tmp_path / 's3'))
+
+
+def randomBytes(n, seed=1):
+    return random.Random(seed).randbytes(n)
+
+
+def test_reader_reads_ranges(s3):
+    data = randomBytes(100000)
+    s3.put_object(Bucket=BUCKET, Key='data', Body=data)
+
+    reader = s3_stream.S3Reader(s3, BUCKET, 'data', partsize=4096, threads=3)
+    chunks = []
+    sizes = [1, 100, 4095, 4097, 20000]
+    while True:
+        chunk = reader.read(sizes[len(chunks) % len(sizes)])
+        if not chunk:
+            break
+        chunks.append(chunk)
+    reader.close()
+
+    assert b''.join(chunks) == data
+    assert len(s3.ranges) == (len(data) + 4095) // 4096
+    assert s3.ranges[0] == 'bytes=0-4095'
+    assert s3.ranges[-1] == f'bytes={4096 * (len(s3.ranges) - 1)}-99999'
+
+
+def test_reader_empty_object(s3):
+    s3.put_object(Bucket=BUCKET, Key='empty', Body=b'')
+    reader = s3_stream.S3Reader(s3, BUCKET, 'empty', partsize=4096)
+    assert reader.read() == b''
+    reader.close()
+    assert s3.ranges == []
+
+
+def test_writer_uploads_parts(s3):
+    data = randomBytes(50000)
+    writer = s3_stream.S3Writer(s3, BUCKET, 'out', partsize=8192, threads=2)
+    for i in range(0, len(data), 3000):
+        writer.write(data[i:i + 3000])
+    writer.close()
+
+    assert s3.get_object(Bucket=BUCKET, Key='out')['Body'].read() == data
+    # parts upload on threads, so they finish in any order
+    assert [size for number, size in sorted(s3.parts)] == \
+        [8192] * 6 + [len(data) - 6 * 8192]
+    assert os.listdir(os.path.join(s3.root, '.uploads')) == []
+
+
+def test_writer_small_object_single_put(s3):
+    writer = s3_stream.S3Writer(s3, BUCKET, 'small', partsize=8192)
+    writer.write(b'tiny')
+    writer.close()
+
+    assert s3.get_object(Bucket=BUCKET, Key='small')['Body'].read() == b'tiny'
+    assert s3.parts == []
+
+
+def test_transfer_files(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(s3_stream, 'PART_SIZE', 5000)
+    data = randomBytes(23456)
+    (tmp_path / 'up').write_bytes(data)
+
+    s3_stream.upload_file(s3, str(tmp_path / 'up'), BUCKET, 'file')
+    s3_stream.download_file(s3, BUCKET, 'file', str(tmp_path / 'down'))
+
+    assert (tmp_path / 'down').read_bytes() == data
+    assert len(s3.parts) == 5
+    assert len(s3.ranges) == 5
+
+
+"""Writes text as the job input name in directory: plain, gzip, or bgzip
+"""
+def writeInput(directory, name, text, compression):
+    path = os.path.join(directory, name)
+    if (compression == 'gzip'):
+        with gzip.open(path, 'wt') as fh:
+            fh.write(text)
+    elif (compression == 'bgzip'):
+        fh = bgzf.openOutput(path)
+        fh.write(text)
+        fh.close()
+    else:
+        with open(path, 'w') as fh:
+            fh.write(text)
+    return path
+
+
+@pytest.mark.parametrize('compression', ['plain', 'gzip', 'bgzip'])
+def test_run_s3_matches_run(s3, database, vcf_text, tmp_path, monkeypatch,
+    compression):
+    # small parts, so the job reads and writes many of them
+    monkeypatch.setattr(s3_stream, 'PART_SIZE', 4096)
+    name = 'job~in.vcf' if (compression == 'plain') else 'job~in.vcf.gz'
+
+    local = tmp_path / 'local'
+    local.mkdir()
+    infile = writeInput(str(local), name, vcf_text, compression)
+    streamed = tmp_path / 'streamed'
+    streamed.mkdir()
+    s3.upload_file(infile, BUCKET, 'user/' + name)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver.run(infile, 'vcf', batchsize=50)
+        driver.run_s3(s3, BUCKET, 'user/' + name, 'gas-results', 'out.annot',
+            str(streamed / name), 'vcf', batchsize=50,
+            compress=name.endswith('.gz'))
+
+    output = s3.get_object(Bucket='gas-results', Key='out.annot')['Body'].read()
+    with open(driver.getOutputFile(infile), 'rb') as fh:
+        assert output == fh.read()
+    fh = bgzf.openText(driver.getOutputFile(infile))
+    assert 'cytoBand=' in fh.read()
+    fh.close()
+    with open(infile + '.count.log') as fh:
+        assert (streamed / (name + '.count.log')).read_text() == fh.read()
+    assert len(s3.ranges) > 1
+    assert len(s3.parts) > 1
+
+### EOF
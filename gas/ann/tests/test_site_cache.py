@@ -0,0 +1,135 @@
+# test_site_cache.py
+#
+# The node's site cache (site_cache.py): runs served from a cold or warm
+# cache write what the fused pipeline writes without one, the stage
+# counters of cached records are replayed into the log, and the file is
+# kept under its size limit
+#
+##
+
+import pytest
+
+import site_cache
+from conftest import runDriver
+
+VERSIONS = {'cytoBand': '1', 'dbSNP': '1', 'gwasCatalog': '1'}
+
+
+def stages(directory):
+    return (directory / 'in.vcf.stages').read_bytes()
+
+
+@pytest.fixture
+def sites(tmp_path, monkeypatch):
+    monkeypatch.setattr(site_cache, '_config', None)
+    monkeypatch.setattr(site_cache, '_shared', None)
+    yield str(tmp_path / 'sites.db')
+    if site_cache._shared is not None:
+        site_cache._shared.close()
+
+
+@pytest.mark.parametrize('batchsize', [0, 50])
+def test_cold_and_warm_runs_match(database, vcf_text, sites, tmp_path,
+    batchsize):
+    expected = runDriver(tmp_path / 'plain', vcf_text, batchsize=batchsize,
+        versions=VERSIONS)
+
+    site_cache.shared(path=sites, maxmb=64)
+    cold = runDriver(tmp_path / 'cold', vcf_text, batchsize=batchsize,
+        versions=VERSIONS)
+    cache = site_cache.shared()
+    assert cache.hits == 0
+    stored = cache.conn.execute("SELECT COUNT(*) FROM sites").fetchone()[0]
+    assert stored > 0
+
+    # the log of the warm run comes from the counters stored with each site
+    warm = runDriver(tmp_path / 'warm', vcf_text, batchsize=batchsize,
+        versions=VERSIONS)
+    assert cache.hits >= stored
+
+    assert cold == expected
+    assert warm == expected
+    assert stages(tmp_path / 'cold') == stages(tmp_path / 'plain')
+    assert stages(tmp_path / 'warm') == stages(tmp_path / 'plain')
+
+
+def test_other_versions_miss(database, vcf_text, sites, tmp_path):
+    site_cache.shared(path=sites, maxmb=64)
+    runDriver(tmp_path / 'v1', vcf_text, versions=VERSIONS)
+    cache = site_cache.shared()
+    hits = cache.hits
+    runDriver(tmp_path / 'v2', vcf_text, versions=dict(VERSIONS,
+        cytoBand='2'))
+    assert cache.hits == hits
+
+
+def test_without_versions_unused(database, vcf_text, sites, tmp_path):
+    site_cache.shared(path=sites, maxmb=64)
+    runDriver(tmp_path / 'run', vcf_text)
+    assert site_cache.shared().misses == 0
+
+
+@pytest.mark.parametrize('info, cached', [
+    ('.', True),
+    ('DP=10', True),
+    ('AF=0.5;', True),
+    ('positionType=exon;DP=1', True),
+    # the dbSNP stage drops the leading '.'
+    ('.;DP=10', False),
+])
+def test_info_context(info, cached):
+    fields = ['1', '100', '.', 'A', 'C', '50', 'PASS', info]
+    assert (site_cache.infoContext(fields) is not None) == cached
+
+
+def test_info_context_key_parts():
+    def context(info, n=8):
+        return site_cache.infoContext(['1', '100', '.', 'A', 'C', '50',
+            'PASS', info, 'GT', '0/1'][:n])
+    assert context('DP=10') != context('DP=10', 10)
+    assert context('DP=10') == context('AF=1')
+    assert context('DP=10') != context('DP=10;')
+    assert context('positionType=exon') != context('positionType=intron')
+
+
+def test_key_excludes_headers_and_short_records():
+    annotator = site_cache.SiteAnnotator(None, [], {})
+    annotator.version = 'v'
+    assert annotator.key(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL',
+        'FILTER', 'INFO']) is None
+    assert annotator.key(['1', '100', '.', 'A', 'C']) is None
+    assert annotator.key(['1', '100', '.', 'A', 'C', '50', 'PASS',
+        '.']).startswith('v\t1\t100')
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    cache = site_cache.SiteCache(str(tmp_path / 'sites.db'), 256 * 1024)
+    value = {'id': '.', 'pad': 'x' * 2000}
+    cache.put([('first', value)])
+    # a clock that moves on with every use
+    times = iter(range(10, 100000))
+    monkeypatch.setattr(site_cache, 'time',
+        type('Clock', (), {'time': staticmethod(lambda: next(times))}))
+    for i in range(400):
+        cache.put([(f'site{i}', value)])
+        # the first site stays in use
+        assert cache.get(['first']) == {'first': value}
+
+    assert cache.size() <= cache.maxbytes
+    count = cache.conn.execute("SELECT COUNT(*) FROM sites").fetchone()[0]
+    assert 0 < count < 400
+    assert len(cache.get(['site0', 'site1', 'site2'])) == 0
+    assert cache.get(['site399']) == {'site399': value}
+    cache.close()
+
+
+def test_shared_disabled_by_blank_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(site_cache, '_config', None)
+    monkeypatch.setattr(site_cache, '_shared', None)
+    assert site_cache.shared(path='', maxmb=64) is None
+    cache = site_cache.shared(path=str(tmp_path / 'sites.db'), maxmb=1)
+    assert cache.maxbytes == 1024 * 1024
+    assert site_cache.shared() is cache
+    cache.close()
+
+### EOF
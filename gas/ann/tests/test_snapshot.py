@@ -0,0 +1,101 @@
+# test_snapshot.py
+#
+# Columnar snapshots (snapshot.py): how columns are stored and read back,
+# snapshots of the sqlite reference database holding the rows of its
+# tables, and annotation from them giving the output of the database
+#
+##
+
+import sqlite3
+
+import numpy as np
+import pytest
+
+import snapshot
+from conftest import buildLocal, runDriver
+
+
+"""Column values read back from a ColumnBuilder saved in shuffled order,
+   with the storage spec
+"""
+def roundTrip(tmp_path, values):
+    builder = snapshot.ColumnBuilder()
+    for value in values:
+        builder.append(value)
+    order = np.random.RandomState(len(values)).permutation(len(values))
+    spec = builder.save(str(tmp_path / 'col'), order)
+    column = snapshot.Column(str(tmp_path / 'col'), spec)
+    found = [None] * len(values)
+    for i, row in enumerate(order.tolist()):
+        found[row] = column.get(i)
+    column.close()
+    return found, spec
+
+
+@pytest.mark.parametrize('values, expected, encoding', [
+    ([3, None, -70000, 12, None], [3, None, -70000, 12, None], 'array'),
+    ([None, None, 1.5], [None, None, 1.5], 'array'),
+    ([1, 2.5, None, 4], [1.0, 2.5, None, 4.0], 'array'),
+    (['a', None, 'b', 'a', ''], ['a', None, 'b', 'a', ''], 'dict'),
+    ([7, 'x', None, 8], ['7', 'x', None, '8'], 'dict'),
+    ([b'1,2,', None, b'', b'\xff'], [b'1,2,', None, b'', b'\xff'], 'offset'),
+    ([None, None], [None, None], 'null'),
+])
+def test_column_round_trip(tmp_path, values, expected, encoding):
+    found, spec = roundTrip(tmp_path, values)
+    assert found == expected
+    assert [type(v) for v in found] == [type(v) for v in expected]
+    assert spec['encoding'] == encoding
+
+
+def test_column_dictionary_overflow(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, 'MAX_DICT', 4)
+    values = ['w' + str(i % 6) for i in range(20)] + [None, 'é']
+    found, spec = roundTrip(tmp_path, values)
+    assert found == values
+    assert spec['encoding'] == 'offset'
+
+
+def test_narrow_integers():
+    assert snapshot.narrowInt(np.array([0, 255])) == np.uint8
+    assert snapshot.narrowInt(np.array([-1, 100])) == np.int8
+    assert snapshot.narrowInt(np.array([0, 70000])) == np.uint32
+    assert snapshot.narrowInt(np.array([-1, 2 ** 40])) == np.int64
+
+
+def test_rows_match_tables(database, indexdir):
+    buildLocal(snapshot, database, indexdir, list(snapshot.TABLES))
+    conn = sqlite3.connect(database)
+    for table, (sources, chromName, start, end, columns) in \
+        snapshot.TABLES.items():
+        snap = snapshot.Snapshot(indexdir, table)
+        if sources is None:
+            chroms = [str(row[0]) for row in conn.execute(
+                f'select distinct {chromName} from {table}')]
+            sources = dict([(chrom, f'{table} where {chromName} = ' +
+                f"'{chrom}'") for chrom in chroms])
+        for chrom, source in sources.items():
+            rows = conn.execute(f'select {columns} from {source}').fetchall()
+            part = snap.partition(chrom)
+            if (len(rows) == 0):
+                assert part is None
+                continue
+            assert [part.row(r) for r in range(len(rows))] == rows
+        snap.close()
+    conn.close()
+
+
+@pytest.mark.parametrize('batchsize', [0, 50])
+@pytest.mark.parametrize('overlapjoin', ['sweep', 'probe'])
+@pytest.mark.parametrize('order', ['unsorted', 'sorted'])
+def test_matches_database(database, indexdir, vcf_text, sorted_vcf_text,
+    tmp_path, batchsize, overlapjoin, order):
+    text = vcf_text if (order == 'unsorted') else sorted_vcf_text
+    buildLocal(snapshot, database, indexdir, list(snapshot.TABLES))
+
+    expected = runDriver(tmp_path / 'database', text, batchsize=batchsize)
+    found = runDriver(tmp_path / 'local', text, batchsize=batchsize,
+        indexdir=indexdir, overlapjoin=overlapjoin)
+    assert found == expected
+
+### EOF
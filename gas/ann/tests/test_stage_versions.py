@@ -0,0 +1,144 @@
+# test_stage_versions.py
+#
+# Incremental re-annotation (stage_versions.py): after a reference table
+# refresh, recomputing only the stale stages of an annotated file gives
+# what a full run with the new versions gives, and the files it cannot
+# update are left for a full run
+#
+##
+
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import utils
+import driver
+import stage_versions
+from conftest import Connection, runDriver
+
+TABLES = ['cytoBand', 'gadAll', 'gwasCatalog', 'hugo', 'targetScanS',
+    'tfbsConsSites', 'dbSNP', 'refGene', 'chrom_pos_equal_base']
+V1 = dict([(table, '1') for table in TABLES])
+
+
+def useDatabase(path):
+    utils.db_connect = lambda refresh=False: Connection(path)
+    utils._db_pool = None
+
+
+"""Copy of the reference database with the rows of the refreshed tables
+   changed; returns its path
+"""
+def refresh(database, path, tables):
+    shutil.copy(database, path)
+    conn = sqlite3.connect(path)
+    updates = {
+        'cytoBand': "update cytoBand set name = name || 'r' " +
+            "where chromStart < 20000",
+        'hugo': "update hugo set descr = 'refreshed' " +
+            "where chromStart % 3 = 0",
+        'gwasCatalog': "delete from gwasCatalog where pubmed % 2 = 0",
+        'tfbsConsSites': "update tfbsConsSites1 set name = 'V$NEW'",
+        'gadAll': "update gadAll set name = 'DIS C'",
+        'dbSNP': "delete from dbSNP where POS % 2 = 0",
+    }
+    for table in tables:
+        conn.execute(updates[table])
+    conn.commit()
+    conn.close()
+    return path
+
+
+"""Annotated file, log and sidecar of directory
+"""
+def results(directory):
+    return [(directory / name).read_bytes() for name in
+        ['in.annot.vcf', 'in.vcf.count.log', 'in.vcf.stages']]
+
+
+@pytest.fixture
+def annotated(database, vcf_text, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'db_connect', utils.db_connect)
+    monkeypatch.setattr(utils, '_db_pool', None)
+    directory = tmp_path / 'annotated'
+    runDriver(directory, vcf_text, batchsize=50, versions=V1)
+    return directory
+
+
+def reannotate(directory, versions, batchsize=0):
+    infile = str(directory / 'in.vcf')
+    return driver.reannotate(driver.getOutputFile(infile), infile, 'vcf',
+        versions, batchsize=batchsize)
+
+
+@pytest.mark.parametrize('batchsize', [0, 50])
+@pytest.mark.parametrize('tables', [
+    ['cytoBand', 'hugo'],
+    ['gwasCatalog'],
+    ['tfbsConsSites', 'cytoBand'],
+])
+def test_reannotate_matches_full_run(database, annotated, vcf_text, tmp_path,
+    batchsize, tables, capsys):
+    v2 = dict(V1, **dict([(table, '2') for table in tables]))
+    useDatabase(refresh(database, str(tmp_path / 'v2.db'), tables))
+    expected = runDriver(tmp_path / 'full', vcf_text, batchsize=batchsize,
+        versions=v2)
+    assert expected[0] != results(annotated)[0]
+
+    assert reannotate(annotated, v2, batchsize) == stage_versions.UPDATED
+    assert results(annotated) == results(tmp_path / 'full')
+    assert 'recomputed (output changed)' in capsys.readouterr().out
+    # nothing left of the rewrite
+    assert sorted(os.listdir(annotated)) == ['in.annot.vcf', 'in.vcf',
+        'in.vcf.count.log', 'in.vcf.stages']
+
+    assert reannotate(annotated, v2) == stage_versions.CURRENT
+
+
+def test_reannotate_unchanged_output(annotated, vcf_text, tmp_path,
+    capsys):
+    v2 = dict(V1, cytoBand='2')
+    runDriver(tmp_path / 'full', vcf_text, versions=v2)
+
+    assert reannotate(annotated, v2) == stage_versions.UPDATED
+    # only the versions in the header and sidecar change
+    assert results(annotated) == results(tmp_path / 'full')
+    assert 'Cytoband - recomputed.' in capsys.readouterr().out
+
+
+def rerun(annotated, versions):
+    before = results(annotated)
+    assert reannotate(annotated, versions) == stage_versions.RERUN
+    # the file is left as it was, for the full run
+    assert results(annotated) == before
+    assert sorted(os.listdir(annotated)) == ['in.annot.vcf', 'in.vcf',
+        'in.vcf.count.log', 'in.vcf.stages']
+
+
+@pytest.mark.parametrize('table', ['dbSNP', 'gadAll',
+    'chrom_pos_equal_base'])
+def test_rerun_unspliceable_stage(annotated, table):
+    rerun(annotated, dict(V1, cytoBand='2', **{table: '2'}))
+
+
+def test_rerun_sidecar_not_matching(annotated):
+    sidecar = annotated / 'in.vcf.stages'
+    lines = sidecar.read_text().splitlines(True)
+    # a record more than the file has
+    sidecar.write_text(''.join(lines + lines[-1:]))
+    rerun(annotated, dict(V1, cytoBand='2'))
+
+    # runs that do not add up to the INFO column
+    lines[5] = lines[5].rstrip('\n') + ' 3:7\n'
+    sidecar.write_text(''.join(lines))
+    rerun(annotated, dict(V1, cytoBand='2'))
+
+
+def test_rerun_without_sidecar(annotated):
+    os.remove(annotated / 'in.vcf.stages')
+    assert reannotate(annotated, dict(V1, cytoBand='2')) == \
+        stage_versions.RERUN
+
+### EOF
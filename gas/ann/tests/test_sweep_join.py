@@ -0,0 +1,77 @@
+# test_sweep_join.py
+#
+# Sweeps (sweep_join.py) over windows of positions against a brute force
+# overlap check: sorted windows advance the sweep, out-of-order ones
+# fall back to the partition's own search
+#
+##
+
+import random
+
+import pytest
+
+import interval_index
+import sweep_join
+from conftest import buildLocal, randomIntervals, bruteForce, makePartition
+
+
+"""Sorted positions up to length (the range of randomIntervals), cut into
+   windows of up to size
+"""
+def sortedWindows(size, seed=1, length=2100):
+    rand = random.Random(seed)
+    positions = sorted([rand.randint(-20, length) for i in range(600)])
+    windows = []
+    while positions:
+        n = rand.randint(1, size)
+        windows.append(positions[:n])
+        positions = positions[n:]
+    return windows
+
+
+@pytest.mark.parametrize('pad', [0, 1, 40])
+@pytest.mark.parametrize('size', [1, 16, 300])
+def test_sweep_matches_brute_force(tmp_path, pad, size):
+    starts, ends = randomIntervals(300, seed=size)
+    part = makePartition(tmp_path, starts, ends)
+    sweep = sweep_join.Sweep(part, pad)
+
+    for window in sortedWindows(size, seed=pad):
+        found = sweep.findMany(window)
+        assert found == [bruteForce(starts, ends, pos, pad) for pos in window]
+        # rows come from the kept rows of active intervals or the partition
+        assert sweep.decode(found) == [[(r,) for r in ranks]
+            for ranks in found]
+        # only intervals that can reach a later position stay active
+        assert all(part.end[sweep.active] + pad >= window[-1])
+    assert sweep.next <= len(starts)
+    part.close()
+
+
+def test_sweep_out_of_order_windows(tmp_path):
+    starts, ends = randomIntervals(200)
+    part = makePartition(tmp_path, starts, ends)
+    sweep = sweep_join.Sweep(part, 5)
+    windows = [[100, 200, 300], [250, 260], [900, 50, 400], [1000, 1500],
+        [1400], [], [1600, 1600, 2000]]
+
+    for window in windows:
+        assert sweep.findMany(window) == \
+            [bruteForce(starts, ends, pos, 5) for pos in window]
+    part.close()
+
+
+def test_sweep_join_matches_index(database, indexdir):
+    buildLocal(interval_index, database, indexdir, ['hugo', 'tfbsConsSites'])
+    for table, chroms in [('hugo', ['chr1', 'chr2', 'chrX', 'chr9']),
+        ('tfbsConsSites', ['1', 'X', 'Y'])]:
+        index = interval_index.IntervalIndex(indexdir, table)
+        join = sweep_join.SweepJoin(index)
+        for chrom in chroms:
+            for pad in [0, 500]:
+                for window in sortedWindows(40, length=60000):
+                    assert join.queryMany(chrom, window, pad) == \
+                        index.queryMany(chrom, window, pad)
+        index.close()
+
+### EOF
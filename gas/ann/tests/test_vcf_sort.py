@@ -0,0 +1,87 @@
+# test_vcf_sort.py
+#
+# Sort order of VCF input (vcf_sort.py) and the tabix index of the sorted
+# output, for inputs naming chromosomes with and without 'chr'
+#
+##
+
+import struct
+import gzip
+
+import pytest
+
+import bgzf
+import vcf_sort
+
+HEADER = ['##fileformat=VCFv4.0\n',
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+
+
+def record(chrom, pos, id='.'):
+    return f'{chrom}\t{pos}\t{id}\tA\tC\t50\tPASS\t.\n'
+
+
+def chroms(lines):
+    return [line.split('\t')[0] for line in lines if not line.startswith('#')]
+
+
+"""Sequence names of the tabix index of path
+"""
+def tabixNames(path):
+    with gzip.open(path + '.tbi', 'rb') as fh:
+        data = fh.read()
+    count, length = struct.unpack('<i', data[4:8])[0], \
+        struct.unpack('<i', data[32:36])[0]
+    names = data[36:36 + length].split(b'\0')[:count]
+    return [name.decode('utf-8') for name in names]
+
+
+def test_sorted_lines_order_and_ties():
+    lines = HEADER + [record('2', 5), record('X', 1), record('1', 30, 'a'),
+        record('GL000192.1', 7), record('1', 30, 'b'), record('1', 2)]
+    out = list(vcf_sort.sortedLines(iter(lines)))
+
+    assert out[:2] == HEADER
+    assert out[2:] == [record('1', 2), record('1', 30, 'a'),
+        record('1', 30, 'b'), record('2', 5), record('X', 1),
+        record('GL000192.1', 7)]
+
+
+def test_sorted_lines_spill():
+    lines = [record(c, p) for p in range(200, 0, -1) for c in ['2', '1']]
+    out = list(vcf_sort.sortedLines(iter(HEADER + lines), maxbytes=2000))
+    assert out == HEADER + sorted(lines, key=vcf_sort.recordKey)
+    assert vcf_sort.isSortedStream(iter(out))
+
+
+@pytest.mark.parametrize('lines, expected', [
+    ([record('1', 5), record('1', 9), record('2', 1)], True),
+    ([record('1', 9), record('1', 5)], False),
+    ([record('1', 5), record('2', 1), record('1', 9)], False),
+    # one chromosome under two names, each name contiguous
+    ([record('1', 5), record('1', 9), record('chr1', 2)], True),
+    ([record('1', 5), record('chr1', 9), record('1', 10)], False),
+])
+def test_is_sorted(lines, expected):
+    assert vcf_sort.isSortedStream(iter(HEADER + lines)) == expected
+
+
+def test_mixed_chromosome_naming_is_indexed(tmp_path):
+    path = str(tmp_path / 'in.vcf.gz')
+    lines = [record('chr2', 40), record('1', 30), record('chr1', 20),
+        record('2', 10), record('1', 10), record('chr1', 5), record('chrX', 3)]
+    with bgzf.openOutput(path) as fh:
+        fh.writelines(HEADER + lines)
+
+    assert vcf_sort.sortFile(path)
+    with bgzf.openText(path) as fh:
+        out = fh.readlines()
+    assert out == HEADER + [record('1', 10), record('1', 30),
+        record('chr1', 5), record('chr1', 20), record('2', 10),
+        record('chr2', 40), record('chrX', 3)]
+    assert not vcf_sort.sortFile(path)
+
+    bgzf.writeTabix(path)
+    assert tabixNames(path) == ['1', 'chr1', '2', 'chr2', 'chrX']
+
+### EOF
@@ -0,0 +1,110 @@
+# test_worker_pool.py
+#
+# Warm annotation workers (worker_pool.py) running stand-in jobs: exit
+# statuses come back through WorkerJob.poll(), a job that raises fails
+# without taking its worker down, and a worker killed mid-job is replaced
+#
+##
+
+import os
+import time
+import signal
+
+import pytest
+
+import run
+import worker_pool
+
+
+"""Stand-in for run.run_job, forked into the workers: the job's path says
+   what it does
+"""
+def runJob(path, bucket=None, key=None):
+    if path == 'fail':
+        raise ValueError('job failed')
+    if path == 'kill':
+        os.kill(os.getpid(), signal.SIGKILL)
+    if path.startswith('wait:'):
+        # until the test creates the file
+        while not os.path.exists(path[5:]):
+            time.sleep(0.01)
+        return
+    with open(path if bucket is None else path + '.out', 'w') as fh:
+        fh.write(str(os.getpid()))
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(run, 'configure', lambda: None)
+    monkeypatch.setattr(run, 'run_job', runJob)
+    pools = []
+
+    def make(size):
+        pools.append(worker_pool.WorkerPool(size))
+        return pools[-1]
+    yield make
+    for workers in pools:
+        workers.close()
+
+
+"""Exit status of job, polled until it is done
+"""
+def wait(job, timeout=20):
+    deadline = time.time() + timeout
+    while job.poll() is None:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return job.poll()
+
+
+def test_status_through_poll(pool, tmp_path):
+    workers = pool(1)
+    gate = str(tmp_path / 'gate')
+    job = workers.submit([f'wait:{gate}'])
+    assert job.poll() is None
+    assert workers.workers[0].busy
+    with pytest.raises(RuntimeError):
+        workers.submit([str(tmp_path / 'other')])
+
+    open(gate, 'w').close()
+    assert wait(job) == 0
+    assert not workers.workers[0].busy
+    # the status is kept once read
+    assert job.poll() == 0
+
+
+def test_streamed_job_arguments(pool, tmp_path):
+    workers = pool(1)
+    path = str(tmp_path / 'in.vcf')
+    assert wait(workers.submit([path, 'bucket', 'key'])) == 0
+    assert os.path.exists(path + '.out')
+
+
+def test_failed_job_keeps_worker(pool, tmp_path):
+    workers = pool(1)
+    pid = workers.workers[0].process.pid
+    assert wait(workers.submit(['fail'])) == 1
+
+    path = str(tmp_path / 'after')
+    assert wait(workers.submit([path])) == 0
+    # run by the same process
+    assert open(path).read() == str(pid)
+
+
+def test_killed_worker_is_replaced(pool, tmp_path):
+    workers = pool(2)
+    pids = [worker.process.pid for worker in workers.workers]
+    assert wait(workers.submit(['kill'])) != 0
+
+    replaced = workers.workers[0]
+    assert replaced.process.pid not in pids
+    assert replaced.process.is_alive()
+    assert not replaced.busy
+    # the other worker was not touched
+    assert workers.workers[1].process.pid == pids[1]
+
+    path = str(tmp_path / 'after')
+    assert wait(workers.submit([path])) == 0
+    assert open(path).read() == str(replaced.process.pid)
+
+### EOF
@@ -0,0 +1,110 @@
+# transcripts.py
+#
+# Parsed exon coordinates of refGene transcripts, so the gene stages find
+# the exons of a position with a binary search instead of splitting the
+# exonStarts/exonEnds blobs for every matching row of every variant.
+#
+# Models are parsed on first use for the transcripts a job hits. They can
+# also be exported once for the whole table and loaded at job start (see
+# the __main__ block below).
+#
+# Usage: python transcripts.py <output file> [table]
+##
+
+import sys
+import pickle
+import bisect
+
+"""Cache key of a refGene row: name, chrom, txStart, txEnd and the exon blobs
+"""
+def transcriptKey(row):
+    return (row[1], row[2], row[4], row[5], row[9], row[10])
+
+
+"""Exon starts, ends and running maximum of the ends, for the first
+   exonCount entries of the row; maxends is None when the exons are not
+   listed in start order, which is then scanned linearly
+"""
+def parseExons(row):
+    exonCount = int(row[8])
+    starts = [int(x) for x in
+        str(row[9].decode('utf-8')).split(',')[:exonCount]]
+    ends = [int(x) for x in
+        str(row[10].decode('utf-8')).split(',')[:exonCount]]
+
+    maxends = None
+    if (starts == sorted(starts)):
+        maxends = []
+        for end in ends:
+            maxends.append(end if (len(maxends) == 0) else
+                max(maxends[-1], end))
+    return (starts, ends, maxends)
+
+
+"""Exon models of the transcripts seen so far, shared by the gene stages
+   of a job
+"""
+class TranscriptModels(object):
+
+    def __init__(self, models=None):
+        self.models = {} if models is None else models
+
+    def model(self, row):
+        key = transcriptKey(row)
+        model = self.models.get(key)
+        if model is None:
+            model = parseExons(row)
+            self.models[key] = model
+        return model
+
+    """0-based numbers of the exons containing pos, in listed order
+       (what scanning with utils.isBetween would find)
+    """
+    def exons(self, row, pos):
+        starts, ends, maxends = self.model(row)
+        if maxends is None:
+            return [e for e in range(len(starts))
+                if (starts[e] <= pos) and (pos <= ends[e])]
+
+        hi = bisect.bisect_right(starts, pos)
+        lo = bisect.bisect_left(maxends, pos, 0, hi)
+        return [e for e in range(lo, hi) if (pos <= ends[e])]
+
+    def save(self, path):
+        with open(path, 'wb') as fh:
+            pickle.dump(self.models, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            return cls(pickle.load(fh))
+
+
+"""Parses every transcript of table (streamed with an unbuffered cursor)
+"""
+def build(conn, table='refGene'):
+    import pymysql.cursors
+
+    models = TranscriptModels()
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute('select * from ' + table)
+    for row in cursor:
+        models.model(row)
+    cursor.close()
+    return models
+
+
+if __name__ == '__main__':
+    import utils as u
+
+    if len(sys.argv) < 2:
+        print("Usage: python transcripts.py <output file> [table]")
+        sys.exit(1)
+
+    conn = u.db_connect()
+    models = build(conn, sys.argv[2] if (len(sys.argv) > 2) else 'refGene')
+    conn.close()
+    models.save(sys.argv[1])
+    print(f"{len(models.models)} transcripts")
+
+### EOF
@@ -12,14 +12,29 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 
 import os
+import time
 import json
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# RDS credentials, cached for DB_SECRET_TTL seconds so connections don't
+# each call Secrets Manager
+DB_SECRET_TTL = 3600
+_db_secret = None
+_db_secret_time = 0
+
+"""Get RDS credentials from AWS Secrets Manager, cached for DB_SECRET_TTL
+   refresh=True fetches them again (e.g. after the password was rotated)
 """
-def db_connect():
+def db_secret(refresh=False):
+    global _db_secret, _db_secret_time
+
+    if (not refresh) and (_db_secret is not None) and \
+        (time.time() - _db_secret_time < DB_SECRET_TTL):
+        return _db_secret
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -27,10 +42,18 @@ def db_connect():
     asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
         asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        _db_secret = json.loads(asm_response['SecretString'])
+        _db_secret_time = time.time()
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
+    return _db_secret
+
+
+"""Get connection to reference database
+"""
+def db_connect(refresh=False):
+    rds_secret = db_secret(refresh=refresh)
 
     # Extract database connection parameters
     rds_host = rds_secret['host']
@@ -48,6 +71,86 @@ def db_connect():
         db=database_name)
 
 
+"""Pool of reference database connections shared by the annotation stages
+   of a process. Connections are pinged before they are handed out and
+   reopened (with fresh credentials) if the server went away; at most size
+   connections are open, acquire() waits for one to be released.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, size=2):
+        self.size = size
+        self.idle = []
+        self.opened = 0
+        self.lock = threading.Condition()
+
+    def acquire(self):
+        with self.lock:
+            while (len(self.idle) == 0) and (self.opened >= self.size):
+                self.lock.wait()
+            conn = self.idle.pop() if (len(self.idle) > 0) else None
+            if conn is None:
+                self.opened = self.opened + 1
+
+        try:
+            if conn is not None:
+                try:
+                    conn.ping(reconnect=True)
+                    return conn
+                except pymysql.MySQLError:
+                    conn = None
+            try:
+                return db_connect()
+            except pymysql.MySQLError:
+                return db_connect(refresh=True)
+        except Exception:
+            with self.lock:
+                self.opened = self.opened - 1
+                self.lock.notify()
+            raise
+
+    """Returns conn to the pool; its transaction is rolled back so the next
+       user doesn't read from an old snapshot
+    """
+    def release(self, conn):
+        try:
+            conn.rollback()
+        except pymysql.MySQLError:
+            conn.close()
+            conn = None
+
+        with self.lock:
+            if conn is None:
+                self.opened = self.opened - 1
+            else:
+                self.idle.append(conn)
+            self.lock.notify()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.opened = self.opened - len(self.idle)
+            self.idle = []
+
+
+_db_pool = None
+_db_pool_pid = None
+
+"""The process-wide connection pool; a forked worker gets its own pool
+   instead of sharing the parent's sockets
+"""
+def db_pool(size=None):
+    global _db_pool, _db_pool_pid
+
+    if (_db_pool is None) or (_db_pool_pid != os.getpid()):
+        _db_pool = ConnectionPool(size=size or 2)
+        _db_pool_pid = os.getpid()
+    elif size is not None:
+        _db_pool.size = size
+    return _db_pool
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
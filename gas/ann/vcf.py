@@ -0,0 +1,275 @@
+# vcf.py
+#
+# Streaming VCF records for the annotation stages. A line is only split
+# into fields once a stage needs them and only joined again if a stage
+# changed them; the writer collects output lines and writes them in large
+# chunks instead of one write per line.
+#
+# The INFO column is an Info while the stages add to it: their tokens are
+# collected as pieces and joined once, when the record is written, and the
+# keys seen so far are indexed for get().
+#
+##
+
+import itertools
+
+"""One line of a VCF file
+   line is the text as read (stripped), or None once fields were changed;
+   fields is the split line, or None until a stage asks for it
+"""
+class VcfRecord(object):
+    __slots__ = ['line', 'fields']
+
+    def __init__(self, line, fields=None):
+        self.line = line
+        self.fields = fields
+
+    """First field, without splitting the line (header prefixes have no
+       tabs, so this is all the header checks need)
+    """
+    def head(self):
+        return self.line if self.fields is None else self.fields[0]
+
+    def split(self, sep='\t'):
+        if self.fields is None:
+            self.fields = self.line.split(sep)
+        return self.fields
+
+    """Replaces the fields with the ones a stage returned
+    """
+    def update(self, fields):
+        self.fields = fields
+        self.line = None
+
+    def text(self, sep='\t'):
+        if self.line is None:
+            self.line = sep.join([str(f) for f in self.fields])
+        return self.line
+
+
+"""INFO column the stages append tokens to; reads like the string it
+   stands for (str(), ==, len(), in, [0], [-1], startswith(), endswith()),
+   which is only built when asked for
+   Each piece remembers the owner set when it was added (the pipeline sets
+   the index of the running stage, see stage_versions.py), and added holds
+   the owners that used add().
+"""
+class Info(object):
+    __slots__ = ['pieces', 'owners', 'owner', 'size', 'keys', 'joined',
+        'added']
+
+    def __init__(self, text, owner=None):
+        self.owner = owner
+        self.added = None
+        self.set(text)
+
+    """Replaces the whole column with text
+    """
+    def set(self, text):
+        self.pieces = [text]
+        self.owners = [self.owner]
+        self.size = len(text)
+        self.keys = {}
+        self.joined = text
+        self.index(text)
+
+    def push(self, text):
+        self.pieces.append(text)
+        self.owners.append(self.owner)
+        self.size = self.size + len(text)
+        self.joined = None
+
+    """Appends text after a ';'
+    """
+    def append(self, text):
+        self.push(';')
+        self.push(text)
+        self.index(text)
+
+    """Appends text, after a ';' unless the column already ends in one
+    """
+    def add(self, text):
+        if self.added is None:
+            self.added = set()
+        self.added.add(self.owner)
+        if self.endswith(';'):
+            self.push(text)
+            self.index(text)
+        else:
+            self.append(text)
+
+    """Puts text in front of the column
+    """
+    def prepend(self, text):
+        self.pieces.insert(0, text)
+        self.owners.insert(0, self.owner)
+        self.size = self.size + len(text)
+        self.joined = None
+        self.keys = {}
+        self.index(self.text())
+
+    """Drops prefix from the start of the column, if it is there; pieces
+       after it keep their owners
+    """
+    def dropPrefix(self, prefix):
+        if not self.startswith(prefix):
+            return
+        n = len(prefix)
+        while (n > 0):
+            piece = self.pieces[0]
+            if (len(piece) <= n):
+                del self.pieces[0]
+                del self.owners[0]
+            else:
+                self.pieces[0] = piece[n:]
+            n = n - min(len(piece), n)
+        self.size = self.size - len(prefix)
+        self.joined = None
+        self.keys = {}
+        self.index(self.text())
+
+    """Strips whitespace from the end of the column, as str.rstrip()
+    """
+    def rstrip(self):
+        if not self.tail(1).isspace():
+            return
+        while (len(self.pieces) > 0):
+            piece = self.pieces[-1].rstrip()
+            self.size = self.size - len(self.pieces[-1]) + len(piece)
+            if (len(piece) > 0):
+                self.pieces[-1] = piece
+                break
+            del self.pieces[-1]
+            del self.owners[-1]
+        self.joined = None
+        self.keys = {}
+        self.index(self.text())
+
+    """Records the key=value tokens of text; the first value of a key
+       wins, as with utils.parse_field()
+    """
+    def index(self, text):
+        for token in text.split(';'):
+            pair = token.replace('"', '').replace("'", '').split('=')
+            if (len(pair) > 1):
+                self.keys.setdefault(pair[0], pair[1])
+
+    """Value of the first key token, or '.' if there is none
+    """
+    def get(self, key):
+        return self.keys.get(key, '.')
+
+    def text(self):
+        if self.joined is None:
+            self.joined = ''.join(self.pieces)
+        return self.joined
+
+    """(owner, length) of the runs of adjacent pieces with the same owner
+    """
+    def runs(self):
+        runs = []
+        for piece, owner in zip(self.pieces, self.owners):
+            if (len(piece) == 0):
+                continue
+            if (len(runs) > 0) and (runs[-1][0] == owner):
+                runs[-1][1] = runs[-1][1] + len(piece)
+            else:
+                runs.append([owner, len(piece)])
+        return [tuple(run) for run in runs]
+
+    def head(self, n):
+        text = ''
+        for piece in self.pieces:
+            if (len(text) >= n):
+                break
+            text = text + piece[:n - len(text)]
+        return text
+
+    def tail(self, n):
+        text = ''
+        for piece in reversed(self.pieces):
+            if (len(text) >= n):
+                break
+            text = piece[max(len(piece) - n + len(text), 0):] + text
+        return text
+
+    def startswith(self, prefix):
+        return self.head(len(prefix)) == prefix
+
+    def endswith(self, suffix):
+        return self.tail(len(suffix)) == suffix
+
+    def __str__(self):
+        return self.text()
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, Info):
+            other = other.text()
+        return (self.size == len(other)) and (self.text() == other)
+
+    def __contains__(self, text):
+        if (len(text) == 1):
+            return any([text in piece for piece in self.pieces])
+        return text in self.text()
+
+    def __getitem__(self, i):
+        if (i == 0) and (self.size > 0):
+            return self.head(1)
+        if (i == -1) and (self.size > 0):
+            return self.tail(1)
+        return self.text()[i]
+
+
+"""INFO column of a split record as an Info, so stages can append to it
+"""
+def info(fields):
+    if not isinstance(fields[7], Info):
+        fields[7] = Info(fields[7])
+    return fields[7]
+
+
+"""Reads fh in windows of up to batchsize records (one at a time for 0)
+"""
+def readWindows(fh, batchsize):
+    while True:
+        records = [VcfRecord(line.strip()) for line in
+            itertools.islice(fh, max(batchsize, 1))]
+        if (len(records) == 0):
+            return
+        yield records
+
+
+"""Buffers output records and writes them bufsize characters at a time
+"""
+class VcfWriter(object):
+
+    def __init__(self, fh, bufsize=1024 * 1024):
+        self.fh = fh
+        self.bufsize = bufsize
+        self.lines = []
+        self.size = 0
+
+    def write(self, record):
+        self.writeLine(record.text())
+
+    def writeLine(self, line):
+        self.lines.append(line)
+        self.size = self.size + len(line) + 1
+        if (self.size >= self.bufsize):
+            self.flush()
+
+    def flush(self):
+        if (len(self.lines) > 0):
+            self.lines.append('')
+            self.fh.write('\n'.join(self.lines))
+        self.lines = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+### EOF
@@ -0,0 +1,175 @@
+# vcf_sort.py
+#
+# Sort order of VCF input. isSorted() checks in one streaming pass that
+# the records of each chromosome are contiguous and in position order,
+# which is all the batched and index-based lookups, the shard splitting
+# and tabix need. An input that is not gets an external merge sort by
+# (chromosome, position): runs of at most maxbytes are sorted in memory
+# and spilled to temporary files, which are then merged. Records with the
+# same chromosome and position keep their input order.
+#
+# A chromosome is its name as written: tabix indexes '1' and 'chr1' as
+# two sequences, so an input naming one chromosome both ways keeps the
+# records of each name together, one name after the other.
+#
+# Usage: python vcf_sort.py <vcf file> [memory MB]
+##
+
+import os
+import heapq
+import tempfile
+
+import bgzf
+
+# memory of the records sorted at once (per spill file)
+MAX_BYTES = 256 * 1024 * 1024
+# rough per-record overhead of the line and its key
+RECORD_OVERHEAD = 150
+# version of the sort order; results of sorted inputs depend on it
+ORDER = 2
+
+CHROM_ORDER = dict([(str(i), i) for i in range(1, 23)] +
+    [('X', 23), ('Y', 24), ('M', 25), ('MT', 25)])
+
+"""Chromosome name without 'chr'; the stages look '1' and 'chr1' up as
+   the same chromosome, so they are sorted next to each other
+"""
+def chromName(chrom):
+    return chrom[3:] if chrom.lower().startswith('chr') else chrom
+
+
+"""Sort key of a chromosome name: 1-22, X, Y, M in that order, then any
+   other names alphabetically; names of the same chromosome ('1', 'chr1')
+   by the name as written
+"""
+def chromKey(chrom):
+    name = chromName(chrom)
+    rank = CHROM_ORDER.get(name.upper())
+    if rank is None:
+        return (1, 0, name, chrom)
+    return (0, rank, '', chrom)
+
+
+def position(fields):
+    try:
+        return int(fields[1])
+    except (IndexError, ValueError):
+        return -1
+
+
+"""Sort key of a record line
+"""
+def recordKey(line):
+    fields = line.split('\t', 2)
+    return chromKey(fields[0]), position(fields)
+
+
+"""True if the records of each chromosome of text stream fh are
+   contiguous and in position order
+"""
+def isSortedStream(fh):
+    seen = set()
+    chrom = None
+    last = -1
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t', 2)
+        if (fields[0] != chrom):
+            chrom = fields[0]
+            if chrom in seen:
+                return False
+            seen.add(chrom)
+            last = -1
+        pos = position(fields)
+        if (pos < last):
+            return False
+        last = pos
+    return True
+
+
+def isSorted(path):
+    with bgzf.openText(path) as fh:
+        return isSortedStream(fh)
+
+
+"""Sorts a run of record lines and writes them to a new temporary file in
+   tmpdir, returning its path
+"""
+def spill(lines, tmpdir):
+    lines.sort(key=recordKey)
+    fd, path = tempfile.mkstemp(prefix='vcfsort.', dir=tmpdir)
+    with os.fdopen(fd, 'w') as fh:
+        fh.writelines(lines)
+    return path
+
+
+"""Lines of text stream fh with the header first and the records sorted
+   by (chromosome, position), holding at most about maxbytes of records in
+   memory; spill files go to tmpdir and are removed once merged
+"""
+def sortedLines(fh, maxbytes=None, tmpdir=None):
+    maxbytes = maxbytes or MAX_BYTES
+    spills = []
+    try:
+        lines = []
+        size = 0
+        for line in fh:
+            if not line.endswith('\n'):
+                line = line + '\n'
+            if line.startswith('#'):
+                yield line
+                continue
+            lines.append(line)
+            size = size + len(line) + RECORD_OVERHEAD
+            if (size >= maxbytes):
+                spills.append(spill(lines, tmpdir))
+                lines = []
+                size = 0
+
+        # the last run stays in memory; heapq.merge is stable, so runs are
+        # merged in input order
+        lines.sort(key=recordKey)
+        runs = [open(path) for path in spills]
+        try:
+            for line in heapq.merge(*(runs + [lines]), key=recordKey):
+                yield line
+        finally:
+            for run in runs:
+                run.close()
+    finally:
+        for path in spills:
+            os.remove(path)
+
+
+"""Sorts VCF file path in place if it is not sorted (a compressed file is
+   rewritten as bgzip); returns True if it had to be sorted
+"""
+def sortFile(path, maxbytes=None):
+    if isSorted(path):
+        return False
+
+    tmp = path + '.sorting' + ('.gz' if path.endswith('.gz') else '')
+    with bgzf.openText(path) as fh:
+        with bgzf.openOutput(tmp) as fh_out:
+            for line in sortedLines(fh, maxbytes,
+                os.path.dirname(os.path.abspath(path))):
+                fh_out.write(line)
+    os.replace(tmp, path)
+    return True
+
+
+if __name__ == '__main__':
+    import sys
+
+    if (len(sys.argv) < 2):
+        print("Usage: python vcf_sort.py <vcf file> [memory MB]")
+        sys.exit(1)
+    maxbytes = int(float(sys.argv[2]) * 1024 * 1024) \
+        if (len(sys.argv) > 2) else None
+    if sortFile(sys.argv[1], maxbytes):
+        print(f"Sorted {sys.argv[1]}")
+    else:
+        print(f"{sys.argv[1]} is already sorted")
+
+### EOF
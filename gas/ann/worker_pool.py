@@ -0,0 +1,118 @@
+# worker_pool.py
+#
+# Pre-forked pool of warm annotation workers. Each worker is forked from
+# the annotator once, with run.py and its dependencies already imported,
+# and keeps its AWS clients, database connections, lookup cache and
+# reference indexes from one job to the next. Jobs are sent to an idle
+# worker over a pipe instead of starting a new `python run.py` per job.
+#
+##
+
+import traceback
+import multiprocessing
+
+import run
+
+"""Worker loop: runs the jobs received on conn one at a time and sends
+   back 0, or 1 if the job raised; returns when the annotator closes conn
+"""
+def serve(conn):
+    run.configure()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            run.run_job(*job)
+            conn.send(0)
+        except Exception:
+            traceback.print_exc()
+            conn.send(1)
+
+
+"""A job sent to a worker; poll() returns None while it runs and its exit
+   status afterwards, like subprocess.Popen.poll()
+"""
+class WorkerJob(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.worker.result()
+        return self.returncode
+
+
+"""One forked worker process and the annotator's end of its pipe
+"""
+class Worker(object):
+
+    def __init__(self, context):
+        self.context = context
+        self.start()
+
+    def start(self):
+        self.conn, child = self.context.Pipe()
+        self.process = self.context.Process(target=serve, args=(child,))
+        self.process.start()
+        child.close()
+        self.busy = False
+
+    def submit(self, job):
+        self.busy = True
+        self.conn.send(job)
+        return WorkerJob(self)
+
+    """Exit status of the running job, or None while it runs; a worker
+       that died mid-job is replaced and its job fails
+    """
+    def result(self):
+        if self.conn.poll():
+            try:
+                status = self.conn.recv()
+                self.busy = False
+                return status
+            except EOFError:
+                pass
+        elif self.process.is_alive():
+            return None
+
+        self.process.join()
+        status = self.process.exitcode or 1
+        self.conn.close()
+        self.start()
+        return status
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+
+
+"""size warm workers; submit() hands a job (the run.py arguments: local
+   path, and the input bucket and key of a streamed job) to an idle one
+"""
+class WorkerPool(object):
+
+    def __init__(self, size):
+        context = multiprocessing.get_context('fork')
+        self.workers = [Worker(context) for i in range(size)]
+
+    def submit(self, job):
+        for worker in self.workers:
+            if not worker.busy:
+                return worker.submit(tuple(job))
+        raise RuntimeError("No idle annotation worker")
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+### EOF